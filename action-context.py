@@ -1,12 +1,35 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
-from snipsTools import SnipsConfigParser
-from hermes_python.hermes import Hermes
-from hermes_python.ontology import *
-from snips_home_manager import SnipsHomeManager
-from enum import Enum
+from snips_home_manager import SnipsHomeManager, DEFAULT_API_ADDRESS, DEFAULT_POOL_SIZE, ALL_ENTITIES, TV_ENTITY
+from async_home_manager import AsyncIntentCallback
+from hass_state import HassStateMirror, DEFAULT_TTL
+from dispatch import CommandDispatcher, DEFAULT_QUEUE_SIZE
+from coalesce import CommandCoalescer
+from intent_router import command_router, intent_handler
+from conversation import ConversationStore, ConversationStep, DEFAULT_IDLE_TIMEOUT
+from entity_index import EntityIndex
+from scenes import HomeScenes
+from reconcile import StateReconciler
+from backends import HassBackends, DEFAULT_BACKEND
+from metrics import metrics, span, TimedHermes
+from config_watcher import ConfigWatcher, load_config, DEFAULT_INTERVAL as DEFAULT_RELOAD_INTERVAL
+from transport import MqttTransport, RestTransport, WebSocketTransport, connect_mqtt, TRANSPORTS, \
+    DEFAULT_STATE_TOPIC, DEFAULT_COMMAND_TOPIC, DEFAULT_QOS
+from supervisor import IntentSupervisor
+from profiler import SamplingProfiler, DEFAULT_DIRECTORY as DEFAULT_PROFILE_DIRECTORY
+from scheduler import HassScheduler, NORMAL, priority, DEFAULT_RATE, DEFAULT_BURST, \
+    DEFAULT_QUEUE_SIZE as DEFAULT_HASS_QUEUE_SIZE
+from resilience import CircuitBreaker, HassUnavailableError, DEFAULT_TIMEOUT, DEFAULT_RETRIES, \
+    DEFAULT_FAILURE_THRESHOLD, DEFAULT_RESET_TIMEOUT
+from multiprocessing.pool import ThreadPool
+import atexit
 import io
+import logging
+import threading
+import timeit
+
+logger = logging.getLogger(__name__)
 
 CONFIGURATION_ENCODING_FORMAT = "utf-8"
 CONFIG_INI = "config.ini"
@@ -26,6 +49,14 @@ INTENT_ARRIVE_HOME = "LLUWE19:arriveHome"
 INTENT_LEAVE_HOME = "LLUWE19:leaveHome"
 INTENT_GIVE_ANSWER = "LLUWE19:giveAnswer"
 
+SENTENCE_HASS_UNAVAILABLE = "sorry. home assistant is unavailable"
+
+# Options only read at startup, the others are applied when config.ini changes
+RESTART_SETTINGS = ('metrics_port', 'metrics_file', 'async_intents', 'hass_state_mirror', 'reconcile_state',
+                    'dispatch_workers', 'dispatch_queue_size', 'entity_discovery', 'record_intents',
+                    'config_reload_interval', 'mqtt_address', 'backends', 'routes', 'hass_transport',
+                    'mqtt_state_topic', 'mqtt_command_topic', 'mqtt_qos', 'intent_workers', 'profile_topic')
+
 
 class HomeManager(object):
     """
@@ -34,262 +65,761 @@ class HomeManager(object):
     on the actual task of calling Hass services and communicating with Hass onto the "SnipsHomeManager" who makes calls
     to the Hass REST API via HTTP.
     """
-    def __init__(self):
-        print("Loading HomeManager")
+    def __init__(self, config=None, blocking=True, mqtt_client=None, connect_websocket=None, shard=None):
+        """
+        :param config: Dict of the config sections, read from "config.ini" when None
+        :param blocking: Bool, start listening to MQTT straight away. False leaves the intent callback to be driven
+                         by the caller, e.g. the benchmark
+        :param mqtt_client: paho.mqtt.client.Client used by the MQTT transport, connected to "mqtt_address" when None
+        :param connect_websocket: Function(url, timeout) opening the connections of the WebSocket transport, with
+                                  the websocket-client package when None
+        :param shard: SiteShard, the satellites handled when running as one of several worker processes, None for all
+        """
+        logger.info("Loading HomeManager")
+        start = timeit.default_timer()
+        self.config = config
+        watch = self.config is None
+        if self.config is None:
+            self.config = self.read_config()
+        self.settings = self.read_settings(self.config)
+        self.shard = shard
+        logging.getLogger().setLevel(self.settings['log_level'])
+        if self.settings['metrics_port'] > 0:
+            # Each worker process on the next port
+            metrics.serve(self.settings['metrics_port'] + (shard.index if shard is not None else 0))
+        if self.settings['metrics_file']:
+            atexit.register(metrics.dump, self.worker_file(self.settings['metrics_file']))
+        self.autho = self.settings['http_api_token']
+        if not self.autho:
+            logger.warning("No http_api_token in the [secret] section of %s, Hass will refuse every call", CONFIG_INI)
+        self.header = self.api_header(self.autho)
+        self.conversations = ConversationStore(self.settings['conversation_timeout'], on_abort=self.undo_conversation)
+        pool_size = self.settings['hass_pool_size']
+        # Carries out the answers of conversations ahead of their end, in order for each satellite
+        self._speculation = CommandDispatcher(pool_size)
+        self.mqtt_client = mqtt_client
+        self.connect_websocket = connect_websocket
+        self.steward = self.create_steward(self.settings['hass_api_address'], self.autho,
+                                           self.create_transport(self.settings['hass_api_address'], self.autho))
+        self.backends = None
+        if self.settings['backends']:
+            self.backends = HassBackends(self.steward)
+            for name, api_address in self.settings['backends'].items():
+                token = self.settings['backend_tokens'][name]
+                self.backends.add(name, self.create_steward(api_address, token,
+                                                            self.create_transport(api_address, token, False)))
+            for key, name in self.settings['routes'].items():
+                self.backends.route(key, name)
+            self.steward.backends = self.backends
+        if self.settings['entity_discovery']:
+            self.steward.entity_index = EntityIndex(self.steward.get_states, self.settings['aliases'])
+            for steward in self.stewards():
+                if steward.state_mirror is not None:
+                    steward.state_mirror.add_listener(self.steward.entity_index.update)
+        self.profiler = SamplingProfiler(self.settings['profile_dir'])
+        for steward in self.stewards():
+            self.profiler.watch(steward)
+        if self.settings['profile_topic']:
+            if self.mqtt_client is None:
+                self.mqtt_client = connect_mqtt(self.settings['mqtt_address'])
+            self.profiler.listen(self.mqtt_client, self.settings['profile_topic'])
+        self.scenes = HomeScenes(self.steward)
+        self.set_coalesce_window(self.settings['coalesce_window'])
+        self.dispatcher = None
+        if self.settings['dispatch_workers'] > 0:
+            self.dispatcher = CommandDispatcher(self.settings['dispatch_workers'], self.settings['dispatch_queue_size'],
+                                                on_error=self.command_failed)
+        self.intent_callback = self.master_intent_callback
+        if self.settings['async_intents']:
+            self.intent_callback = AsyncIntentCallback(self.master_intent_callback, pool_size)
+        if self.settings['record_intents']:
+            from replay import IntentRecorder
+            self.intent_callback = IntentRecorder(self.intent_callback,
+                                                  self.worker_file(self.settings['record_intents']))
+        self._reload_lock = threading.Lock()
+        self.config_watcher = None
+        if watch and self.settings['config_reload_interval'] > 0:
+            self.config_watcher = ConfigWatcher(CONFIG_INI, self.reload_config, self.settings['config_reload_interval'])
+            self.config_watcher.start()
+
+        self.ready = threading.Event()  # Set once warmed up, before subscribing to the intents
+        self.warm_up()
+        self.ready.set()
+        logger.info("Ready in %.2fs", timeit.default_timer() - start)
+        if self.settings['profile_calls'] > 0:
+            self.profiler.start(self.settings['profile_calls'])
+
+        # start listening to MQTT
+        if blocking:
+            self.start_blocking()
+
+    @staticmethod
+    def read_config():
+        """
+        :return: Dict of the config sections of "config.ini", empty when there is none
+        """
         try:
-            self.config = SnipsConfigParser.read_configuration_file(CONFIG_INI)
-        except:
-            self.config = None
-            print("[Warning] No config file")
-        self.autho = self.config['secret']['http_api_token']
-        self.header = {
-            'Authorization': self.autho,
+            return load_config(CONFIG_INI)
+        except ValueError as e:
+            logger.warning("%s, using the defaults", e)
+            return {}
+
+    def worker_file(self, path):
+        """
+        :param path: String, file written by the action
+        :return: String, the file of this worker process when there are several, so they do not write to the same one
+        """
+        return self.shard.file_name(path) if self.shard is not None else path
+
+    @staticmethod
+    def read_settings(config):
+        """
+        Read and check every option of a config, so that a bad value is reported before any setting is changed
+        :param config: Dict of the config sections
+        :return: Dict, option -> value converted to the type of the option
+        :raises ValueError: When an option has a wrong value
+        """
+        options = config.get('global', {})
+
+        def value(option, default, kind=None, minimum=None):
+            raw = options.get(option, default)
+            if kind is None:
+                return raw
+            try:
+                converted = str(raw).lower() == 'true' if kind is bool else kind(raw)
+            except (TypeError, ValueError):
+                raise ValueError("{} is not a valid {}: {}".format(option, kind.__name__, raw))
+            if minimum is not None and converted < minimum:
+                raise ValueError("{} must be at least {}: {}".format(option, minimum, raw))
+            return converted
+
+        log_level = value('log_level', 'INFO').upper()
+        if not isinstance(logging.getLevelName(log_level), int):
+            raise ValueError("log_level is not a logging level: {}".format(log_level))
+        api_address = value('hass_api_address', DEFAULT_API_ADDRESS)
+        if not api_address.startswith(('http://', 'https://')):
+            raise ValueError("hass_api_address is not an http(s) address: {}".format(api_address))
+        if not api_address.endswith('/'):
+            api_address += '/'
+        secrets = config.get('secret', {})
+        token = secrets.get('http_api_token', '')
+        backends = {}
+        for name, address in config.get('backends', {}).items():
+            if name == DEFAULT_BACKEND or not address.startswith(('http://', 'https://')):
+                raise ValueError("[backends] {} is not an http(s) address of another Hass: {}".format(name, address))
+            backends[name] = address if address.endswith('/') else address + '/'
+        transport = value('hass_transport', 'rest').lower()
+        if transport not in TRANSPORTS:
+            raise ValueError("hass_transport is not one of {}: {}".format(", ".join(TRANSPORTS), transport))
+        qos = value('mqtt_qos', DEFAULT_QOS, int, 0)
+        if qos > 1:
+            raise ValueError("mqtt_qos must be 0 or 1: {}".format(qos))
+        routes = dict(config.get('routes', {}))
+        for key, name in routes.items():
+            if name != DEFAULT_BACKEND and name not in backends:
+                raise ValueError("[routes] {} goes to {}, which is not in [backends]".format(key, name))
+        return {
+            'log_level': log_level,
+            'metrics_port': value('metrics_port', 0, int, 0),
+            'metrics_file': value('metrics_file', ''),
+            'hass_api_address': api_address,
+            'hass_pool_size': value('hass_pool_size', DEFAULT_POOL_SIZE, int, 1),
+            'hass_timeout': value('hass_timeout', DEFAULT_TIMEOUT, float, 0.001),
+            'hass_retries': value('hass_retries', DEFAULT_RETRIES, int, 0),
+            'hass_breaker_failures': value('hass_breaker_failures', DEFAULT_FAILURE_THRESHOLD, int, 1),
+            'hass_breaker_reset': value('hass_breaker_reset', DEFAULT_RESET_TIMEOUT, float, 0),
+            'hass_rate_limit': value('hass_rate_limit', DEFAULT_RATE, float, 0),
+            'hass_rate_burst': value('hass_rate_burst', DEFAULT_BURST, int, 1),
+            'hass_queue_size': value('hass_queue_size', DEFAULT_HASS_QUEUE_SIZE, int, 1),
+            'async_intents': value('async_intents', 'false', bool),
+            'hass_state_mirror': value('hass_state_mirror', 'true', bool),
+            'hass_state_ttl': value('hass_state_ttl', DEFAULT_TTL, float, 0),
+            'reconcile_state': value('reconcile_state', 'true', bool),
+            'dispatch_workers': value('dispatch_workers', 0, int, 0),
+            'dispatch_queue_size': value('dispatch_queue_size', DEFAULT_QUEUE_SIZE, int, 1),
+            'coalesce_window': value('coalesce_window', 0, float, 0),
+            'conversation_timeout': value('conversation_timeout', DEFAULT_IDLE_TIMEOUT, float, 0),
+            'speculative_conversations': value('speculative_conversations', 'true', bool),
+            'entity_discovery': value('entity_discovery', 'true', bool),
+            'record_intents': value('record_intents', ''),
+            'intent_workers': value('intent_workers', 1, int, 1),
+            'profile_calls': value('profile_calls', 0, int, 0),
+            'profile_dir': value('profile_dir', DEFAULT_PROFILE_DIRECTORY),
+            'profile_topic': value('profile_topic', ''),
+            'config_reload_interval': value('config_reload_interval', DEFAULT_RELOAD_INTERVAL, float, 0),
+            'mqtt_address': value('mqtt_address', MQTT_ADDR),
+            'hass_transport': transport,
+            'mqtt_state_topic': value('mqtt_state_topic', DEFAULT_STATE_TOPIC),
+            'mqtt_command_topic': value('mqtt_command_topic', DEFAULT_COMMAND_TOPIC),
+            'mqtt_qos': qos,
+            'http_api_token': token,
+            'aliases': dict(config.get('aliases', {})),
+            'backends': backends,
+            'backend_tokens': dict((name, secrets.get('http_api_token_' + name, token)) for name in backends),
+            'routes': routes,
+        }
+
+    @staticmethod
+    def api_header(token):
+        """
+        :param token: String, Hass API token e.g. "Bearer ..."
+        :return: Dict, headers required by the Hass REST API
+        """
+        return {
+            'Authorization': token,
             "Content-Type": "application/json",
         }
-        self.context_commands = True
-        self.arriving = True
-        self.last_question = None
-        self.light_on = False
-        self.light_color = None
-        self.light_brightness = None
-        self.tv_on = False
-        self.steward = SnipsHomeManager(self.autho, self.header)
 
-        # start listening to MQTT
-        self.start_blocking()
+    def reload_config(self, config):
+        """
+        Apply a changed config file while intents are being handled. Every option is checked before any is applied,
+        a file with a bad value is reported and ignored. The connections to Hass are kept unless its address or the
+        pool size changed. Options that only take effect at startup are reported.
+        :param config: Dict of the config sections
+        :return: Bool, True if the config was applied
+        """
+        try:
+            settings = self.read_settings(config)
+        except ValueError as e:
+            logger.error("Ignoring the changes to %s: %s", CONFIG_INI, e)
+            return False
+        if self.settings['http_api_token'] and not settings['http_api_token']:
+            logger.error("Ignoring the changes to %s: http_api_token was removed from [secret]", CONFIG_INI)
+            return False
+        with self._reload_lock:
+            changed = sorted(option for option in settings if settings[option] != self.settings.get(option))
+            if not changed:
+                self.config = config
+                return True
+            restart = [option for option in changed if option in RESTART_SETTINGS]
+            if restart:
+                logger.warning("Restart the action to apply %s", ", ".join(restart))
+            logging.getLogger().setLevel(settings['log_level'])
+            self.autho = settings['http_api_token']
+            self.header = self.api_header(self.autho)
+            self.steward.configure(header=self.header, api_address=settings['hass_api_address'])
+            for steward in self.stewards():
+                steward.configure(pool_size=settings['hass_pool_size'], timeout=settings['hass_timeout'],
+                                  retries=settings['hass_retries'])
+                steward.breaker.failure_threshold = settings['hass_breaker_failures']
+                steward.breaker.reset_timeout = settings['hass_breaker_reset']
+                steward.scheduler.configure(slots=settings['hass_pool_size'], rate=settings['hass_rate_limit'],
+                                            burst=settings['hass_rate_burst'], queue_size=settings['hass_queue_size'])
+                if steward.state_mirror is not None:
+                    steward.state_mirror.ttl = settings['hass_state_ttl']
+            if self.backends is not None:
+                for name, token in settings['backend_tokens'].items():
+                    steward = self.backends.get(name)
+                    if steward is not None:
+                        steward.configure(header=self.api_header(token))
+            self.conversations.idle_timeout = settings['conversation_timeout']
+            self.profiler.directory = settings['profile_dir']
+            if settings['profile_calls'] != self.settings['profile_calls']:
+                if settings['profile_calls'] > 0:
+                    self.profiler.start(settings['profile_calls'])
+                else:
+                    self.profiler.stop()
+            self.set_coalesce_window(settings['coalesce_window'])
+            entity_index = self.steward.entity_index
+            if entity_index is not None:
+                entity_index.set_aliases(settings['aliases'])
+            if settings['hass_api_address'] != self.settings['hass_api_address']:
+                # Another Hass, the entities known so far may not exist there
+                if self.steward.state_mirror is not None:
+                    self.steward.state_mirror.restart()
+                elif entity_index is not None:
+                    try:
+                        entity_index.refresh()
+                    except HassUnavailableError as e:
+                        logger.warning("Could not discover the rooms: %s", e)
+            self.config, self.settings = config, settings
+        logger.info("Reloaded %s: %s", CONFIG_INI, ", ".join(changed))
+        return True
+
+    def set_coalesce_window(self, window):
+        """
+        Merge the commands given to a light within "window" seconds, 0 sends each straight away
+        :param window: Float, seconds
+        :return: None
+        """
+        coalescer = self.steward.coalescer
+        if window <= 0:
+            self.steward.coalescer = None
+            if coalescer is not None:
+                coalescer.flush()
+        elif coalescer is None:
+            self.steward.coalescer = CommandCoalescer(self.steward, window)
+        else:
+            coalescer.window = window
 
+    def create_transport(self, api_address, token, default=True):
+        """
+        :param api_address: String, address of the Hass REST API, still used to load the states over MQTT
+        :param token: String, Hass API token
+        :param default: Bool, True for the default instance, the only one reached over MQTT
+        :return: MqttTransport or WebSocketTransport depending on "hass_transport", None for the REST API
+        """
+        settings = self.settings
+        if settings['hass_transport'] == 'websocket':
+            return WebSocketTransport(self.api_header(token), api_address, self.connect_websocket)
+        if settings['hass_transport'] != 'mqtt' or not default:
+            return None
+        if self.mqtt_client is None:
+            self.mqtt_client = connect_mqtt(settings['mqtt_address'])
+        fallback = RestTransport(self.api_header(token), api_address, settings['hass_pool_size'])
+        return MqttTransport(self.mqtt_client, fallback, settings['mqtt_state_topic'], settings['mqtt_command_topic'],
+                             settings['mqtt_qos'])
+
+    def create_steward(self, api_address, token, transport=None):
+        """
+        Build the SnipsHomeManager calling a Hass instance, with its own connection pool, circuit breaker, scheduler,
+        state mirror and reconciler
+        :param api_address: String, address of the Hass REST API
+        :param token: String, Hass API token
+        :param transport: MqttTransport or WebSocketTransport, None for the REST API
+        :return: SnipsHomeManager, not warmed up yet
+        """
+        settings = self.settings
+        breaker = CircuitBreaker(settings['hass_breaker_failures'], settings['hass_breaker_reset'])
+        steward = SnipsHomeManager(token, self.api_header(token), api_address=api_address,
+                                   pool_size=settings['hass_pool_size'], timeout=settings['hass_timeout'],
+                                   retries=settings['hass_retries'], breaker=breaker, warm_up=False,
+                                   transport=transport)
+        steward.scheduler = HassScheduler(settings['hass_pool_size'], settings['hass_rate_limit'],
+                                          settings['hass_rate_burst'], settings['hass_queue_size'])
+        if settings['hass_state_mirror']:
+            steward.state_mirror = HassStateMirror(steward, settings['hass_state_ttl'])
+            if settings['reconcile_state']:
+                steward.reconciler = StateReconciler(steward.state_mirror)
+        return steward
+
+    def stewards(self):
+        """
+        :return: List of the SnipsHomeManager of every Hass instance, the default one first
+        """
+        if self.backends is None:
+            return [self.steward]
+        return self.backends.stewards()
+
+    def warm_up(self):
+        """
+        Get everything the first voice command needs at once instead of on its way: the states of the entities are
+        loaded from every Hass instance while their other pooled connections are opened and their API token is
+        checked, then the rooms of the lights are found. Failures are only reported, the first commands will try again.
+        :return: Bool, True if every Hass accepted its token and the states were loaded
+        """
+        stewards = self.stewards()
+        pool = ThreadPool(2 * len(stewards))
+        try:
+            with span('startup.warm_up'):
+                loads = [pool.apply_async(steward.state_mirror.start) for steward in stewards
+                         if steward.state_mirror is not None]
+                # Loading the states holds one of the pooled connections
+                pings = [pool.apply_async(steward.warm_up, (steward.pool_size - 1,)) for steward in stewards]
+                # Without a mirror the rooms are found while the connections open
+                loaded = all([load.get() for load in loads]) and self.discover_rooms()
+                token_valid = all([ping.get() for ping in pings])
+                return loaded and token_valid
+        finally:
+            pool.close()
+
+    def discover_rooms(self):
+        """
+        Find the rooms of the lights
+        :return: Bool, True if they were found
+        """
+        if self.steward.entity_index is not None:
+            try:
+                self.steward.entity_index.refresh()
+            except HassUnavailableError as e:
+                logger.warning("Could not discover the rooms: %s", e)
+                return False
+        return True
+
+    def command(self, entity_ids, action, *args, **kwargs):
+        """
+        Carry out a call to Hass. In dispatch mode the call is queued on the dispatcher and this returns straight
+        away, so the user gets an answer without waiting for Hass.
+        :param entity_ids: String or list of the entity ids changed by the call, "all" for every entity
+        :param action: SnipsHomeManager method making the call
+        :return: The result of the call, or a PendingCommand in dispatch mode
+        """
+        if self.dispatcher is None:
+            return action(*args, **kwargs)
+        return self.dispatcher.submit(entity_ids, action, *args, **kwargs)
+
+    def command_failed(self, command):
+        """
+        Called by the dispatcher when a queued call to Hass failed
+        """
+        if isinstance(command.error, HassUnavailableError):
+            logger.warning("%s for %s dropped, Hass is unavailable: %s", command.action.__name__, command.entity_ids,
+                           command.error)
+            return
+        logger.error("%s for %s failed: %s", command.action.__name__, command.entity_ids, command.error)
+
+    def check_rooms(self, hermes, intent_message, rooms):
+        """
+        Answer the user straight away when a room has no light known to Hass, instead of calling Hass for nothing
+        :return: Bool, True if every room is known
+        """
+        unknown = self.steward.unknown_rooms(rooms)
+        if unknown:
+            hermes.publish_end_session(intent_message.session_id, "I don't know the " + " or ".join(unknown))
+            return False
+        return True
+
+    @intent_handler(INTENT_LIGHT_ON, rooms=True)
     def turn_light_on(self, hermes, intent_message, rooms):
         """
         Process a command:
         Either turn on a specific choice of light/s or turn on every connected light.
         """
-        print("[DEBUG] (turn_light_on)")
+        logger.debug("(turn_light_on)")
+        if not self.check_rooms(hermes, intent_message, rooms):
+            return
         if len(rooms) > 0:
             sentence = "turning on the "
             for room in rooms:
-                print("Turning on ", room)
+                logger.debug("Turning on %s", room)
                 sentence += " " + room
-                self.steward.light_on(room)
+            entity_ids = self.steward.light_entities(rooms)
+            self.command(entity_ids, self.steward.apply, 'light/turn_on', entity_ids)
             sentence += " lights"
         else:
             sentence = "lights on"
-            self.steward.light_on_all()
+            self.command(ALL_ENTITIES, self.steward.light_on_all)
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @intent_handler(INTENT_LIGHT_OFF, rooms=True)
     def turn_light_off(self, hermes, intent_message, rooms):
         """
         Process a command:
         Either turn off a specific choice of light/s or turn off every connected light.
         """
-        print("[DEBUG] (turn_light_off)")
+        logger.debug("(turn_light_off)")
+        if not self.check_rooms(hermes, intent_message, rooms):
+            return
         if len(rooms) > 0:
             sentence = "turning off the "
             for room in rooms:
-                self.steward.light_off(room)
                 sentence += " " + room
+            entity_ids = self.steward.light_entities(rooms)
+            self.command(entity_ids, self.steward.apply, 'light/turn_off', entity_ids)
             sentence += " lights"
         else:
-            self.steward.light_off_all()
+            self.command(ALL_ENTITIES, self.steward.light_off_all)
             sentence = "lights off"
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @intent_handler(INTENT_LIGHT_COLOR, rooms=True)
     def set_light_color(self, hermes, intent_message, rooms):
         """
         Process a command:
         Either set the color of a specific choice of light/s or change the color of every connected light.
         """
-        print("[DEBUG] (set_light_color)")
+        logger.debug("(set_light_color)")
+        if not self.check_rooms(hermes, intent_message, rooms):
+            return
         color = self.extract_color(intent_message)
         if len(rooms) > 0:
             sentence = "changing  "
             for room in rooms:
                 sentence += " " + room
-                self.steward.light_color(room, color)
+            entity_ids = self.steward.light_entities(rooms)
+            self.command(entity_ids, self.steward.apply, 'light/turn_on', entity_ids, color_name=color)
             sentence += " lights to " + color
         else:
-            self.steward.light_color_all(color)
+            self.command(ALL_ENTITIES, self.steward.light_color_all, color)
             sentence = "changing lights to " + color
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @intent_handler(INTENT_LIGHT_BRIGHTNESS, rooms=True)
     def set_light_brightness(self, hermes, intent_message, rooms):
         """
         Process a command:
         Either change the brightness of a specific choice of light/s or of every connected light.
         """
-        print("[DEBUG] set_light_brightness ")
-        percent = intent_message.slots.percent.first().value
+        logger.debug("(set_light_brightness)")
+        if not self.check_rooms(hermes, intent_message, rooms):
+            return
+        with span('slots.percent'):
+            percent = intent_message.slots.percent.first().value
         if percent is None:
             sentence = "Did not specify the brightness"
             hermes.publish_end_session(intent_message.session_id, sentence)
         if len(rooms) > 0:
             sentence = "Setting  "
             for room in rooms:
-                self.steward.light_brightness(room, percent)
                 sentence += " " + room
+            entity_ids = self.steward.light_entities(rooms)
+            self.command(entity_ids, self.steward.apply, 'light/turn_on', entity_ids, brightness_pct=percent)
             sentence += " lights to " + str(percent)
         else:
-            self.steward.light_brightness_all(percent)
+            self.command(ALL_ENTITIES, self.steward.light_brightness_all, percent)
             sentence = "Setting light brightness to " + str(percent)
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @intent_handler(INTENT_TV_ON)
     def turn_tv_on(self, hermes, intent_message):
         """
         Process a command:
         Turn the tv on.
         """
-        self.steward.tv_on()
+        self.command(TV_ENTITY, self.steward.tv_on)
         sentence = "TV on"
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @intent_handler(INTENT_TV_OFF)
     def turn_tv_off(self, hermes, intent_message):
         """
         Process a command:
         Turn the tv off.
         """
-        self.steward.tv_off()
+        self.command(TV_ENTITY, self.steward.tv_off)
         sentence = "TV off"
         hermes.publish_end_session(intent_message.session_id, sentence)
 
+    @intent_handler(INTENT_ARRIVE_HOME)
     def start_conversation_arrive(self, hermes, intent_message):
         """
         Begin a conversation:
         Triggered with the "I'm home intent", starts a conversation setting lights and switches in the house.
         """
-        print("[DEBUG] (welcome_home)")
+        logger.debug("(welcome_home)")
+        conversation = self.conversations.start(intent_message.session_id, intent_message.site_id, arriving=True)
+        self.prepare_conversation(conversation)
         sentence = "welcome home. would you like the lights on"
-        self.last_question = sentence
-        self.context_commands = False
-        self.arriving = True
         hermes.publish_continue_session(intent_message.session_id, sentence, [INTENT_GIVE_ANSWER])
 
+    @intent_handler(INTENT_LEAVE_HOME)
     def start_conversation_leave(self, hermes, intent_message):
         """
         Begin a conversation:
         Triggered with the "I'm leaving intent", starts a conversation setting lights and switches in the house.
         """
-        print("[DEBUG] (good_bye)")
+        logger.debug("(good_bye)")
+        conversation = self.conversations.start(intent_message.session_id, intent_message.site_id, arriving=False)
+        self.prepare_conversation(conversation)
         sentence = "okay. would you like the lights on"
-        self.last_question = sentence
-        self.context_commands = False
-        self.arriving = False
         hermes.publish_continue_session(intent_message.session_id, sentence, [INTENT_GIVE_ANSWER])
 
-    def conversation(self, hermes, intent_message):
+    def conversation(self, hermes, intent_message, conversation):
         """
-        Becomes the main callback function when the conversation context is triggered (i.e when "context_commands" is false.
+        Becomes the main callback function for a session once it has started a conversation.
         Will ask for a number of user preferences and carry them out at the end of the conversation.
         """
-        print("[DEBUG] conversation")
+        logger.debug("(conversation)")
         session_id = intent_message.session_id
 
         """Check for slots"""
         answer = None
         if intent_message.slots.answer:
             answer = intent_message.slots.answer.first().value
-            print("The user answered: " + answer)
+            logger.debug("The user answered: %s", answer)
 
         if intent_message.slots.color:
-            print("message with color")
-            self.light_color = intent_message.slots.color.first().value
+            logger.debug("message with color")
+            conversation.light_color = intent_message.slots.color.first().value
 
         if intent_message.slots.percent:
-            print("message with brightness")
-            self.light_brightness = intent_message.slots.percent.first().value
+            logger.debug("message with brightness")
+            conversation.light_brightness = intent_message.slots.percent.first().value
             # Need to add some error checking to ensure that value is between 0 and 100 percent
 
         """Register the users answers + keep track of the conversation"""
-        if self.last_question == "welcome home. would you like the lights on" \
-                or self.last_question == "okay. would you like the lights on":
+        if conversation.step == ConversationStep.LIGHTS_ON:
             if answer == "yes":
-                self.light_on = True
+                conversation.light_on = True
+                conversation.step = ConversationStep.LIGHT_COLOR
                 sentence = "okay. what color do you want the light"
-                self.last_question = sentence
                 hermes.publish_continue_session(session_id, sentence, [INTENT_LIGHT_COLOR])
+                self.speculate(conversation, self.steward.light_on_all)
             else:
-                self.light_on = False
+                conversation.light_on = False
+                conversation.step = ConversationStep.TV_ON
                 sentence = "okay. did you want the TV on"
-                self.last_question = sentence
                 hermes.publish_continue_session(session_id, sentence, [INTENT_GIVE_ANSWER])
-        elif self.last_question == "okay. what color do you want the light":
+                self.speculate(conversation, self.steward.light_off_all)
+        elif conversation.step == ConversationStep.LIGHT_COLOR:
+            conversation.step = ConversationStep.LIGHT_BRIGHTNESS
             sentence = "okay. how bright do you want the light"
-            self.last_question = sentence
             hermes.publish_continue_session(session_id, sentence, [INTENT_LIGHT_BRIGHTNESS])
-        elif self.last_question == "okay. how bright do you want the light":
+            if conversation.light_color:
+                self.speculate(conversation, self.steward.light_color_all, conversation.light_color)
+        elif conversation.step == ConversationStep.LIGHT_BRIGHTNESS:
+            conversation.step = ConversationStep.TV_ON
+            if conversation.light_brightness is not None:
+                self.speculate(conversation, self.steward.light_brightness_all, conversation.light_brightness)
             sentence = "okay. did you want the TV on"
-            self.last_question = sentence
             hermes.publish_continue_session(session_id, sentence, [INTENT_GIVE_ANSWER])
-        elif self.last_question == "okay. did you want the TV on":
+        elif conversation.step == ConversationStep.TV_ON:
             if answer == "yes":
-                self.tv_on = True
+                conversation.tv_on = True
             else:
-                self.tv_on = False
+                conversation.tv_on = False
 
-            self.end_conversation(hermes, session_id)
+            self.end_conversation(hermes, conversation)
 
-    def end_conversation(self, hermes, session_id):
+    def end_conversation(self, hermes, conversation):
         """
         Now have all of the required information and can carry out the users requests
         """
 
-        """Carry out the requests"""
-        if self.tv_on:
-            self.steward.tv_on()
+        """Carry out the requests, as a single scene"""
+        carried_out = self.wait_speculation(conversation)
+        if conversation.speculated and carried_out:
+            # The lights were set while the user was answering, only the tv is left
+            self.command(TV_ENTITY, self.steward.tv_on if conversation.tv_on else self.steward.tv_off)
         else:
-            self.steward.tv_off()
-        if self.light_on:
-            self.steward.set_lights_all(self.light_color, self.light_brightness)
-        else:
-            self.steward.light_off_all()
-        if self.arriving:
+            self.command(ALL_ENTITIES, self.scenes.activate, conversation.light_on, conversation.light_color,
+                         conversation.light_brightness, conversation.tv_on)
+        if conversation.arriving:
             sentence = "okay. welcome home"
         else:
             sentence = "okay. see you later"
 
         """Return to command mode"""
-        self.context_commands = True
-        self.last_question = sentence
-        hermes.publish_end_session(session_id, sentence)
+        self.conversations.end(conversation.session_id)
+        hermes.publish_end_session(conversation.session_id, sentence)
+
+    def wait_speculation(self, conversation):
+        """
+        Wait for the calls carried out ahead of the end of a conversation, at most "hass_timeout" seconds in all so
+        that a hung Hass can not hold the Hermes callback thread
+        :param conversation: Conversation that is ending
+        :return: Bool, True if every call was made
+        """
+        deadline = timeit.default_timer() + self.settings['hass_timeout']
+        for command in conversation.pending:
+            if not command.wait(max(deadline - timeit.default_timer(), 0)):
+                logger.warning("(end_conversation) The answers of conversation %s are still being carried out, "
+                               "applying them again as a scene", conversation.session_id)
+                return False
+            if not command.result:
+                return False
+        return True
+
+    def speculate(self, conversation, action, *args):
+        """
+        Carry out part of a conversation ahead of its end, so that Hass is called while the user is still answering
+        instead of all at the end. The calls of a satellite are made one at a time, in order, on a worker thread,
+        those of other satellites in parallel. Does nothing when "speculative_conversations" is off.
+        :param conversation: Conversation the call is made for
+        :param action: Function making the call
+        :return: None
+        """
+        if not self.settings['speculative_conversations']:
+            return
+        conversation.speculated = True
+        conversation.pending.append(self._speculation.submit(conversation.site_id, self._speculative, action, *args))
+
+    def _speculative(self, action, *args):
+        """
+        Make a call ahead of the end of a conversation, after the commands of the users for a single light
+        :return: Bool, True if the call was made
+        """
+        try:
+            with span('speculation.' + action.__name__), priority(NORMAL):
+                action(*args)
+            return True
+        except HassUnavailableError as e:
+            logger.warning("(speculate) %s: %s", action.__name__, e)
+        except Exception:
+            logger.exception("(speculate) %s failed", action.__name__)
+        return False
+
+    def prepare_conversation(self, conversation):
+        """
+        Get ready to carry out the answers of a conversation on the speculation worker: note the state of the
+        lights, to put them back if the conversation is aborted, and open again the connections to the Hass instances
+        that have not answered for a while.
+        Does nothing when "speculative_conversations" is off.
+        :param conversation: Conversation that started
+        :return: None
+        """
+        if self.settings['speculative_conversations']:
+            conversation.pending.append(self._speculation.submit(conversation.site_id, self._speculative,
+                                                                 self._prepare, conversation))
+
+    def _prepare(self, conversation):
+        for steward in self.stewards():
+            if steward.is_cold():
+                steward.warm_up()
+        conversation.snapshot = HomeScenes.snapshot(self.steward.get_states())
+
+    def undo_conversation(self, conversation):
+        """
+        Put the lights back as they were when a conversation that was aborted started, if some of its answers were
+        already carried out
+        :param conversation: Conversation that was aborted
+        :return: None
+        """
+        if not conversation.speculated:
+            return
+        logger.info("(undo_conversation) Conversation %s aborted, putting the lights back", conversation.session_id)
+        # Queued after the calls made for the conversation, prepare_conversation included
+        self._speculation.submit(conversation.site_id, self._undo, conversation)
+
+    def _undo(self, conversation):
+        if conversation.snapshot:
+            self._speculative(self.scenes.apply, conversation.snapshot)
+
+    def session_ended(self, hermes, session_ended_message):
+        """
+        Called by Hermes when a dialogue session ended, abort the conversation of the session if it was still going
+        e.g. the user stopped answering
+        """
+        self.conversations.abort(session_ended_message.session_id)
 
     def master_intent_callback(self,hermes, intent_message):
         """
         Callback function to provide extra processing and routing for either commands or conversations.
-        Commands or conversations are managed using the "context_commands" boolean. E.g. if the "context_commands" is
-        true, then the system is in command mode and will listen and execute intents that issue commands. (turn light on).
-        If it is false it will continue to call back the conversation function until the conversation has been
-        processed.
+        Commands or conversations are managed per dialogue session by the "conversations" store. E.g. if the session
+        of the intent is not in a conversation, then the system is in command mode and will listen and execute intents
+        that issue commands. (turn light on). The handler of each command is looked up in the "command_router" table
+        (see the @intent_handler decorators).
+        If the session is in a conversation it will continue to call back the conversation function until the
+        conversation has been processed.
+        When Hass can not be reached the user is told so and the session ends, instead of leaving it hanging. A
+        conversation is then aborted, the answers already carried out being undone.
+        While the profiler is armed the handling of the intent is sampled.
         """
-        rooms = self.extract_house_rooms(intent_message)
+        if self.profiler.armed:
+            return self.profiler.run(self._handle_intent, hermes, intent_message)
+        return self._handle_intent(hermes, intent_message)
+
+    def _handle_intent(self, hermes, intent_message):
         intent_name = intent_message.intent.intent_name
-        print("[DEBUG] (master_intent_callback) intent_name: " + intent_name)
-        if self.context_commands:
-            print("[DEBUG] (master_intent_callback) In command mode")
-            if intent_name == INTENT_LIGHT_ON:
-                self.turn_light_on(hermes, intent_message, rooms)
-            elif intent_name == INTENT_LIGHT_OFF:
-                self.turn_light_off(hermes, intent_message, rooms)
-            elif intent_name == INTENT_LIGHT_COLOR:
-                self.set_light_color(hermes, intent_message, rooms)
-            elif intent_name == INTENT_LIGHT_BRIGHTNESS:
-                self.set_light_brightness(hermes, intent_message, rooms)
-            elif intent_name == INTENT_TV_ON:
-                self.turn_tv_on(hermes, intent_message)
-            elif intent_name == INTENT_TV_OFF:
-                self.turn_tv_off(hermes, intent_message)
-            elif intent_name == INTENT_ARRIVE_HOME:
-                self.start_conversation_arrive(hermes, intent_message)
-            elif intent_name == INTENT_LEAVE_HOME:
-                self.start_conversation_leave(hermes, intent_message)
-        else:
-            print("[DEBUG] (master_intent_callback) Conversation mode")
-            self.conversation(hermes, intent_message)
+        logger.debug("(master_intent_callback) intent_name: %s", intent_name)
+        hermes = TimedHermes(hermes, metrics)
+        with span('intent.' + intent_name):
+            try:
+                conversation = self.conversations.get(intent_message.session_id)
+                if conversation is None:
+                    logger.debug("(master_intent_callback) In command mode")
+                    if not command_router.dispatch(self, hermes, intent_message):
+                        logger.debug("(master_intent_callback) No handler for %s", intent_name)
+                else:
+                    logger.debug("(master_intent_callback) Conversation mode")
+                    self.conversation(hermes, intent_message, conversation)
+            except HassUnavailableError as e:
+                logger.warning("(master_intent_callback) %s: %s", intent_name, e)
+                # The answers already carried out are undone
+                self.conversations.abort(intent_message.session_id)
+                hermes.publish_end_session(intent_message.session_id, SENTENCE_HASS_UNAVAILABLE)
 
     def start_blocking(self):
         """
         Subscribe and start listening to the MQTT broker
         """
-        with Hermes(MQTT_ADDR) as h:
-            print("Start Blocking")
-            h.subscribe_intents(self.master_intent_callback).start()
+        from hermes_python.hermes import Hermes
+        intent_callback, session_ended = self.intent_callback, self.session_ended
+        if self.shard is not None:
+            intent_callback, session_ended = self.shard.filter(intent_callback), self.shard.filter(session_ended)
+        with Hermes(self.settings['mqtt_address']) as h:
+            logger.info("Start Blocking")
+            h.subscribe_intents(intent_callback).subscribe_session_ended(session_ended).start()
 
     def extract_house_rooms(self, intent_message):
         """
@@ -298,10 +828,10 @@ class HomeManager(object):
         :return: A list of rooms
         """
         house_rooms = []
-        if intent_message.slots.house_room:
-            for room in intent_message.slots.house_room.all():
-                type(room.value)
-                house_rooms.append(room.value)
+        with span('slots.house_room'):
+            if intent_message.slots.house_room:
+                for room in intent_message.slots.house_room.all():
+                    house_rooms.append(room.value)
         return house_rooms
 
     def extract_percentage(self, intent_message, default_percentage):
@@ -327,11 +857,25 @@ class HomeManager(object):
         :return: string, color name
         """
         color_code = None
-        if intent_message.slots.color:
-            color_code = intent_message.slots.color.first().value
+        with span('slots.color'):
+            if intent_message.slots.color:
+                color_code = intent_message.slots.color.first().value
         return color_code
 
 
+def run_worker(shard):
+    """
+    Run a HomeManager handling the intents of a share of the satellites, in a process started by the IntentSupervisor
+    :param shard: SiteShard
+    """
+    HomeManager(shard=shard)
+
+
 if __name__ == "__main__":
-    HomeManager()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    workers = HomeManager.read_settings(HomeManager.read_config())['intent_workers']
+    if workers > 1:
+        IntentSupervisor(run_worker, workers).run()
+    else:
+        HomeManager()
 
@@ -0,0 +1,105 @@
+import logging
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+# SnipsHomeManager methods that talk to Hass, these get a non blocking counterpart
+ASYNC_METHODS = (
+    'apply', 'apply_batch', 'send', 'send_batch', 'apply_scene',
+    'light_on', 'light_on_all', 'light_off', 'light_off_all',
+    'light_color', 'light_color_all', 'light_brightness', 'light_brightness_all',
+    'shift_light_up', 'shift_light_up_all', 'shift_light_down', 'shift_light_down_all',
+    'set_lights_all', 'tv_on', 'tv_off',
+)
+
+
+class AsyncSnipsHomeManager(object):
+    """
+    Non blocking counterpart of the SnipsHomeManager.
+    Every light and tv method returns straight away with an AsyncResult while the request to Hass runs on a
+    worker thread, so many service calls can be in flight at once over the shared keep-alive session.
+    Call .get() on the result (or use gather) to wait for the requests.Response.
+    The other attributes are those of the SnipsHomeManager, e.g. get_state still blocks.
+
+    Python 2 has no asyncio, so the concurrency comes from a thread pool sized to the Hass connection pool.
+    """
+    def __init__(self, steward, workers=None):
+        self.steward = steward  # SnipsHomeManager doing the actual requests
+        self._pool = ThreadPool(workers or steward.pool_size)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.steward, name)
+        if name not in ASYNC_METHODS:
+            return attribute
+
+        def submit(*args, **kwargs):
+            return self._pool.apply_async(attribute, args, kwargs)
+        return submit
+
+    @staticmethod
+    def gather(results, timeout=None):
+        """
+        Wait for several pending calls.
+        :param results: List of AsyncResult returned by this manager
+        :param timeout: Float, seconds to wait for each call, None waits forever
+        :return: List of the calls return values, in the same order
+        """
+        return [result.get(timeout) for result in results]
+
+    def close(self):
+        """
+        Wait for the pending calls to finish and stop the worker threads
+        :return: None
+        """
+        self._pool.close()
+        self._pool.join()
+
+
+class AsyncIntentCallback(object):
+    """
+    Adapter for HomeManager.master_intent_callback so that the Hermes callback thread is never blocked by Hass.
+    Each intent is handed to a worker thread and the callback returns immediately. Intents belonging to the same
+    dialogue session are still handled one at a time and in order: they wait in a queue per session, emptied by a
+    single worker at a time.
+    """
+    def __init__(self, callback, workers=4):
+        self.callback = callback  # E.g. HomeManager.master_intent_callback
+        self._pool = ThreadPool(workers)
+        self._guard = threading.Lock()
+        self._sessions = {}  # session_id -> deque of the (hermes, intent_message) not handled yet
+
+    def __call__(self, hermes, intent_message):
+        session_id = intent_message.session_id
+        with self._guard:
+            waiting = self._sessions.get(session_id)
+            if waiting is not None:
+                # A worker is handling the session, it takes this intent next
+                waiting.append((hermes, intent_message))
+                return
+            self._sessions[session_id] = deque([(hermes, intent_message)])
+        self._pool.apply_async(self._run, (session_id,))
+
+    def _run(self, session_id):
+        with self._guard:
+            waiting = self._sessions[session_id]
+        while True:
+            hermes, intent_message = waiting[0]
+            try:
+                self.callback(hermes, intent_message)
+            except Exception:
+                logger.exception("(AsyncIntentCallback) %s failed", intent_message.intent.intent_name)
+            with self._guard:
+                waiting.popleft()
+                if not waiting:
+                    del self._sessions[session_id]
+                    return
+
+    def close(self):
+        """
+        Wait for the queued intents to be handled and stop the worker threads
+        :return: None
+        """
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,193 @@
+import logging
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from entity_index import room_key
+from resilience import HassUnavailableError
+from scheduler import carry_priority
+from snips_home_manager import ALL_ENTITIES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = "default"
+DEFAULT_WORKERS = 8  # Calls sent to the Hass instances at once
+
+
+class HassBackends(object):
+    """
+    Registry of the Hass instances driven by the action, e.g. one per building. Each instance is a SnipsHomeManager
+    with its own connection pool, circuit breaker and state mirror, so one building going down does not slow down
+    the others. An entity is routed to its instance by, in order:
+    the longest entity prefix route matching it (e.g. "light.annex_"), the instance that reported it, a room route
+    matching the start of its object id (e.g. "garage" for "light.garage_light") and otherwise the default instance.
+    Calls spanning several instances are sent to them in parallel, calls for "all" go to every instance.
+    """
+    def __init__(self, default, workers=DEFAULT_WORKERS):
+        """
+        :param default: SnipsHomeManager of the instance the entities go to unless routed elsewhere
+        :param workers: Int, calls sent to the instances at once
+        """
+        self._backends = OrderedDict()  # name -> SnipsHomeManager
+        self._prefixes = []  # (entity prefix, name), longest prefix first
+        self._rooms = {}  # room key -> name
+        self._owners = {}  # entity_id -> name of the instance that reported it
+        self._lock = threading.Lock()
+        self._workers = ThreadPool(workers)
+        self.add(DEFAULT_BACKEND, default)
+
+    def add(self, name, steward):
+        """
+        :param name: String, name of the instance used by the routes
+        :param steward: SnipsHomeManager calling the instance
+        :return: None
+        """
+        self._backends[name] = steward
+        if steward.state_mirror is not None:
+            steward.state_mirror.add_listener(lambda entity_id, state: self._learn(name, entity_id, state))
+
+    def route(self, key, name):
+        """
+        Send the entities of a room, or starting with an entity prefix, to an instance
+        :param key: String, room name e.g. "garage", or entity prefix e.g. "light.annex_"
+        :param name: String, name of the instance
+        :return: None
+        """
+        if name not in self._backends:
+            raise ValueError("No Hass instance named {}".format(name))
+        if '.' in key:
+            self._prefixes.append((key, name))
+            self._prefixes.sort(key=lambda route: -len(route[0]))
+        else:
+            self._rooms[room_key(key)] = name
+
+    def get(self, name):
+        """
+        :param name: String, name of the instance
+        :return: SnipsHomeManager of the instance, None if there is none of that name
+        """
+        return self._backends.get(name)
+
+    def stewards(self):
+        """
+        :return: List of the SnipsHomeManager of every instance, the default one first
+        """
+        return list(self._backends.values())
+
+    def health(self):
+        """
+        :return: Dict, name of each instance -> state of its circuit breaker e.g. "closed" when healthy
+        """
+        return dict((name, steward.breaker.state) for name, steward in self._backends.items())
+
+    def backend(self, entity_id):
+        """
+        :param entity_id: String, e.g. "light.garage_light"
+        :return: SnipsHomeManager of the instance the entity belongs to
+        """
+        for prefix, name in self._prefixes:
+            if entity_id.startswith(prefix):
+                return self._backends[name]
+        name = self._owners.get(entity_id)
+        if name is None and self._rooms:
+            object_id = entity_id.split('.', 1)[-1]
+            for key, room_name in self._rooms.items():
+                if object_id == key or object_id.startswith(key + '_'):
+                    name = room_name
+                    break
+        return self._backends[name or DEFAULT_BACKEND]
+
+    def split(self, entity_ids):
+        """
+        :param entity_ids: String or list of entity ids, "all" targets every entity of every instance
+        :return: List of (SnipsHomeManager, entity ids for that instance)
+        """
+        if not isinstance(entity_ids, (list, tuple, set)):
+            if entity_ids == ALL_ENTITIES:
+                return [(steward, ALL_ENTITIES) for steward in self._backends.values()]
+            return [(self.backend(entity_ids), entity_ids)]
+        if ALL_ENTITIES in entity_ids:
+            return self.split(ALL_ENTITIES)
+        parts = OrderedDict()
+        for entity_id in entity_ids:
+            parts.setdefault(self.backend(entity_id), []).append(entity_id)
+        return list(parts.items())
+
+    def send(self, service, entity_ids, data):
+        """
+        Call a Hass service on every instance owning some of the entities, in parallel
+        :return: requests.Response, the one with the highest status when several instances were called, None when
+                 the call would change nothing
+        """
+        responses = self._fan_out(lambda part: part[0].send_local(service, part[1], data), self.split(entity_ids))
+        responses = [response for response in responses if response is not None]
+        if not responses:
+            return None
+        return max(responses, key=lambda response: response.status_code)
+
+    def apply_scene(self, entities):
+        """
+        Apply the part of a scene owned by each instance, in parallel
+        :param entities: Dict, entity_id -> target state
+        :return: requests.Response, the one with the highest status when several instances were called, None when
+                 the scene would change nothing
+        """
+        parts = OrderedDict()
+        for entity_id, target in entities.items():
+            parts.setdefault(self.backend(entity_id), {})[entity_id] = target
+        responses = self._fan_out(lambda part: part[0].apply_scene_local(part[1]), list(parts.items()))
+        responses = [response for response in responses if response is not None]
+        if not responses:
+            return None
+        return max(responses, key=lambda response: response.status_code)
+
+    def get_state(self, entity_id):
+        """
+        :return: State dict of the entity, from the instance owning it
+        """
+        return self.backend(entity_id).get_state_local(entity_id)
+
+    def get_states(self):
+        """
+        :return: List of the state dicts of every instance, read in parallel
+        """
+        backends = list(self._backends.items())
+        states = self._fan_out(lambda backend: backend[1].get_states_local(), backends)
+        merged = []
+        for (name, _), backend_states in zip(backends, states):
+            for state in backend_states:
+                self._learn(name, state['entity_id'], state)
+            merged.extend(backend_states)
+        return merged
+
+    def close(self):
+        self._workers.close()
+
+    def _learn(self, name, entity_id, state):
+        with self._lock:
+            if state is None:
+                if self._owners.get(entity_id) == name:
+                    del self._owners[entity_id]
+            else:
+                self._owners[entity_id] = name
+
+    def _fan_out(self, function, items):
+        """
+        Call function on every item, in parallel when there are several.
+        Every call is made even if Hass is unavailable for some of them, the first such error is raised after.
+        :return: List of the results, in the order of the items
+        """
+        if len(items) == 1:
+            return [function(items[0])]
+
+        def call(item):
+            try:
+                return function(item), None
+            except HassUnavailableError as e:
+                return None, e
+
+        results = self._workers.map(carry_priority(call), items)
+        for _, error in results:
+            if error is not None:
+                raise error
+        return [result for result, _ in results]
@@ -0,0 +1,243 @@
+"""
+End-to-end latency benchmark of the HomeManager intent handlers and the SnipsHomeManager methods, run against the
+FakeHass server so that performance regressions can be caught offline.
+
+    python benchmark.py --iterations 200 --latency 0.02 --jitter 0.01 --concurrency 4
+
+With --transport mqtt the service calls go through a FakeBroker to the FakeHass instead of its REST API, with
+--transport websocket they go over a connection to the WebSocket API of the FakeHass.
+
+With --background N, N threads keep sending whole house calls while the scenarios run, like automations firing at
+the same time, to check that the commands of the user are not slowed down by them.
+"""
+import argparse
+import itertools
+import logging
+import threading
+import timeit
+from multiprocessing.pool import ThreadPool
+
+from fake_hass import FakeHass
+from fake_mqtt import FakeBroker, FakeHassBridge
+from fake_hermes import FakeHermes, IntentMessage, load_action
+from metrics import metrics
+from snipsTools import SnipsConfigParser
+
+logger = logging.getLogger(__name__)
+
+ROOMS = ['kitchen', 'bedroom', 'bathroom', 'living room']
+
+
+def percentile(ordered, fraction):
+    """
+    :param ordered: Sorted list of numbers
+    :param fraction: Float between 0 and 1
+    :return: Value below which "fraction" of the numbers fall
+    """
+    if not ordered:
+        return 0.0
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class Result(object):
+    """
+    Latencies measured for one scenario
+    """
+    def __init__(self, name, latencies, errors, elapsed):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed  # Wall clock seconds for every iteration
+
+    @property
+    def throughput(self):
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def row(self):
+        return "{:<28} {:>6} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            self.name, len(self.latencies), self.errors,
+            percentile(self.latencies, 0.50) * 1000, percentile(self.latencies, 0.95) * 1000,
+            percentile(self.latencies, 0.99) * 1000, self.throughput)
+
+
+HEADER = "{:<28} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9}".format(
+    "scenario", "calls", "errors", "p50 ms", "p95 ms", "p99 ms", "calls/s")
+
+
+def run(name, scenario, iterations, concurrency):
+    """
+    Call a scenario "iterations" times from "concurrency" threads and time every call
+    :param scenario: Function(iteration)
+    :return: Result
+    """
+    def timed(iteration):
+        start = timeit.default_timer()
+        try:
+            scenario(iteration)
+            error = 0
+        except Exception as e:
+            logger.warning("%s failed: %s", name, e)
+            error = 1
+        return timeit.default_timer() - start, error
+
+    pool = ThreadPool(concurrency)
+    start = timeit.default_timer()
+    try:
+        measures = pool.map(timed, range(iterations))
+    finally:
+        pool.close()
+    elapsed = timeit.default_timer() - start
+    return Result(name, [latency for latency, _ in measures], sum(error for _, error in measures), elapsed)
+
+
+def steward_scenarios(steward):
+    """
+    :return: List of (name, Function(iteration)) calling the SnipsHomeManager methods
+    """
+    return [
+        ("steward.light_on", lambda i: steward.light_on('kitchen')),
+        ("steward.light_off", lambda i: steward.light_off('kitchen')),
+        ("steward.light_on_all", lambda i: steward.light_on_all()),
+        ("steward.light_off_all", lambda i: steward.light_off_all()),
+        ("steward.light_color", lambda i: steward.light_color('bedroom', 'red')),
+        ("steward.light_brightness", lambda i: steward.light_brightness('bedroom', i % 100)),
+        ("steward.shift_light_up", lambda i: steward.shift_light_up('bedroom', 5)),
+        ("steward.shift_light_down", lambda i: steward.shift_light_down('bedroom', 5)),
+        ("steward.shift_light_up_all", lambda i: steward.shift_light_up_all(5)),
+        ("steward.set_lights_all", lambda i: steward.set_lights_all('blue', 50)),
+        ("steward.tv_on", lambda i: steward.tv_on()),
+        ("steward.tv_off", lambda i: steward.tv_off()),
+    ]
+
+
+def handler_scenarios(home_manager, hermes):
+    """
+    :return: List of (name, Function(iteration)) feeding intents to HomeManager.master_intent_callback
+    """
+    sessions = itertools.count()
+
+    def intent(intent_name, **slots):
+        def scenario(i):
+            home_manager.master_intent_callback(hermes, IntentMessage(intent_name, 'bench-{}'.format(next(sessions)),
+                                                                      slots=slots))
+        return scenario
+
+    def conversation(intent_name):
+        def scenario(i):
+            session_id = 'bench-{}'.format(next(sessions))
+            site_id = 'site-{}'.format(session_id)
+            for name, slots in [(intent_name, {}), ('LLUWE19:giveAnswer', {'answer': ['yes']}),
+                                ('LLUWE19:setColor', {'color': ['red']}), ('setBrightness', {'percent': [60]}),
+                                ('LLUWE19:giveAnswer', {'answer': ['yes']})]:
+                home_manager.master_intent_callback(hermes, IntentMessage(name, session_id, site_id, slots))
+        return scenario
+
+    return [
+        ("intent.turnOn 1 room", intent('turnOn', house_room=ROOMS[:1])),
+        ("intent.turnOn 4 rooms", intent('turnOn', house_room=ROOMS)),
+        ("intent.turnOff all", intent('turnOff')),
+        ("intent.setColor 2 rooms", intent('LLUWE19:setColor', house_room=ROOMS[:2], color=['green'])),
+        ("intent.setBrightness 4 rooms", intent('setBrightness', house_room=ROOMS, percent=[40])),
+        ("intent.putTvOn", intent('LLUWE19:putTvOn')),
+        ("intent.putTvOff", intent('LLUWE19:putTvOff')),
+        ("conversation.arriveHome", conversation('LLUWE19:arriveHome')),
+        ("conversation.leaveHome", conversation('LLUWE19:leaveHome')),
+    ]
+
+
+def automations(steward, threads, stopped):
+    """
+    Send whole house calls from "threads" threads until "stopped" is set
+    :param stopped: threading.Event
+    :return: List of the threads, each counting its calls and errors in its "calls" and "errors" attributes
+    """
+    def automation():
+        thread = threading.current_thread()
+        colors = itertools.cycle(['blue', 'green'])
+        while not stopped.is_set():
+            try:
+                steward.set_lights_all(next(colors), 50)
+            except Exception:
+                thread.errors += 1
+            thread.calls += 1
+
+    workers = []
+    for number in range(threads):
+        worker = threading.Thread(target=automation, name="automation-{}".format(number))
+        worker.daemon = True
+        worker.calls = worker.errors = 0
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the action against a fake Home Assistant")
+    parser.add_argument('--iterations', type=int, default=100, help="calls per scenario")
+    parser.add_argument('--concurrency', type=int, default=1, help="threads calling each scenario at once")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each Hass response is delayed by")
+    parser.add_argument('--jitter', type=float, default=0.0, help="seconds the Hass delay varies by")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of Hass requests failing")
+    parser.add_argument('--hass-workers', type=int, default=0, help="requests Hass handles at once, 0 for no limit")
+    parser.add_argument('--config', default='config.ini.default', help="config file of the action to benchmark")
+    parser.add_argument('--transport', default='rest', choices=['rest', 'mqtt', 'websocket'], help="how Hass is called")
+    parser.add_argument('--mqtt-latency', type=float, default=0.0, help="seconds each MQTT message is delayed by")
+    parser.add_argument('--background', type=int, default=0, help="threads sending whole house calls meanwhile")
+    parser.add_argument('--profile', type=int, default=0, help="calls to sample, written to the profile_dir")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    fake = FakeHass(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                    workers=args.hass_workers)
+    api_address = fake.start()
+    config = SnipsConfigParser.read_configuration_file(args.config)
+    config.setdefault('global', {})['hass_api_address'] = api_address
+    config.setdefault('secret', {})['http_api_token'] = 'Bearer benchmark'
+    mqtt_client = bridge = connect_websocket = None
+    if args.transport == 'mqtt':
+        broker = FakeBroker(args.mqtt_latency)
+        bridge = FakeHassBridge(fake, broker)
+        bridge.start()
+        config['global']['hass_transport'] = 'mqtt'
+        mqtt_client = broker.client()
+        mqtt_client.connect()
+    elif args.transport == 'websocket':
+        config['global']['hass_transport'] = 'websocket'
+        connect_websocket = fake.connect_websocket
+
+    action = load_action()
+    home_manager = action.HomeManager(config=config, blocking=False, mqtt_client=mqtt_client,
+                                      connect_websocket=connect_websocket)
+    hermes = FakeHermes()
+    if args.profile:
+        home_manager.profiler.start(args.profile)
+
+    stopped = threading.Event()
+    background = automations(home_manager.steward, args.background, stopped)
+    results = []
+    for name, scenario in steward_scenarios(home_manager.steward) + handler_scenarios(home_manager, hermes):
+        results.append(run(name, scenario, args.iterations, args.concurrency))
+    stopped.set()
+    for worker in background:
+        worker.join()
+
+    print("")
+    print(HEADER)
+    for result in results:
+        print(result.row())
+    print("Hass requests: {}".format(len(fake.calls)))
+    if background:
+        print("Background calls: {}, shed or failed: {}".format(sum(worker.calls for worker in background),
+                                                               sum(worker.errors for worker in background)))
+    print("")
+    print("{:<36} {:>7} {:>9} {:>9} {:>9}".format("span", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for name, summary in sorted(metrics.snapshot().items()):
+        print("{:<36} {count:>7} {p50_ms:>9.1f} {p95_ms:>9.1f} {p99_ms:>9.1f}".format(name, **summary))
+    if bridge is not None:
+        bridge.stop()
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
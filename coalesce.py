@@ -0,0 +1,91 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 0.3  # Seconds a command waits for later commands to the same entity
+
+# Service data that replace each other, e.g. a new brightness_pct overrides a pending brightness
+EXCLUSIVE_DATA = (
+    ('brightness', 'brightness_pct'),
+    ('color_name', 'rgb_color', 'hs_color', 'xy_color', 'color_temp', 'kelvin'),
+)
+
+
+class CommandCoalescer(object):
+    """
+    Holds the commands for each entity for a short window and merges them into one final call, so a burst like
+    "brighter... brighter... set it to 40" costs a single request to Hass instead of queuing every step.
+    Commands are merged last write wins: a turn_off replaces whatever was pending, a turn_on after a turn_on keeps
+    the earlier service data unless the new command sets it again (e.g. a color then a brightness become one call).
+    When the window closes every pending command is sent at once through SnipsHomeManager.send_batch.
+    """
+    def __init__(self, steward, window=DEFAULT_WINDOW):
+        self.steward = steward  # SnipsHomeManager sending the merged commands
+        self.window = window
+        self._pending = {}  # entity_id -> (service, data)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One flush at a time keeps the order of commands per entity
+        self._timer = None
+
+    def submit(self, service, entity_ids, data):
+        """
+        Queue a service call, merging it with the commands already pending for the same entities
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param entity_ids: String or list of entity ids
+        :param data: Dict, service data
+        :return: None
+        """
+        if not isinstance(entity_ids, (list, tuple, set)):
+            entity_ids = [entity_ids]
+        with self._lock:
+            for entity_id in entity_ids:
+                self._pending[entity_id] = self._merge(self._pending.get(entity_id), service, data or {})
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def pending(self, entity_id):
+        """
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: (service, data) waiting to be sent for the entity, or None
+        """
+        with self._lock:
+            return self._pending.get(entity_id)
+
+    def flush(self):
+        """
+        Send every pending command now
+        :return: List of requests.Response
+        :raises HassUnavailableError: When Hass could not be called
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not pending:
+                return []
+            calls = [(service, entity_id, data) for entity_id, (service, data) in pending.items()]
+            return self.steward.send_batch(calls)
+
+    def _flush_later(self):
+        # Run by the timer, nobody is waiting to be told the calls failed
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning("(CommandCoalescer) Could not send the merged commands: %s", e)
+
+    @staticmethod
+    def _merge(previous, service, data):
+        if previous is None or not service.endswith('/turn_on') or previous[0] != service:
+            return service, dict(data)
+        merged = dict(previous[1])
+        for keys in EXCLUSIVE_DATA:
+            if any(key in data for key in keys):
+                for key in keys:
+                    merged.pop(key, None)
+        merged.update(data)
+        return service, merged
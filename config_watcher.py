@@ -0,0 +1,98 @@
+import io
+import logging
+import os
+import threading
+
+from snipsTools import SnipsConfigParser, CONFIGURATION_ENCODING_FORMAT
+
+try:
+    from ConfigParser import Error as ConfigError
+except ImportError:  # Python 3
+    from configparser import Error as ConfigError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5  # Seconds between two checks of the config file
+
+
+def load_config(path):
+    """
+    Parse a config file, unlike SnipsConfigParser.read_configuration_file a file that can not be read or parsed is
+    an error instead of an empty config
+    :param path: String, e.g. "config.ini"
+    :return: Dict of the config sections
+    :raises ValueError: When the file can not be read or parsed
+    """
+    try:
+        with io.open(path, encoding=CONFIGURATION_ENCODING_FORMAT) as f:
+            parser = SnipsConfigParser()
+            parser.readfp(f)
+            return parser.to_dict()
+    except (IOError, UnicodeError, ConfigError) as e:
+        raise ValueError("Could not read {}: {}".format(path, e))
+
+
+class ConfigWatcher(object):
+    """
+    Watches a config file from a background thread and hands the new config to "on_change" whenever the file
+    changed. Each check only compares the modification time and size of the file, the file is parsed once per change.
+    """
+    def __init__(self, path, on_change, interval=DEFAULT_INTERVAL, load=load_config):
+        """
+        :param path: String, config file to watch e.g. "config.ini"
+        :param on_change: Function(config), called with the dict of the config sections after each change
+        :param interval: Float, seconds between two checks
+        :param load: Function(path) -> dict of the config sections, raising a ValueError when the file is bad
+        """
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.load = load
+        self._signature = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def start(self):
+        """
+        Start checking the file every "interval" seconds
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._watch, name="config-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self):
+        """
+        Parse the file and call "on_change" if it changed since the last check. A file that can not be parsed is
+        reported and ignored until it changes again.
+        :return: Bool, True if the file changed
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        logger.info("(ConfigWatcher) %s changed", self.path)
+        try:
+            config = self.load(self.path)
+        except ValueError as e:
+            logger.error("(ConfigWatcher) Ignoring the changes: %s", e)
+            return True
+        self.on_change(config)
+        return True
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("(ConfigWatcher) Could not reload %s", self.path)
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from enum import Enum
+
+DEFAULT_IDLE_TIMEOUT = 120  # Seconds without an answer before a conversation is forgotten
+
+
+class ConversationStep(Enum):
+    """
+    Question the user has been asked last in an arrive/leave conversation
+    """
+    LIGHTS_ON = 1
+    LIGHT_COLOR = 2
+    LIGHT_BRIGHTNESS = 3
+    TV_ON = 4
+
+
+class Conversation(object):
+    """
+    The answers collected so far in one arrive/leave conversation
+    """
+    __slots__ = ('session_id', 'site_id', 'arriving', 'step', 'light_on', 'light_color', 'light_brightness',
+                 'tv_on', 'last_seen', 'snapshot', 'speculated', 'pending')
+
+    def __init__(self, session_id, site_id, arriving):
+        self.session_id = session_id
+        self.site_id = site_id  # Satellite the user is talking to
+        self.arriving = arriving  # True for "I'm home", False for "I'm leaving"
+        self.step = ConversationStep.LIGHTS_ON
+        self.light_on = False
+        self.light_color = None
+        self.light_brightness = None
+        self.tv_on = False
+        self.last_seen = time.time()
+        self.snapshot = None  # entity_id -> state of the lights when the conversation started, to undo with
+        self.speculated = False  # True once an answer was carried out before the end of the conversation
+        self.pending = []  # PendingCommand of the calls carried out ahead of the end of the conversation
+
+
+class ConversationStore(object):
+    """
+    Keeps one Conversation per dialogue session so that several satellites can hold a conversation at the same time.
+    A satellite only has one conversation at a time, starting a new one replaces the previous one. Conversations
+    that have not been answered for "idle_timeout" seconds are dropped, which bounds the memory used by dialogues
+    that were abandoned.
+    "on_abort" is told about every conversation dropped before it ended, replaced, expired or aborted.
+    """
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, on_abort=None):
+        self.idle_timeout = idle_timeout
+        self.on_abort = on_abort  # Function(conversation)
+        self._conversations = {}  # session_id -> Conversation
+        self._sites = {}  # site_id -> session_id of the conversation on that satellite
+        self._lock = threading.Lock()
+
+    def start(self, session_id, site_id, arriving):
+        """
+        Begin a conversation for a session
+        :param session_id: String, Hermes session id
+        :param site_id: String, Hermes site id of the satellite
+        :param arriving: Bool, True for an arrive conversation, False for a leave conversation
+        :return: Conversation
+        """
+        conversation = Conversation(session_id, site_id, arriving)
+        with self._lock:
+            dropped = self._expire()
+            previous = self._sites.get(site_id)
+            if previous is not None and previous in self._conversations:
+                dropped.append(self._conversations.pop(previous))
+            self._conversations[session_id] = conversation
+            self._sites[site_id] = session_id
+        self._aborted(dropped)
+        return conversation
+
+    def get(self, session_id):
+        """
+        :param session_id: String, Hermes session id
+        :return: The Conversation of the session, None if the session is not in a conversation
+        """
+        with self._lock:
+            dropped = self._expire()
+            conversation = self._conversations.get(session_id)
+            if conversation is not None:
+                conversation.last_seen = time.time()
+        self._aborted(dropped)
+        return conversation
+
+    def end(self, session_id):
+        """
+        Forget the conversation of a session
+        :param session_id: String, Hermes session id
+        :return: The Conversation that ended, or None
+        """
+        with self._lock:
+            conversation = self._conversations.pop(session_id, None)
+            if conversation is not None and self._sites.get(conversation.site_id) == session_id:
+                del self._sites[conversation.site_id]
+            return conversation
+
+    def abort(self, session_id):
+        """
+        Forget the conversation of a session that ended before the conversation did, e.g. the user stopped answering
+        :param session_id: String, Hermes session id
+        :return: The Conversation that was aborted, or None
+        """
+        conversation = self.end(session_id)
+        if conversation is not None:
+            self._aborted([conversation])
+        return conversation
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def _aborted(self, conversations):
+        if self.on_abort is not None:
+            for conversation in conversations:
+                self.on_abort(conversation)
+
+    def _expire(self):
+        """
+        :return: List of the conversations dropped
+        """
+        dropped = []
+        deadline = time.time() - self.idle_timeout
+        for session_id, conversation in list(self._conversations.items()):
+            if conversation.last_seen < deadline:
+                dropped.append(self._conversations.pop(session_id))
+                if self._sites.get(conversation.site_id) == session_id:
+                    del self._sites[conversation.site_id]
+        return dropped
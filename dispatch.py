@@ -0,0 +1,123 @@
+import logging
+import queue
+import threading
+
+from snips_home_manager import ALL_ENTITIES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 32
+
+
+class PendingCommand(object):
+    """
+    A call to Hass handed to the CommandDispatcher.
+    wait() blocks until the call has been carried out, then "result" or "error" is set.
+    """
+    __slots__ = ('entity_ids', 'action', 'args', 'kwargs', 'result', 'error', '_lanes_left', '_lock', '_done')
+
+    def __init__(self, entity_ids, action, args, kwargs, lanes):
+        self.entity_ids = entity_ids
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self._lanes_left = lanes  # Lanes still to reach this command before it can run
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: Float, seconds to wait, None waits forever
+        :return: Bool, True if the command has been carried out
+        """
+        return self._done.wait(timeout)
+
+
+class CommandDispatcher(object):
+    """
+    Runs calls to Hass on a bounded pool of worker threads so the intent handlers can answer the user straight away.
+    Each worker owns a lane with a bounded queue and every entity is always served by the same lane, so commands
+    for one entity are carried out in the order they were given. A command for several entities (or "all") waits
+    until each of their lanes has reached it, which keeps that order across every entity it touches.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, on_complete=None, on_error=None):
+        """
+        :param workers: Int, number of worker threads / lanes
+        :param queue_size: Int, commands each lane holds before submit blocks the caller
+        :param on_complete: Function(command), called after a command succeeded
+        :param on_error: Function(command), called after a command raised, the exception is in command.error
+        """
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self._lanes = [queue.Queue(queue_size) for _ in range(workers)]
+        self._submit_lock = threading.Lock()  # Keeps the order of commands identical in every lane
+        self._threads = []
+        for number, lane in enumerate(self._lanes):
+            thread = threading.Thread(target=self._work, args=(lane,), name="hass-dispatch-{}".format(number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, entity_ids, action, *args, **kwargs):
+        """
+        Queue a call to Hass, blocking only while the lanes involved are full.
+        :param entity_ids: String or list of the entity ids the call changes, "all" for every entity
+        :param action: Function making the call e.g. SnipsHomeManager.apply
+        :return: PendingCommand
+        """
+        lanes = self._lanes_for(entity_ids)
+        command = PendingCommand(entity_ids, action, args, kwargs, len(lanes))
+        with self._submit_lock:
+            for lane in lanes:
+                lane.put(command)
+        return command
+
+    def close(self):
+        """
+        Finish the queued commands and stop the workers
+        :return: None
+        """
+        with self._submit_lock:
+            for lane in self._lanes:
+                lane.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _lanes_for(self, entity_ids):
+        if entity_ids == ALL_ENTITIES:
+            return self._lanes
+        if not isinstance(entity_ids, (list, tuple, set)):
+            entity_ids = [entity_ids]
+        numbers = sorted(set(hash(entity_id) % len(self._lanes) for entity_id in entity_ids))
+        return [self._lanes[number] for number in numbers] or [self._lanes[0]]
+
+    def _work(self, lane):
+        while True:
+            command = lane.get()
+            if command is None:
+                break
+            with command._lock:
+                command._lanes_left -= 1
+                last = command._lanes_left == 0
+            if last:
+                self._run(command)
+            else:
+                # Hold this lane until the command has run
+                command.wait()
+
+    def _run(self, command):
+        try:
+            command.result = command.action(*command.args, **command.kwargs)
+        except Exception as e:
+            command.error = e
+        finally:
+            command._done.set()
+        callback = self.on_error if command.error is not None else self.on_complete
+        if callback is not None:
+            try:
+                callback(command)
+            except Exception:
+                logger.exception("(CommandDispatcher) callback failed")
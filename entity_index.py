@@ -0,0 +1,120 @@
+import threading
+import time
+
+DEFAULT_REFRESH_INTERVAL = 60  # Seconds before an unknown room triggers a new discovery
+
+
+def room_key(name):
+    """
+    :param name: String, room as spoken e.g. "Living Room"
+    :return: String, room as written in entity ids e.g. "living_room"
+    """
+    return name.strip().lower().replace(' ', '_')
+
+
+class EntityIndex(object):
+    """
+    Maps the rooms of the house to the Hass entities found in them, so that the entity ids no longer have to be
+    guessed from the room name. An entity belongs to every room its object id (or friendly name) starts with,
+    word by word: "light.living_room_lamp" is found for "living", "living room" and "living room lamp", and a room
+    with two lamps gives both of them. Aliases map other names onto a room e.g. "lounge" -> "living room".
+    The index is built from every state once and then kept current entity by entity, e.g. by listening to the
+    HassStateMirror. Without a listener an unknown room triggers a new discovery at most every "refresh_interval".
+    """
+    def __init__(self, load_states, aliases=None, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        :param load_states: Function returning the list of every Hass state, e.g. SnipsHomeManager.get_states
+        :param aliases: Dict, alias -> room name
+        :param refresh_interval: Float, seconds between discoveries triggered by unknown rooms
+        """
+        self.load_states = load_states
+        self.aliases = {}  # room key of the alias -> room key
+        self.set_aliases(aliases)
+        self.refresh_interval = refresh_interval
+        self._rooms = {}  # room key -> {domain: set of entity ids}
+        self._entity_rooms = {}  # entity_id -> room keys it is indexed under
+        self._lock = threading.Lock()
+        self._refreshed = 0
+
+    def set_aliases(self, aliases):
+        """
+        :param aliases: Dict, alias -> room name
+        :return: None
+        """
+        self.aliases = dict((room_key(alias), room_key(room)) for alias, room in (aliases or {}).items())
+
+    def refresh(self):
+        """
+        Rebuild the whole index from every state in a single request
+        :return: None
+        """
+        states = self.load_states()
+        with self._lock:
+            self._rooms = {}
+            self._entity_rooms = {}
+            for state in states:
+                self._add(state)
+            self._refreshed = time.time()
+
+    def update(self, entity_id, state):
+        """
+        Index a new or changed entity, or drop a removed one
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :param state: State dict as returned by Hass, None when the entity was removed
+        :return: None
+        """
+        with self._lock:
+            self._remove(entity_id)
+            if state is not None:
+                self._add(state)
+
+    def entities(self, room, domain):
+        """
+        :param room: String, room as spoken e.g. "living room"
+        :param domain: String, e.g. "light"
+        :return: Sorted list of the entity ids of that domain in the room, empty if there are none
+        """
+        key = room_key(room)
+        key = self.aliases.get(key, key)
+        with self._lock:
+            found = self._rooms.get(key, {}).get(domain)
+            stale = time.time() - self._refreshed > self.refresh_interval
+        if found is None and stale:
+            self.refresh()
+            with self._lock:
+                found = self._rooms.get(key, {}).get(domain)
+        return sorted(found or [])
+
+    def lights(self, room):
+        """
+        :param room: String, room as spoken
+        :return: List of the light entity ids in the room
+        """
+        return self.entities(room, 'light')
+
+    def _add(self, state):
+        entity_id = state['entity_id']
+        domain, object_id = entity_id.split('.', 1)
+        names = [object_id]
+        friendly_name = state.get('attributes', {}).get('friendly_name')
+        if friendly_name:
+            names.append(room_key(friendly_name))
+        keys = set()
+        for name in names:
+            words = name.split('_')
+            for end in range(1, len(words) + 1):
+                keys.add('_'.join(words[:end]))
+        for key in keys:
+            self._rooms.setdefault(key, {}).setdefault(domain, set()).add(entity_id)
+        self._entity_rooms[entity_id] = keys
+
+    def _remove(self, entity_id):
+        domain = entity_id.split('.', 1)[0]
+        for key in self._entity_rooms.pop(entity_id, ()):
+            entities = self._rooms.get(key, {}).get(domain)
+            if entities is not None:
+                entities.discard(entity_id)
+                if not entities:
+                    del self._rooms[key][domain]
+                if not self._rooms[key]:
+                    del self._rooms[key]
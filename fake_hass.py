@@ -0,0 +1,450 @@
+"""
+Stand-in for the Home Assistant REST API, used to exercise the action and measure its latency offline.
+Implements the parts of the API the action uses: "/api/", "/api/states", "/api/states/<entity_id>", the
+"/api/stream" event stream and "/api/services/<domain>/<service>" for the light, switch and scene domains.
+connect_websocket() opens an in-process connection to the same states through the messages of the WebSocket API.
+Every response can be delayed (latency +/- jitter), a share of them can fail with a 500 and the requests handled at
+once can be limited, like a Hass running on a small board.
+
+    python fake_hass.py --port 8123 --latency 0.05 --jitter 0.02 --failure-rate 0.01 --workers 2
+"""
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+
+import queue
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_STATES = [
+    {"entity_id": "light.kitchen_light", "state": "off", "attributes": {"friendly_name": "Kitchen Light"}},
+    {"entity_id": "light.bedroom_light", "state": "off", "attributes": {"friendly_name": "Bedroom Light"}},
+    {"entity_id": "light.bathroom_light", "state": "off", "attributes": {"friendly_name": "Bathroom Light"}},
+    {"entity_id": "light.living_room_light", "state": "off", "attributes": {"friendly_name": "Living Room Light"}},
+    {"entity_id": "switch.living_room_tv", "state": "off", "attributes": {"friendly_name": "Living Room TV"}},
+]
+
+STREAM_PING_INTERVAL = 50
+WEBSOCKET_TICK = 0.1  # Seconds recv() waits for a message before returning None
+
+
+class FakeHass(object):
+    """
+    In-process fake Home Assistant server.
+    start() returns the api address to give to the SnipsHomeManager, "calls" records every request received.
+    """
+    def __init__(self, states=None, token=None, latency=0.0, jitter=0.0, failure_rate=0.0, workers=0,
+                 host='127.0.0.1', port=0):
+        """
+        :param states: List of state dicts, DEFAULT_STATES when None
+        :param token: String, expected Authorization header, None accepts any
+        :param latency: Float, seconds every response is delayed by
+        :param jitter: Float, seconds the delay varies by, up or down
+        :param failure_rate: Float between 0 and 1, share of requests answered with a 500
+        :param workers: Int, requests handled at once, the others wait their turn. 0 for no limit
+        """
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.workers = threading.Semaphore(workers) if workers > 0 else None
+        self.calls = []  # (method, path, body) of every request
+        self._states = {}
+        self._lock = threading.Lock()
+        self._streams = []  # Queues of the connected event streams
+        self._websockets = []  # FakeWebSocket connected
+        self._server = _Server((host, port), _Handler)
+        self._server.hass = self
+        self._thread = None
+        for state in states if states is not None else DEFAULT_STATES:
+            self._states[state['entity_id']] = _copy(state)
+
+    @property
+    def api_address(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/api/'.format(host, port)
+
+    def start(self):
+        """
+        Serve in a background thread
+        :return: String, api address e.g. "http://127.0.0.1:8123/api/"
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-hass")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.api_address
+
+    def stop(self):
+        """
+        Stop serving and disconnect the event streams
+        :return: None
+        """
+        with self._lock:
+            for stream in self._streams:
+                stream.put(None)
+        self.drop_websockets()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def connect_websocket(self, url=None, timeout=None):
+        """
+        Open a connection to the WebSocket API, can be given as "connect" to the WebSocketTransport
+        :return: FakeWebSocket
+        """
+        websocket = FakeWebSocket(self)
+        with self._lock:
+            self._websockets.append(websocket)
+        return websocket
+
+    def drop_websockets(self):
+        """
+        Close every WebSocket from the server side, as when Hass restarts
+        :return: None
+        """
+        with self._lock:
+            websockets, self._websockets = self._websockets, []
+        for websocket in websockets:
+            websocket.close()
+
+    def record(self, method, path, body):
+        """
+        Add a request to "calls"
+        :return: None
+        """
+        with self._lock:
+            self.calls.append((method, path, body))
+
+    def reset(self):
+        """
+        Forget the recorded calls
+        :return: None
+        """
+        with self._lock:
+            del self.calls[:]
+
+    def states(self):
+        """
+        :return: List of the current state dicts
+        """
+        with self._lock:
+            return [_copy(state) for state in self._states.values()]
+
+    def state(self, entity_id):
+        """
+        :return: The current state dict of an entity, None if unknown
+        """
+        with self._lock:
+            state = self._states.get(entity_id)
+            return _copy(state) if state is not None else None
+
+    def set_state(self, entity_id, state, attributes=None):
+        """
+        Change an entity as if it had been changed from outside the action, firing a state_changed event
+        :return: The new state dict
+        """
+        with self._lock:
+            return self._set_state(entity_id, state, attributes or {})
+
+    def delay(self):
+        """
+        Wait for the configured latency and jitter
+        :return: None
+        """
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self):
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+    def call_service(self, domain, service, data):
+        """
+        Carry out a service call on the fake states
+        :return: List of the state dicts that changed
+        """
+        with self._lock:
+            if domain == 'scene' and service == 'apply':
+                changed = []
+                for entity_id, target in data.get('entities', {}).items():
+                    target = dict(target) if isinstance(target, dict) else {"state": target}
+                    changed.append(self._set_state(entity_id, target.pop('state'), target))
+                return changed
+            entity_ids = data.get('entity_id', [])
+            if entity_ids == 'all':
+                entity_ids = [entity_id for entity_id in self._states if entity_id.startswith(domain + '.')]
+            elif not isinstance(entity_ids, list):
+                entity_ids = [entity_ids]
+            attributes = dict((key, value) for key, value in data.items() if key != 'entity_id')
+            changed = []
+            for entity_id in entity_ids:
+                current = self._states.get(entity_id, {}).get('state', 'off')
+                if service == 'toggle':
+                    new_state = 'off' if current == 'on' else 'on'
+                else:
+                    new_state = 'on' if service == 'turn_on' else 'off'
+                changed.append(self._set_state(entity_id, new_state, attributes))
+            return changed
+
+    def open_stream(self):
+        stream = queue.Queue()
+        with self._lock:
+            self._streams.append(stream)
+        return stream
+
+    def close_stream(self, stream):
+        with self._lock:
+            if stream in self._streams:
+                self._streams.remove(stream)
+
+    def _set_state(self, entity_id, state, attributes):
+        old_state = self._states.get(entity_id)
+        new_attributes = dict(old_state['attributes']) if old_state else {}
+        if 'brightness_pct' in attributes:
+            attributes = dict(attributes)
+            attributes['brightness'] = int(round(attributes.pop('brightness_pct') * 255 / 100.0))
+        new_attributes.update(attributes)
+        if state == 'off':
+            new_attributes.pop('brightness', None)
+        elif entity_id.startswith('light.') and 'brightness' not in new_attributes:
+            new_attributes['brightness'] = 255
+        new_state = {"entity_id": entity_id, "state": state, "attributes": new_attributes}
+        self._states[entity_id] = new_state
+        if new_state == old_state:
+            # Like Hass, no event when nothing changed
+            return _copy(new_state)
+        event = {
+            "event_type": "state_changed",
+            "data": {"entity_id": entity_id, "old_state": _copy(old_state), "new_state": _copy(new_state)},
+        }
+        for stream in self._streams:
+            stream.put(event)
+        return _copy(new_state)
+
+
+class FakeWebSocket(object):
+    """
+    In-process connection to the WebSocket API of a FakeHass: auth, call_service, get_states, subscribe_events and
+    ping. Each message is handled on its own after the latency of the FakeHass, so messages sent at once are
+    answered about one latency later. recv() returns None when nothing arrived within WEBSOCKET_TICK seconds and
+    raises an IOError once the connection is closed.
+    """
+    _CLOSED = object()
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.authenticated = False
+        self.closed = False
+        self._inbox = queue.Queue()
+        self._streams = []
+        self._inbox.put(json.dumps({"type": "auth_required", "ha_version": "fake"}))
+        thread = threading.Thread(target=self._tick, name="fake-websocket")
+        thread.daemon = True
+        thread.start()
+
+    def send(self, text):
+        if self.closed:
+            raise IOError("WebSocket closed")
+        message = json.loads(text)
+        if not self.authenticated:
+            self._authenticate(message)
+            return
+        thread = threading.Thread(target=self._answer, args=(message,), name="fake-websocket-message")
+        thread.daemon = True
+        thread.start()
+
+    def recv(self):
+        item = self._inbox.get()
+        if item is self._CLOSED:
+            # Seen by every later call as well
+            self._inbox.put(item)
+            raise IOError("WebSocket closed")
+        return item
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for stream in self._streams:
+            self.hass.close_stream(stream)
+            stream.put(None)
+        self._inbox.put(self._CLOSED)
+
+    def _tick(self):
+        while not self.closed:
+            time.sleep(WEBSOCKET_TICK)
+            self._inbox.put(None)
+
+    def _reply(self, message):
+        if not self.closed:
+            self._inbox.put(json.dumps(message))
+
+    def _authenticate(self, message):
+        token = self.hass.token
+        refused = token is not None and 'Bearer ' + message.get('access_token', '') != token
+        if message.get('type') != 'auth' or refused:
+            self._reply({"type": "auth_invalid", "message": "Invalid access token or password"})
+            return
+        self.authenticated = True
+        self._reply({"type": "auth_ok", "ha_version": "fake"})
+
+    def _answer(self, message):
+        hass = self.hass
+        if hass.workers is not None:
+            with hass.workers:
+                hass.delay()
+        else:
+            hass.delay()
+        kind = message.get('type')
+        hass.record('WS', kind, message)
+        result = {"id": message.get('id'), "type": "result", "success": True, "result": None}
+        if kind == 'ping':
+            result = {"id": message.get('id'), "type": "pong"}
+        elif hass.should_fail():
+            result.update(success=False, error={"code": "home_assistant_error", "message": "Injected failure"})
+        elif kind == 'call_service':
+            hass.call_service(message['domain'], message['service'], message.get('service_data', {}))
+        elif kind == 'get_states':
+            result['result'] = hass.states()
+        elif kind == 'subscribe_events' and message.get('event_type') == 'state_changed':
+            self._subscribe(message['id'])
+        else:
+            result.update(success=False, error={"code": "unknown_command", "message": "Unknown command."})
+        self._reply(result)
+
+    def _subscribe(self, subscription):
+        stream = self.hass.open_stream()
+        self._streams.append(stream)
+
+        def forward():
+            while True:
+                event = stream.get()
+                if event is None:
+                    break
+                self._reply({"id": subscription, "type": "event", "event": event})
+        thread = threading.Thread(target=forward, name="fake-websocket-events")
+        thread.daemon = True
+        thread.start()
+
+
+def _copy(state):
+    return json.loads(json.dumps(state)) if state is not None else None
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like Hass
+    wbufsize = -1  # Send the headers and the body together, flushed after each request
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        hass = self.server.hass
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        body = json.loads(raw.decode('utf-8')) if raw else {}
+        path = self.path.split('?', 1)[0]
+        hass.record(method, self.path, body)
+
+        if hass.token is not None and self.headers.get('Authorization') != hass.token:
+            return self._send(401, {"message": "401: Unauthorized"})
+        if hass.workers is None or path == '/api/stream':
+            return self._respond(hass, method, path, body)
+        with hass.workers:
+            return self._respond(hass, method, path, body)
+
+    def _respond(self, hass, method, path, body):
+        hass.delay()
+        if hass.should_fail():
+            return self._send(500, {"message": "500: Injected failure"})
+
+        if method == 'GET' and path == '/api/':
+            return self._send(200, {"message": "API running."})
+        if method == 'GET' and path == '/api/states':
+            return self._send(200, hass.states())
+        if method == 'GET' and path.startswith('/api/states/'):
+            state = hass.state(path[len('/api/states/'):])
+            if state is None:
+                return self._send(404, {"message": "Entity not found."})
+            return self._send(200, state)
+        if method == 'GET' and path == '/api/stream':
+            return self._stream(hass)
+        if method == 'POST' and path.startswith('/api/services/'):
+            parts = path[len('/api/services/'):].split('/')
+            if len(parts) == 2 and parts[0] in ('light', 'switch', 'scene'):
+                return self._send(200, hass.call_service(parts[0], parts[1], body))
+        self._send(404, {"message": "Not found"})
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, hass):
+        stream = hass.open_stream()
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')  # Like Hass, one chunk per event
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            self._write_event('ping')
+            while True:
+                try:
+                    event = stream.get(timeout=STREAM_PING_INTERVAL)
+                except queue.Empty:
+                    self._write_event('ping')
+                    continue
+                if event is None:
+                    break
+                self._write_event(json.dumps(event))
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            hass.close_stream(stream)
+
+    def _write_event(self, payload):
+        data = 'data: {}\n\n'.format(payload).encode('utf-8')
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Home Assistant REST API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each response is delayed by")
+    parser.add_argument('--jitter', type=float, default=0.0, help="seconds the delay varies by")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of requests failing with a 500")
+    parser.add_argument('--workers', type=int, default=0, help="requests handled at once, 0 for no limit")
+    args = parser.parse_args()
+    fake = FakeHass(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, workers=args.workers,
+                    host=args.host, port=args.port)
+    print("Fake Hass listening on " + fake.api_address)
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
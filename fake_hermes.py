@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import time
+
+ACTION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'action-context.py')
+
+
+def load_action(path=ACTION_FILE):
+    """
+    Import the action script, whose file name is not a valid module name
+    :param path: String, path of "action-context.py"
+    :return: The action module, with the HomeManager class
+    """
+    try:
+        import importlib.util
+    except ImportError:  # Python 2
+        import imp
+        return imp.load_source('action_context', path)
+    spec = importlib.util.spec_from_file_location('action_context', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['action_context'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class SlotValue(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class SlotsList(list):
+    """
+    Values of one slot, like the hermes-python SlotsList: empty (falsy) when the slot was not filled
+    """
+    def first(self):
+        return self[0] if self else None
+
+    def all(self):
+        return list(self)
+
+
+class Slots(object):
+    """
+    Slots of an intent message: any slot name can be read, slots that were not filled are empty
+    """
+    def __init__(self, values):
+        self._values = dict((name, SlotsList(SlotValue(value) for value in slot_values))
+                            for name, slot_values in values.items())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._values.get(name, SlotsList())
+
+    def items(self):
+        return list(self._values.items())
+
+
+class Intent(object):
+    def __init__(self, intent_name, confidence_score=1.0):
+        self.intent_name = intent_name
+        self.confidence_score = confidence_score
+
+
+class IntentMessage(object):
+    """
+    Stand-in for the hermes-python IntentMessage, with the attributes used by the HomeManager
+    """
+    def __init__(self, intent_name, session_id, site_id='default', slots=None, input=None, custom_data=None):
+        """
+        :param intent_name: String, e.g. "turnOn"
+        :param session_id: String, dialogue session the intent belongs to
+        :param site_id: String, satellite the intent was spoken to
+        :param slots: Dict, slot name -> list of values e.g. {"house_room": ["kitchen"]}
+        """
+        self.intent = Intent(intent_name)
+        self.session_id = session_id
+        self.site_id = site_id
+        self.slots = Slots(slots or {})
+        self.slot_values = dict(slots or {})
+        self.input = input
+        self.custom_data = custom_data
+
+
+class FakeHermes(object):
+    """
+    Stand-in for the Hermes connection handed to the intent callbacks. Records what the action says instead of
+    publishing it to MQTT, and can wait for a session to be answered.
+    """
+    def __init__(self):
+        self.published = []  # (kind, session_id, text, intent_filter)
+        self._answered = threading.Condition()
+
+    def publish_end_session(self, session_id, text):
+        self._publish(('end', session_id, text, None))
+        return self
+
+    def publish_continue_session(self, session_id, text, intent_filter, custom_data=None, send_intent_not_recognized=False):
+        self._publish(('continue', session_id, text, intent_filter))
+        return self
+
+    def wait_for(self, session_id, count=1, timeout=None):
+        """
+        Wait until a session has been answered "count" times
+        :return: Bool, False on timeout
+        """
+        with self._answered:
+            return _wait(self._answered, lambda: self.answers(session_id) >= count, timeout)
+
+    def answers(self, session_id):
+        """
+        :return: Int, number of times a session has been answered
+        """
+        return len([message for message in self.published if message[1] == session_id])
+
+    def _publish(self, message):
+        with self._answered:
+            self.published.append(message)
+            self._answered.notify_all()
+
+
+def _wait(condition, predicate, timeout):
+    # Condition.wait_for does not exist on Python 2
+    if timeout is None:
+        while not predicate():
+            condition.wait()
+        return True
+    deadline = time.time() + timeout
+    while not predicate():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        condition.wait(remaining)
+    return True
@@ -0,0 +1,290 @@
+"""
+Stand-in for an MQTT broker and the MQTT side of Home Assistant, used to exercise the MQTT transport offline.
+FakeBroker routes messages between in-process clients offering the parts of the paho.mqtt.client.Client API used by
+the action (connect, subscribe, publish, message_callback_add, on_connect, on_disconnect). Every message can be
+delayed and the broker can drop every connection, like a restart.
+FakeHassBridge plays Hass against a FakeHass: it carries out the service calls published under the command topic and
+publishes every state change on the statestream topics, like the mqtt_statestream integration.
+"""
+import json
+import threading
+import time
+import timeit
+
+import queue
+
+from transport import DEFAULT_COMMAND_TOPIC, DEFAULT_STATE_TOPIC
+
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+
+
+def topic_matches(subscription, topic):
+    """
+    :param subscription: String, topic filter with the "+" and "#" wildcards
+    :param topic: String, topic of a message
+    :return: Bool, True if the message is for the subscription
+    """
+    wanted = subscription.split('/')
+    parts = topic.split('/')
+    for index, level in enumerate(wanted):
+        if level == '#':
+            return True
+        if index >= len(parts) or (level != '+' and level != parts[index]):
+            return False
+    return len(wanted) == len(parts)
+
+
+class FakeMessage(object):
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class FakeMessageInfo(object):
+    """
+    Returned by publish, like paho's MQTTMessageInfo
+    """
+    def __init__(self, rc):
+        self.rc = rc
+        self._published = threading.Event()
+
+    def is_published(self):
+        return self._published.is_set()
+
+    def wait_for_publish(self, timeout=None):
+        self._published.wait(timeout)
+
+
+class FakeBroker(object):
+    """
+    In-process MQTT broker. Messages are delivered in order from a single thread, "latency" seconds after they were
+    published, and a qos 1 message counts as published once the broker has it (after "latency" seconds as well).
+    """
+    def __init__(self, latency=0.0):
+        """
+        :param latency: Float, seconds a message takes from a client to the broker, and from the broker to a client
+        """
+        self.latency = latency
+        self.messages = []  # (topic, payload) of every message published
+        self._clients = []
+        self._retained = {}  # topic -> FakeMessage
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._deliver, name="fake-broker")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def client(self, client_id=''):
+        """
+        :return: FakeMqttClient, not connected yet
+        """
+        return FakeMqttClient(self, client_id)
+
+    def disconnect_all(self):
+        """
+        Drop every connection, as when the broker restarts
+        :return: None
+        """
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            client._lost()
+
+    def _connect(self, client):
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+
+    def _disconnect(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def _subscribed(self, client, subscription):
+        with self._lock:
+            retained = [message for topic, message in self._retained.items() if topic_matches(subscription, topic)]
+        for message in retained:
+            self._queue.put((timeit.default_timer() + self.latency, client, message, None))
+
+    def _publish(self, message, info):
+        with self._lock:
+            self.messages.append((message.topic, message.payload))
+            if message.retain:
+                self._retained[message.topic] = message
+        self._queue.put((timeit.default_timer() + self.latency, None, message, info))
+
+    def _deliver(self):
+        while True:
+            due, client, message, info = self._queue.get()
+            delay = due - timeit.default_timer()
+            if delay > 0:
+                time.sleep(delay)
+            if info is not None:
+                info._published.set()
+            with self._lock:
+                clients = [client] if client is not None else list(self._clients)
+            for receiver in clients:
+                receiver._receive(message)
+
+
+class FakeMqttClient(object):
+    """
+    Client of the FakeBroker with the API of paho.mqtt.client.Client
+    """
+    def __init__(self, broker, client_id=''):
+        self.broker = broker
+        self.client_id = client_id
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self._connected = False
+        self._subscriptions = []
+        self._callbacks = []  # (subscription, callback)
+        self._lock = threading.Lock()
+
+    def connect(self, host=None, port=None, keepalive=60):
+        self.broker._connect(self)
+        self._connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return MQTT_ERR_SUCCESS
+
+    connect_async = connect
+    reconnect = connect
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.broker._disconnect(self)
+        self._lost(0)
+        return MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self._connected
+
+    def subscribe(self, topic, qos=0):
+        with self._lock:
+            if topic not in self._subscriptions:
+                self._subscriptions.append(topic)
+        self.broker._subscribed(self, topic)
+        return MQTT_ERR_SUCCESS, 1
+
+    def message_callback_add(self, subscription, callback):
+        with self._lock:
+            self._callbacks.append((subscription, callback))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self._connected:
+            return FakeMessageInfo(MQTT_ERR_NO_CONN)
+        if isinstance(payload, type(u'')):
+            payload = payload.encode('utf-8')
+        info = FakeMessageInfo(MQTT_ERR_SUCCESS)
+        if qos == 0:
+            info._published.set()
+        self.broker._publish(FakeMessage(topic, payload, qos, retain), info if qos > 0 else None)
+        return info
+
+    def _lost(self, rc=1):
+        if not self._connected:
+            return
+        self._connected = False
+        with self._lock:
+            self._subscriptions = []
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, rc)
+
+    def _receive(self, message):
+        with self._lock:
+            if not any(topic_matches(subscription, message.topic) for subscription in self._subscriptions):
+                return
+            callbacks = [callback for subscription, callback in self._callbacks
+                         if topic_matches(subscription, message.topic)]
+        if not callbacks and self.on_message is not None:
+            callbacks = [self.on_message]
+        for callback in callbacks:
+            callback(self, None, message)
+
+
+class FakeHassBridge(object):
+    """
+    The MQTT side of a FakeHass: an automation carrying out the service calls published on
+    "<command_topic>/<domain>/<service>" and the mqtt_statestream integration publishing each state on
+    "<state_topic>/<domain>/<object_id>/state" and each attribute on "<state_topic>/<domain>/<object_id>/<attribute>".
+    Service calls are delayed by the latency of the FakeHass, like its REST API.
+    """
+    def __init__(self, hass, broker, state_topic=DEFAULT_STATE_TOPIC, command_topic=DEFAULT_COMMAND_TOPIC):
+        self.hass = hass
+        self.state_topic = state_topic
+        self.command_topic = command_topic
+        self.client = broker.client('home-assistant')
+        self.client.message_callback_add(command_topic + '/+/+', self._on_command)
+        self.client.on_connect = self._on_connect
+        self._commands = queue.Queue()
+        self._stream = None
+
+    def start(self):
+        """
+        Connect to the broker and publish the states as they change
+        :return: None
+        """
+        self.client.connect()
+        self._stream = self.hass.open_stream()
+        for target in (self._follow, self._carry_out):
+            thread = threading.Thread(target=target, name="fake-hass-bridge")
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.hass.close_stream(self._stream)
+        self._stream.put(None)
+        self._commands.put(None)
+        self.client.disconnect()
+
+    def publish_states(self):
+        """
+        Publish every current state, as the statestream does for the entities changing after Hass started
+        :return: None
+        """
+        for state in self.hass.states():
+            self._publish_state(state)
+
+    def _publish_state(self, state):
+        domain, object_id = state['entity_id'].split('.', 1)
+        base = '/'.join((self.state_topic, domain, object_id))
+        self.client.publish(base + '/state', state['state'])
+        for attribute, value in state.get('attributes', {}).items():
+            self.client.publish(base + '/' + attribute, json.dumps(value))
+
+    def _on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.command_topic + '/#', 1)
+
+    def _on_command(self, client, userdata, message):
+        self._commands.put(message)
+
+    def _carry_out(self):
+        while True:
+            message = self._commands.get()
+            if message is None:
+                break
+            domain, service = message.topic[len(self.command_topic) + 1:].split('/')
+            self.hass.delay()
+            self.hass.record('MQTT', message.topic, message.payload)
+            self.hass.call_service(domain, service, json.loads(message.payload.decode('utf-8') or '{}'))
+
+    def _follow(self):
+        while True:
+            event = self._stream.get()
+            if event is None:
+                break
+            new_state = event['data'].get('new_state')
+            if new_state is not None:
+                self._publish_state(new_state)
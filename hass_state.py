@@ -0,0 +1,229 @@
+import json
+import logging
+import threading
+import time
+
+import requests as rq
+
+from resilience import HassUnavailableError
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 30  # Seconds a state is trusted for while the event stream is down
+STREAM_READ_TIMEOUT = 90  # Hass pings the event stream every 50 seconds
+STREAM_RETRY_DELAY = 5
+
+
+class HassStateMirror(object):
+    """
+    In-process copy of the Hass entity states, so that status queries and relative changes (e.g. "brighter")
+    can be answered from memory instead of a GET per command.
+    The mirror loads every state from "/api/states" once, then stays current by listening to the Hass
+    "state_changed" event stream, or to the transport of the steward when it follows the states itself (MQTT or
+    WebSocket).
+    While the stream is connected every state is trusted. When the stream is down a state older than "ttl" seconds
+    is fetched again from Hass.
+    """
+    def __init__(self, steward, ttl=DEFAULT_TTL):
+        self.steward = steward  # SnipsHomeManager, used for the fallback requests
+        self.ttl = ttl
+        self._states = {}  # entity_id -> state dict as returned by Hass
+        self._updated = {}  # entity_id -> time the state was last confirmed
+        self._lock = threading.Lock()
+        self._streaming = False  # True while the event stream is connected
+        self._listener = None  # Thread following the event stream, None when stopped
+        self._callbacks = []  # Functions(entity_id, state) told about every change
+
+    def add_listener(self, callback):
+        """
+        Be told about every state change, e.g. to keep an index of the entities current
+        :param callback: Function(entity_id, state), state is None when the entity was removed
+        :return: None
+        """
+        self._callbacks.append(callback)
+
+    def start(self):
+        """
+        Load every state and start following the event stream in a background thread.
+        If Hass can not be reached the states are loaded once the event stream connects.
+        :return: Bool, True if the states were loaded
+        """
+        try:
+            self.load()
+            loaded = True
+        except HassUnavailableError as e:
+            logger.warning("(HassStateMirror) Could not load the states: %s", e)
+            loaded = False
+        if self.steward.transport.follow(self):
+            # The transport keeps the mirror current
+            self._listener = None
+            return loaded
+        listener = threading.Thread(target=self._listen, args=(not loaded,), name="hass-state-stream")
+        listener.daemon = True
+        self._listener = listener
+        listener.start()
+        return loaded
+
+    def stop(self):
+        """
+        Stop following the event stream, the states already loaded are kept
+        :return: None
+        """
+        self._listener = None
+        self._streaming = False
+        self.steward.transport.follow(None)
+
+    def restart(self):
+        """
+        Reload every state and follow the event stream again, e.g. after the Hass address changed
+        :return: Bool, True if the states were loaded
+        """
+        self.stop()
+        return self.start()
+
+    def set_streaming(self, streaming):
+        """
+        Called by a transport following the states, e.g. when its connection was lost
+        :param streaming: Bool, True while every change is being received
+        :return: None
+        """
+        self._streaming = streaming
+
+    def load(self):
+        """
+        Replace the mirror with a fresh copy of every state in a single request
+        :return: List of state dicts
+        """
+        states = self.steward.fetch_states()
+        now = time.time()
+        with self._lock:
+            removed = set(self._states) - set(state['entity_id'] for state in states)
+            self._states = dict((state['entity_id'], state) for state in states)
+            self._updated = dict((entity_id, now) for entity_id in self._states)
+        for entity_id in removed:
+            self._notify(entity_id, None)
+        for state in states:
+            self._notify(state['entity_id'], state)
+        return states
+
+    def get(self, entity_id):
+        """
+        Get the state of an entity, from memory if it is still trusted or from Hass otherwise.
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: State dict as returned by Hass
+        """
+        with self._lock:
+            state = self._states.get(entity_id)
+            fresh = state is not None and self._is_fresh(entity_id)
+        if fresh:
+            return state
+        state = self.steward.fetch_state(entity_id)
+        self.update(state)
+        return state
+
+    def all(self):
+        """
+        Get every state, reloading them in one request if the mirror can not be trusted
+        :return: List of state dicts
+        """
+        with self._lock:
+            fresh = self._streaming or all(self._is_fresh(entity_id) for entity_id in self._updated)
+            if fresh and self._states:
+                return list(self._states.values())
+        return self.load()
+
+    def known(self, entity_id):
+        """
+        State of an entity as long as it can be trusted, without asking Hass
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: State dict as returned by Hass, None when not known or possibly out of date
+        """
+        with self._lock:
+            if entity_id in self._states and self._is_fresh(entity_id):
+                return self._states[entity_id]
+        return None
+
+    def known_states(self):
+        """
+        Every state, as long as they can all be trusted, without asking Hass
+        :return: List of state dicts, None when some may be out of date
+        """
+        with self._lock:
+            if self._streaming and self._states:
+                return list(self._states.values())
+        return None
+
+    def update(self, state):
+        """
+        Store the latest state of an entity
+        :param state: State dict as returned by Hass
+        :return: None
+        """
+        with self._lock:
+            self._states[state['entity_id']] = state
+            self._updated[state['entity_id']] = time.time()
+        self._notify(state['entity_id'], state)
+
+    def remove(self, entity_id):
+        """
+        Forget an entity removed from Hass
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: None
+        """
+        with self._lock:
+            self._states.pop(entity_id, None)
+            self._updated.pop(entity_id, None)
+        self._notify(entity_id, None)
+
+    def _notify(self, entity_id, state):
+        for callback in self._callbacks:
+            callback(entity_id, state)
+
+    def _is_fresh(self, entity_id):
+        return self._streaming or time.time() - self._updated.get(entity_id, 0) < self.ttl
+
+    def _listen(self, reconnecting=False):
+        """
+        :param reconnecting: Bool, load the states once connected, False when start() just loaded them
+        """
+        listener = threading.current_thread()
+        session = rq.Session()
+        while self._listener is listener:
+            # Read on every connection so that a new token is picked up
+            session.headers.update(self.steward.header)
+            try:
+                response = session.get(self.steward.api_address + 'stream', params={'restrict': 'state_changed'},
+                                       stream=True, timeout=(STREAM_RETRY_DELAY, STREAM_READ_TIMEOUT))
+                response.raise_for_status()
+                if reconnecting:
+                    # Events may have been missed while disconnected
+                    self.load()
+                reconnecting = True
+                self._streaming = True
+                # Hass sends each event as a chunk of a chunked response, chunk_size=None hands over every chunk as
+                # soon as it arrives instead of waiting for 512 bytes, without reading byte by byte
+                for line in response.iter_lines(chunk_size=None):
+                    if self._listener is not listener:
+                        break
+                    self._handle_line(line)
+            except (rq.RequestException, HassUnavailableError, ValueError) as e:
+                logger.warning("(HassStateMirror) Event stream lost: %s", e)
+            if self._listener is listener:
+                self._streaming = False
+                time.sleep(STREAM_RETRY_DELAY)
+        session.close()
+
+    def _handle_line(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.startswith('data: '):
+            return
+        payload = line[len('data: '):]
+        if payload == 'ping':
+            return
+        event = json.loads(payload)
+        data = event.get('data', {})
+        new_state = data.get('new_state')
+        if new_state is not None:
+            self.update(new_state)
+        elif data.get('entity_id'):
+            self.remove(data['entity_id'])
@@ -0,0 +1,63 @@
+class IntentRouter(object):
+    """
+    Table of intent handlers used by the HomeManager in command mode.
+    Each intent name maps to one handler, so finding the handler is a single dict lookup however many intents are
+    registered. Handlers are registered with the "handler" decorator, either on HomeManager methods or on plain
+    functions from another module, which lets new device intents be plugged in without touching the HomeManager:
+
+        @intent_handler("LLUWE19:putFanOn", rooms=True)
+        def turn_fan_on(home_manager, hermes, intent_message, rooms):
+            ...
+
+    The rooms of the intent message are only extracted for handlers registered with rooms=True.
+    """
+    def __init__(self):
+        self._handlers = {}  # intent_name -> (handler, wants rooms)
+
+    def register(self, intent_name, handler, rooms=False):
+        """
+        Register the handler of an intent, replacing any previous handler for it
+        :param intent_name: String, name of the intent e.g. "turnOn"
+        :param handler: Function(home_manager, hermes, intent_message[, rooms])
+        :param rooms: Bool, pass the rooms extracted from the intent message to the handler
+        :return: The handler
+        """
+        self._handlers[intent_name] = (handler, rooms)
+        return handler
+
+    def handler(self, intent_name, rooms=False):
+        """
+        Decorator form of register
+        """
+        def decorator(function):
+            return self.register(intent_name, function, rooms)
+        return decorator
+
+    def intents(self):
+        """
+        :return: List of the intent names with a handler
+        """
+        return list(self._handlers)
+
+    def dispatch(self, home_manager, hermes, intent_message):
+        """
+        Call the handler registered for the intent of the message
+        :param home_manager: HomeManager, passed to the handler as its first argument
+        :param hermes: Hermes connection
+        :param intent_message: The intent message received from Hermes
+        :return: Bool, False if no handler is registered for the intent
+        """
+        entry = self._handlers.get(intent_message.intent.intent_name)
+        if entry is None:
+            return False
+        handler, rooms = entry
+        if rooms:
+            handler(home_manager, hermes, intent_message, home_manager.extract_house_rooms(intent_message))
+        else:
+            handler(home_manager, hermes, intent_message)
+        return True
+
+
+# Router of the HomeManager command mode
+command_router = IntentRouter()
+intent_handler = command_router.handler
@@ -0,0 +1,189 @@
+import bisect
+import json
+import logging
+import threading
+import timeit
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class LatencyHistogram(object):
+    """
+    Counts of durations per bucket, cheap enough to be updated on every call
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last count is for durations above every bucket
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """
+        :param seconds: Float, a measured duration
+        :return: None
+        """
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.maximum:
+                self.maximum = seconds
+
+    def percentile(self, fraction):
+        """
+        :param fraction: Float between 0 and 1
+        :return: Float, upper bound of the bucket holding that percentile, in seconds
+        """
+        with self._lock:
+            rank = fraction * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    return self.buckets[index] if index < len(self.buckets) else self.maximum
+        return 0.0
+
+    def summary(self):
+        """
+        :return: Dict with the count, mean, p50/p95/p99 and max, in milliseconds
+        """
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean_ms": round(mean * 1000, 3),
+            "p50_ms": self.percentile(0.50) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": round(self.maximum * 1000, 3),
+        }
+
+
+class Metrics(object):
+    """
+    Latency histograms per named span, e.g. "hass.light/turn_on" or "hermes.publish_end_session".
+    The histograms can be dumped to a JSON file or scraped in the Prometheus text format from serve().
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        """
+        :param name: String, span name
+        :return: LatencyHistogram of the span, created on first use
+        """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, LatencyHistogram())
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time the enclosed block into the histogram of "name"
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe(timeit.default_timer() - start)
+
+    def snapshot(self):
+        """
+        :return: Dict, span name -> histogram summary
+        """
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return dict((name, histogram.summary()) for name, histogram in histograms)
+
+    def dump(self, path):
+        """
+        Write the summary of every span to a JSON file
+        :param path: String, file to write
+        :return: None
+        """
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def prometheus(self):
+        """
+        :return: String, every histogram in the Prometheus text exposition format
+        """
+        lines = ["# TYPE home_manager_latency_seconds histogram"]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for name, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('home_manager_latency_seconds_bucket{{span="{}",le="{}"}} {}'.format(name, bound, cumulative))
+            lines.append('home_manager_latency_seconds_sum{{span="{}"}} {}'.format(name, histogram.total))
+            lines.append('home_manager_latency_seconds_count{{span="{}"}} {}'.format(name, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve the histograms on http://host:port/metrics (Prometheus) and /metrics.json from a background thread
+        :return: The HTTPServer
+        """
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body, content_type = json.dumps(registry.snapshot()), 'application/json'
+                else:
+                    body, content_type = registry.prometheus(), 'text/plain; version=0.0.4'
+                data = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving latency metrics on http://%s:%s/metrics", host, port)
+        return server
+
+
+class TimedHermes(object):
+    """
+    Wraps the Hermes connection so that every publish_* call is timed
+    """
+    def __init__(self, hermes, registry):
+        self._hermes = hermes
+        self._registry = registry
+
+    def __getattr__(self, name):
+        attribute = getattr(self._hermes, name)
+        if not name.startswith('publish_'):
+            return attribute
+        registry = self._registry
+
+        def timed(*args, **kwargs):
+            with registry.span('hermes.' + name):
+                return attribute(*args, **kwargs)
+        return timed
+
+
+# Metrics of the action
+metrics = Metrics()
+span = metrics.span
@@ -0,0 +1,226 @@
+import inspect
+import itertools
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+import timeit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIRECTORY = 'profiles'
+DEFAULT_INTERVAL = 0.002  # Seconds between two samples of the stacks
+
+
+class SamplingProfiler(object):
+    """
+    Finds where slow intents spend their time without stopping the action. Off until start(calls), then the stacks
+    of the threads running the intent callback or a method of the watched SnipsHomeManager are sampled every
+    "interval" seconds, until "calls" such calls have returned (calls made inside another one are not counted).
+    The samples are then written to "directory" as:
+        profile-<time>-<pid>-<n>.pstats, for "python -m pstats" or snakeviz, sample counts standing for call counts
+        profile-<time>-<pid>-<n>.folded, one "frame;frame;frame count" line per stack for flamegraph.pl or speedscope
+    While off the methods are not wrapped and no thread samples, the intent callback only checks "armed".
+    """
+    def __init__(self, directory=DEFAULT_DIRECTORY, interval=DEFAULT_INTERVAL):
+        """
+        :param directory: String, where the profiles are written
+        :param interval: Float, seconds between two samples
+        """
+        self.directory = directory
+        self.interval = interval
+        self.armed = False
+        self._remaining = 0
+        self._targets = []  # Objects whose methods are wrapped while armed
+        self._active = {}  # Thread id -> depth of profiled calls running in it
+        self._samples = {}  # Stack -> [samples, seconds], the stack being a tuple of (file, line, function)
+        self._lock = threading.Lock()
+        self._sampling = threading.Event()  # Set while profiled calls run, wakes the sampling thread
+        self._thread = None
+        self._written = itertools.count(1)
+
+    def watch(self, target):
+        """
+        Profile the public methods of an object while armed, e.g. a SnipsHomeManager
+        :return: None
+        """
+        self._targets.append(target)
+
+    def start(self, calls):
+        """
+        Profile the next calls, starting over if already profiling
+        :param calls: Int, calls to profile
+        :return: None
+        """
+        with self._lock:
+            self._remaining = calls
+            self._samples = {}
+            if self.armed:
+                return
+            self.armed = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="profiler")
+                self._thread.daemon = True
+                self._thread.start()
+        for target in self._targets:
+            self._wrap(target)
+        logger.info("(SamplingProfiler) Profiling the next %s calls", calls)
+
+    def stop(self):
+        """
+        Stop profiling and write what was sampled
+        :return: Tuple of the paths written, empty if nothing was sampled
+        """
+        with self._lock:
+            if not self.armed:
+                return ()
+            self.armed = False
+            samples, self._samples = self._samples, {}
+        for target in self._targets:
+            self._unwrap(target)
+        if not samples:
+            logger.info("(SamplingProfiler) Stopped, nothing was sampled")
+            return ()
+        return self.write(samples)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call function with its stack sampled
+        :return: The result of function
+        """
+        ident = threading.current_thread().ident
+        with self._lock:
+            depth = self._active.get(ident, 0)
+            self._active[ident] = depth + 1
+            self._sampling.set()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with self._lock:
+                if depth:
+                    self._active[ident] = depth
+                else:
+                    del self._active[ident]
+                    if not self._active:
+                        self._sampling.clear()
+                    if self.armed:
+                        self._remaining -= 1
+                done = self.armed and self._remaining <= 0 and not depth
+            if done:
+                self.stop()
+
+    def listen(self, client, topic):
+        """
+        Start profiling when a number of calls is published on an MQTT topic, "0" stops and writes the profile
+        :param client: paho.mqtt.client.Client
+        :param topic: String, e.g. "homemanager/profile"
+        :return: None
+        """
+        previous = client.on_connect
+
+        def on_connect(client, userdata, flags, rc):
+            if previous is not None:
+                previous(client, userdata, flags, rc)
+            client.subscribe(topic)
+
+        client.on_connect = on_connect
+        client.message_callback_add(topic, self._on_message)
+        if client.is_connected():
+            client.subscribe(topic)
+
+    def write(self, samples):
+        """
+        :param samples: Dict, stack -> [samples, seconds]
+        :return: Tuple of the paths of the pstats and folded files
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, 'profile-{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                                                                      next(self._written)))
+        with open(base + '.pstats', 'wb') as f:
+            marshal.dump(pstats_of(samples), f)
+        with open(base + '.folded', 'w') as f:
+            for stack, (count, _) in sorted(samples.items()):
+                f.write(';'.join('{} ({}:{})'.format(name, os.path.basename(path), line)
+                                 for path, line, name in stack))
+                f.write(' {}\n'.format(count))
+        logger.info("(SamplingProfiler) %s samples written to %s.pstats and .folded",
+                    sum(count for count, _ in samples.values()), base)
+        return base + '.pstats', base + '.folded'
+
+    def _wrap(self, target):
+        for name, method in vars(target.__class__).items():
+            if name.startswith('_') or not inspect.isfunction(method):
+                continue
+            setattr(target, name, self._profiled(getattr(target, name)))
+
+    def _unwrap(self, target):
+        for name, method in vars(target.__class__).items():
+            if name in vars(target) and inspect.isfunction(method):
+                delattr(target, name)
+
+    def _profiled(self, method):
+        def profiled(*args, **kwargs):
+            return self.run(method, *args, **kwargs)
+        return profiled
+
+    def _on_message(self, client, userdata, message):
+        try:
+            calls = int(message.payload)
+        except ValueError:
+            logger.warning("(SamplingProfiler) Not a number of calls on %s: %s", message.topic, message.payload)
+            return
+        if calls > 0:
+            self.start(calls)
+        else:
+            self.stop()
+
+    def _sample(self):
+        while True:
+            self._sampling.wait()
+            before = timeit.default_timer()
+            time.sleep(self.interval)
+            elapsed = timeit.default_timer() - before
+            frames = sys._current_frames()
+            with self._lock:
+                if not self.armed:
+                    continue
+                for ident in self._active:
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        # Leave out the wrappers of the profiler
+                        if frame.f_globals.get('__name__') != __name__:
+                            code = frame.f_code
+                            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    stack = tuple(reversed(stack))
+                    sample = self._samples.setdefault(stack, [0, 0.0])
+                    sample[0] += 1
+                    sample[1] += elapsed
+
+
+def pstats_of(samples):
+    """
+    Turn sampled stacks into the statistics cProfile writes, so that pstats can sort and print them
+    :param samples: Dict, stack -> [samples, seconds]
+    :return: Dict, (file, line, function) -> (samples, samples, own seconds, cumulated seconds, callers)
+    """
+    stats = {}
+    for stack, (count, seconds) in samples.items():
+        for function in set(stack):
+            calls, _, own, cumulated, callers = stats.get(function, (0, 0, 0.0, 0.0, {}))
+            if function == stack[-1]:
+                own += seconds
+            stats[function] = (calls + count, calls + count, own, cumulated + seconds, callers)
+        for caller, callee in set(zip(stack, stack[1:])):
+            callers = stats[callee][4]
+            calls, _, own, cumulated = callers.get(caller, (0, 0, 0.0, 0.0))
+            if callee == stack[-1]:
+                own += seconds
+            callers[caller] = (calls + count, calls + count, own, cumulated + seconds)
+    return stats
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+from snips_home_manager import ALL_ENTITIES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIRM_TIMEOUT = 5  # Seconds an entity we changed is not trusted for, unless Hass reports its new state
+
+
+class StateReconciler(object):
+    """
+    Compares the state asked for with the state of each entity known to the HassStateMirror, so that only the
+    entities the call would change are sent to Hass, e.g. "lights off" when every light is already off costs nothing.
+    Only states the mirror trusts are compared, anything else is sent. An entity we just sent a call for is not
+    trusted again until Hass reports its new state (or "confirm_timeout" passes), so that a command quickly
+    following another is never dropped because of an out of date state.
+    Service data that can not be checked against the state, e.g. a color name, is always sent.
+    """
+    def __init__(self, state_mirror, confirm_timeout=DEFAULT_CONFIRM_TIMEOUT):
+        """
+        :param state_mirror: HassStateMirror holding the known states
+        :param confirm_timeout: Float, seconds an entity we changed is not trusted for
+        """
+        self.state_mirror = state_mirror
+        self.confirm_timeout = confirm_timeout
+        self._unconfirmed = {}  # entity_id -> (time, action, data) of the last call sent to change it
+        self._lock = threading.Lock()
+        state_mirror.add_listener(self._confirmed)
+
+    def changing(self, service, entity_ids, data):
+        """
+        Find the entities a call would change, they are not trusted again until Hass reports their new state
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param entity_ids: String or list of entity ids, "all" targets every entity of the domain
+        :param data: Dict, service data
+        :return: The entity ids the call would change, "all" when it changes every entity or they are not known,
+                 empty when the call changes nothing
+        """
+        domain, action = service.split('/', 1)
+        if entity_ids == ALL_ENTITIES or (isinstance(entity_ids, (list, tuple, set)) and ALL_ENTITIES in entity_ids):
+            states = self.state_mirror.known_states()
+            if states is None:
+                return ALL_ENTITIES
+            entity_ids = [state['entity_id'] for state in states if state['entity_id'].startswith(domain + '.')]
+            changing = [entity_id for entity_id in entity_ids if self._changes(entity_id, action, data)]
+            self._sent(changing, action, data)
+            return ALL_ENTITIES if len(changing) == len(entity_ids) else changing
+        if not isinstance(entity_ids, (list, tuple, set)):
+            changing = [entity_ids] if self._changes(entity_ids, action, data) else []
+            self._sent(changing, action, data)
+            return entity_ids if changing else []
+        changing = [entity_id for entity_id in entity_ids if self._changes(entity_id, action, data)]
+        self._sent(changing, action, data)
+        return changing
+
+    def changing_scene(self, entities):
+        """
+        Find the part of a scene that would change something, its entities are not trusted again until Hass reports
+        their new state
+        :param entities: Dict, entity_id -> target state e.g. {"light.kitchen_light": {"state": "on"}}
+        :return: Dict, the part of the scene that changes something
+        """
+        changing = {}
+        for entity_id, target in entities.items():
+            data = dict(target)
+            action = 'turn_{}'.format(data.pop('state', 'on'))
+            if self._changes(entity_id, action, data):
+                changing[entity_id] = target
+                self._sent([entity_id], action, data)
+        return changing
+
+    def _sent(self, entity_ids, action, data):
+        now = time.time()
+        with self._lock:
+            for entity_id in entity_ids:
+                self._unconfirmed[entity_id] = (now, action, data)
+
+    def _confirmed(self, entity_id, state):
+        with self._lock:
+            sent = self._unconfirmed.get(entity_id)
+            # A state reported for an earlier call does not confirm the last one
+            if sent is not None and (state is None or not self._differs(state, sent[1], sent[2])):
+                del self._unconfirmed[entity_id]
+
+    def _changes(self, entity_id, action, data):
+        with self._lock:
+            sent = self._unconfirmed.get(entity_id)
+            if sent is not None:
+                if time.time() - sent[0] < self.confirm_timeout:
+                    return True
+                del self._unconfirmed[entity_id]
+        state = self.state_mirror.known(entity_id)
+        return state is None or self._differs(state, action, data)
+
+    @staticmethod
+    def _differs(state, action, data):
+        """
+        :param state: State dict as returned by Hass
+        :param action: String, service without its domain e.g. "turn_on"
+        :param data: Dict, service data
+        :return: Bool, True unless the entity is known to already be as the call would leave it
+        """
+        if action == 'turn_off':
+            return state.get('state') != 'off'
+        if action != 'turn_on' or state.get('state') != 'on':
+            return True
+        brightness = state.get('attributes', {}).get('brightness')
+        for key, value in data.items():
+            if key == 'brightness_pct':
+                if brightness is None or int(round(brightness * 100.0 / 255)) != value:
+                    return True
+            elif key == 'brightness':
+                if brightness != value:
+                    return True
+            else:
+                return True
+        return False
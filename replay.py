@@ -0,0 +1,196 @@
+"""
+Record the intents received by the action and replay them into HomeManager.master_intent_callback, at their
+recorded pace or faster, without an MQTT broker. Gives reproducible throughput and concurrency runs of the command
+and conversation paths.
+
+Record by setting "record_intents" in the [global] section of config.ini, then e.g.
+
+    python replay.py intents.jsonl --speed 10 --concurrency 4 --latency 0.02
+"""
+import argparse
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+import timeit
+
+from async_home_manager import AsyncIntentCallback
+from benchmark import percentile
+from fake_hass import FakeHass
+from fake_hermes import FakeHermes, IntentMessage, load_action
+from snipsTools import SnipsConfigParser
+
+# Slots read when the intent message can not list its own slots
+KNOWN_SLOTS = ('house_room', 'color', 'percent', 'answer')
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return io.open(path, mode + 'b')
+
+
+def slot_values(intent_message):
+    """
+    :param intent_message: Intent message received from Hermes
+    :return: Dict, slot name -> list of the slot values
+    """
+    slots = intent_message.slots
+    try:
+        names = [name for name, _ in slots.items()]
+    except AttributeError:
+        names = KNOWN_SLOTS
+    values = {}
+    for name in names:
+        slot = getattr(slots, name)
+        if slot:
+            values[name] = [value.value for value in slot.all()]
+    return values
+
+
+class IntentRecorder(object):
+    """
+    Wraps an intent callback and appends every intent it receives to a file, one compact JSON line per intent:
+    seconds since the recording started, intent name, session id, site id and slot values. Files ending with ".gz"
+    are compressed.
+    """
+    def __init__(self, callback, path):
+        self.callback = callback
+        self.path = path
+        self._file = _open(path, 'a')
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def __call__(self, hermes, intent_message):
+        record = {
+            "t": round(time.time() - self._start, 3),
+            "i": intent_message.intent.intent_name,
+            "s": intent_message.session_id,
+            "site": intent_message.site_id,
+            "sl": slot_values(intent_message),
+        }
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line.encode('utf-8'))
+            self._file.flush()
+        return self.callback(hermes, intent_message)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_recording(path):
+    """
+    :param path: String, file written by an IntentRecorder
+    :return: List of (offset in seconds, IntentMessage)
+    """
+    messages = []
+    with _open(path, 'r') as f:
+        for line in f:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            messages.append((record["t"], IntentMessage(record["i"], record["s"], record.get("site", 'default'),
+                                                        record.get("sl"))))
+    return messages
+
+
+class Replayer(object):
+    """
+    Feeds recorded intents to an intent callback through a FakeHermes.
+    With "speed" 1 the intents are sent at the pace they were recorded, 10 sends them ten times faster and 0 as
+    fast as possible. With "concurrency" above 1 the intents of different sessions are handled in parallel, the
+    intents of one session always in order.
+    """
+    def __init__(self, callback, hermes=None, speed=1.0, concurrency=1):
+        self.hermes = hermes or FakeHermes()
+        self.speed = speed
+        self.concurrency = concurrency
+        self.callback = callback
+        self.latencies = []  # Seconds each intent took to handle, from the moment it was due
+        self._lock = threading.Lock()
+
+    def replay(self, messages):
+        """
+        :param messages: List of (offset in seconds, IntentMessage)
+        :return: Float, seconds taken to replay and handle every intent
+        """
+        callback = self._timed
+        dispatcher = None
+        if self.concurrency > 1:
+            dispatcher = AsyncIntentCallback(self._timed_message, self.concurrency)
+            callback = dispatcher
+        start = timeit.default_timer()
+        for offset, intent_message in messages:
+            due = start + (offset / self.speed if self.speed > 0 else 0)
+            wait = due - timeit.default_timer()
+            if wait > 0:
+                time.sleep(wait)
+            if dispatcher is None:
+                self._timed(self.hermes, intent_message)
+            else:
+                intent_message.due = due
+                callback(self.hermes, intent_message)
+        if dispatcher is not None:
+            dispatcher.close()
+        return timeit.default_timer() - start
+
+    def _timed(self, hermes, intent_message):
+        intent_message.due = timeit.default_timer()
+        self._timed_message(hermes, intent_message)
+
+    def _timed_message(self, hermes, intent_message):
+        try:
+            self.callback(hermes, intent_message)
+        finally:
+            with self._lock:
+                self.latencies.append(timeit.default_timer() - intent_message.due)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded intents into the HomeManager")
+    parser.add_argument('recording', help="file written with record_intents")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed, 0 for as fast as possible")
+    parser.add_argument('--concurrency', type=int, default=1, help="sessions handled at once")
+    parser.add_argument('--repeat', type=int, default=1, help="times the recording is replayed")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each fake Hass response is delayed by")
+    parser.add_argument('--jitter', type=float, default=0.0, help="seconds the fake Hass delay varies by")
+    parser.add_argument('--config', default='config.ini.default', help="config file of the action")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    fake = FakeHass(latency=args.latency, jitter=args.jitter)
+    config = SnipsConfigParser.read_configuration_file(args.config)
+    config.setdefault('global', {})['hass_api_address'] = fake.start()
+    config['global'].pop('record_intents', None)
+    config.setdefault('secret', {})['http_api_token'] = 'Bearer replay'
+    home_manager = load_action().HomeManager(config=config, blocking=False)
+
+    recording = read_recording(args.recording)
+    messages = []
+    for run in range(args.repeat):
+        # Each run gets its own sessions so the conversations do not collide
+        shift = run * (recording[-1][0] if recording else 0)
+        for offset, message in recording:
+            messages.append((offset + shift, IntentMessage(message.intent.intent_name,
+                                                           '{}-{}'.format(message.session_id, run),
+                                                           message.site_id, message.slot_values)))
+
+    replayer = Replayer(home_manager.master_intent_callback, speed=args.speed, concurrency=args.concurrency)
+    elapsed = replayer.replay(messages)
+    latencies = sorted(replayer.latencies)
+    print("")
+    print("intents: {}  elapsed: {:.2f}s  throughput: {:.1f}/s".format(
+        len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0.0))
+    print("latency ms  p50: {:.1f}  p95: {:.1f}  p99: {:.1f}".format(
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.95) * 1000, percentile(latencies, 0.99) * 1000))
+    print("Hass requests: {}".format(len(fake.calls)))
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 3.0  # Seconds a call to Hass may take, retries included
+DEFAULT_RETRIES = 2
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+
+class HassUnavailableError(Exception):
+    """
+    Raised when Hass could not be reached in time, or is not tried because it has been failing
+    """
+
+
+class HassOverloadedError(HassUnavailableError):
+    """
+    Raised when a request is shed by the HassScheduler instead of being sent, Hass itself may be fine
+    """
+
+
+class RetryPolicy(object):
+    """
+    Bounded retries with jittered exponential backoff ("full jitter"), so retries from several callers do not
+    reach a recovering Hass all at once.
+    """
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=0.1, max_backoff=1.0):
+        """
+        :param retries: Int, attempts made after the first one
+        :param backoff: Float, seconds the first retry waits for at most
+        :param max_backoff: Float, longest wait between two attempts
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        """
+        :param attempt: Int, number of attempts made so far
+        :return: Float, seconds to wait before the next attempt
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling Hass after "failure_threshold" calls failed in a row, so that intents fail straight away instead
+    of each waiting for a timeout. After "reset_timeout" seconds a single trial call is let through: if it succeeds
+    calls go through again, if it fails the breaker stays open for another "reset_timeout".
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: Bool, False if the call should fail straight away
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self._opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Hass is available again")
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Hass is unavailable, failing fast for %ss", self.reset_timeout)
+                self.state = self.OPEN
+                self._opened = time.time()
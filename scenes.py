@@ -0,0 +1,152 @@
+import logging
+import threading
+
+from snips_home_manager import ALL_ENTITIES, TV_ENTITY
+
+logger = logging.getLogger(__name__)
+
+# Light attribute putting a light back in its color, per color mode reported by Hass
+COLOR_MODE_ATTRIBUTES = {'color_temp': 'color_temp', 'hs': 'hs_color', 'rgb': 'rgb_color', 'xy': 'xy_color'}
+
+
+class HomeScenes(object):
+    """
+    Compiles the outcome of an arrive/leave conversation (lights on? color? brightness? tv on?) into a scene
+    definition, the target state of every light and of the tv, and applies it with a single "scene/apply" call so
+    "welcome home" costs one request however many devices there are.
+    Compiled scenes are cached per outcome and compiled again when the lights known to Hass change. define() can
+    replace the scene of an outcome, e.g. to add devices.
+    If Hass does not support "scene/apply" the scene is carried out with the fewest parallel service calls instead.
+    """
+    def __init__(self, steward):
+        self.steward = steward  # SnipsHomeManager
+        self._scenes = {}  # outcome -> (light entity ids compiled for, scene entities)
+        self._lock = threading.Lock()
+        self._scene_apply = True  # False once Hass has refused scene/apply
+
+    @staticmethod
+    def outcome(light_on, light_color, light_brightness, tv_on):
+        """
+        :return: Tuple identifying the outcome of a conversation, used as the scene cache key
+        """
+        if not light_on:
+            light_color = light_brightness = None
+        return bool(light_on), light_color, light_brightness, bool(tv_on)
+
+    def scene(self, outcome):
+        """
+        Get the scene of an outcome, compiling it if the lights changed since it was cached
+        :param outcome: Tuple returned by outcome()
+        :return: Dict, entity_id -> target state e.g. {"switch.living_room_tv": {"state": "on"}}, None when the
+                 lights are not known and the scene has to target "all" of them
+        """
+        lights = self._known_lights()
+        with self._lock:
+            cached = self._scenes.get(outcome)
+            if cached is not None and (cached[0] is None or cached[0] == lights):
+                return cached[1]
+        if lights is None:
+            return None
+        entities = self._compile(outcome, lights)
+        with self._lock:
+            self._scenes[outcome] = (lights, entities)
+        return entities
+
+    def define(self, outcome, entities):
+        """
+        Replace the scene applied for an outcome
+        :param outcome: Tuple returned by outcome()
+        :param entities: Dict, entity_id -> target state
+        :return: None
+        """
+        with self._lock:
+            self._scenes[outcome] = (None, entities)
+
+    def activate(self, light_on, light_color, light_brightness, tv_on):
+        """
+        Put the house in the state asked for at the end of a conversation
+        :return: List of requests.Response
+        """
+        outcome = self.outcome(light_on, light_color, light_brightness, tv_on)
+        entities = self.scene(outcome)
+        if entities is None:
+            return self.steward.send_batch(self._calls(outcome, entities))
+        return self.apply(entities)
+
+    def apply(self, entities):
+        """
+        Put entities in the given states, e.g. back to how they were before
+        :param entities: Dict, entity_id -> target state e.g. {"light.kitchen_light": {"state": "on", "brightness": 120}}
+        :return: List of requests.Response
+        """
+        if self._scene_apply:
+            response = self.steward.apply_scene(entities)
+            if response is None:
+                # Everything is already as asked
+                return []
+            if response.status_code < 400:
+                return [response]
+            logger.warning("Hass refused scene/apply (%s), using service calls", response.status_code)
+            self._scene_apply = False
+        return self.steward.send_batch(self._calls(None, entities))
+
+    @staticmethod
+    def snapshot(states):
+        """
+        :param states: List of state dicts as returned by Hass
+        :return: Dict, scene putting the lights back in these states
+        """
+        entities = {}
+        for state in states:
+            if not state['entity_id'].startswith('light.') or state.get('state') not in ('on', 'off'):
+                continue
+            target = {"state": state['state']}
+            attributes = state.get('attributes', {})
+            if state['state'] == 'on':
+                if attributes.get('brightness') is not None:
+                    target["brightness"] = attributes['brightness']
+                color = COLOR_MODE_ATTRIBUTES.get(attributes.get('color_mode'))
+                if color is not None and attributes.get(color) is not None:
+                    target[color] = attributes[color]
+            entities[state['entity_id']] = target
+        return entities
+
+    def _known_lights(self):
+        if self.steward.state_mirror is None and self.steward.entity_index is None:
+            # Listing the lights would cost a request of its own
+            return None
+        return tuple(sorted(state['entity_id'] for state in self.steward.get_states()
+                            if state['entity_id'].startswith('light.')))
+
+    @staticmethod
+    def _compile(outcome, lights):
+        light_on, light_color, light_brightness, tv_on = outcome
+        light = {"state": "on" if light_on else "off"}
+        if light_color:
+            light["color_name"] = light_color
+        if light_brightness is not None:
+            light["brightness"] = int(round(light_brightness * 255 / 100.0))
+        entities = dict((entity_id, dict(light)) for entity_id in lights)
+        entities[TV_ENTITY] = {"state": "on" if tv_on else "off"}
+        return entities
+
+    @staticmethod
+    def _calls(outcome, entities):
+        if entities is None:
+            light_on, light_color, light_brightness, tv_on = outcome
+            data = {}
+            if light_color:
+                data["color_name"] = light_color
+            if light_brightness is not None:
+                data["brightness_pct"] = light_brightness
+            return [
+                ('switch/turn_on' if tv_on else 'switch/turn_off', TV_ENTITY, {}),
+                ('light/turn_on' if light_on else 'light/turn_off', ALL_ENTITIES, data),
+            ]
+        calls = []
+        for entity_id, target in entities.items():
+            data = dict(target)
+            state = data.pop("state")
+            domain = entity_id.split('.', 1)[0]
+            calls.append(('{}/turn_{}'.format(domain, state), entity_id, data))
+        return calls
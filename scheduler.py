@@ -0,0 +1,270 @@
+import logging
+import threading
+import time
+import timeit
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import metrics
+from resilience import HassOverloadedError
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, the lower the sooner
+INTERACTIVE = 0  # A single entity asked for by the user e.g. "turn on the kitchen light"
+NORMAL = 1  # Several entities, the states of every entity, or conversation answers carried out ahead of time
+BULK = 2  # Scenes and "all", e.g. whole house automations
+PRIORITY_NAMES = ('interactive', 'normal', 'bulk')
+
+DEFAULT_QUEUE_SIZE = 16  # Normal or bulk requests waiting per instance before more are shed
+DEFAULT_RATE = 0  # Requests per second sent to an instance, 0 for no limit
+DEFAULT_BURST = 10  # Requests sent at once after a quiet period when rate limited
+RESERVED_SLOTS = 1  # Connections kept for interactive requests
+TICK = 0.005  # Seconds between two checks of the queues while requests wait for tokens or expire
+
+_context = threading.local()
+
+
+@contextmanager
+def priority(level):
+    """
+    Send the requests made by the enclosed block, in this thread, with a priority class instead of the one
+    guessed from each request, e.g. with priority(NORMAL): steward.light_off_all()
+    :param level: Int, INTERACTIVE, NORMAL or BULK
+    """
+    previous = getattr(_context, 'priority', None)
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def current_priority(default=None):
+    """
+    :param default: Int, priority class used when none was set with priority()
+    :return: Int, priority class of the requests made by this thread
+    """
+    level = getattr(_context, 'priority', None)
+    return default if level is None else level
+
+
+def carry_priority(function):
+    """
+    Wrap a function run by a worker thread so that it keeps the priority class of the thread handing it over
+    :return: Function taking the same arguments
+    """
+    level = getattr(_context, 'priority', None)
+    if level is None:
+        return function
+
+    def run(*args, **kwargs):
+        with priority(level):
+            return function(*args, **kwargs)
+    return run
+
+
+class TokenBucket(object):
+    """
+    Allows "rate" requests per second on average and up to "burst" at once. Not thread safe, the HassScheduler
+    only uses it under its lock.
+    """
+    def __init__(self, rate, burst=DEFAULT_BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self._last = timeit.default_timer()
+
+    def take(self):
+        """
+        :return: Bool, True if a request may be sent now
+        """
+        now = timeit.default_timer()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _Request(object):
+    __slots__ = ('priority', 'key', 'deadline', 'enqueued', 'result', 'error', 'admitted', 'done')
+
+    def __init__(self, level, key, deadline):
+        self.priority = level
+        self.key = key
+        self.deadline = deadline
+        self.enqueued = timeit.default_timer()
+        self.result = None
+        self.error = None
+        self.admitted = threading.Event()
+        self.done = threading.Event()
+
+
+class HassScheduler(object):
+    """
+    Decides which request goes to a Hass instance next, so that a whole house scene or an automation firing many
+    calls can not delay a command the user is waiting for.
+    Requests wait in one queue per priority class and the most urgent class always goes first. At most "slots"
+    requests are sent at once, one connection being kept for interactive requests, and a token bucket limits the
+    requests per second. A read waiting for the same call as one already queued shares its answer instead of being sent
+    again. Writes are always sent on their own, merging one into an earlier identical write would move it ahead of the
+    writes queued in between (on, off, on leaving the light off). Normal and bulk requests are shed with a
+    HassOverloadedError when their queue is full, as is any request not sent within its timeout.
+    """
+    def __init__(self, slots, rate=DEFAULT_RATE, burst=DEFAULT_BURST, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        :param slots: Int, requests sent at once, usually the size of the connection pool
+        :param rate: Float, requests per second, 0 for no limit
+        :param burst: Int, requests sent at once after a quiet period when rate limited
+        :param queue_size: Int, normal or bulk requests waiting before more are shed
+        """
+        self.slots = slots
+        self.queue_size = queue_size
+        self.bucket = None
+        self.shed = [0] * len(PRIORITY_NAMES)  # Requests shed per class
+        self.merged = [0] * len(PRIORITY_NAMES)  # Requests answered by an identical queued request, per class
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._queued = {}  # Key -> request waiting to be sent
+        self._running = 0
+        self._lock = threading.Lock()
+        self._waiting = threading.Event()  # Set while requests wait, wakes the thread checking the queues
+        self._stopped = False
+        self._thread = threading.Thread(target=self._watch, name="hass-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+        self.configure(rate=rate, burst=burst)
+
+    def configure(self, slots=None, rate=None, burst=None, queue_size=None):
+        """
+        Change the limits while requests are being sent, the arguments left to None are kept
+        :return: None
+        """
+        with self._lock:
+            if slots is not None:
+                self.slots = slots
+            if queue_size is not None:
+                self.queue_size = queue_size
+            if rate is not None or burst is not None:
+                rate = rate if rate is not None else (self.bucket.rate if self.bucket is not None else DEFAULT_RATE)
+                burst = burst if burst is not None else (self.bucket.burst if self.bucket is not None else DEFAULT_BURST)
+                self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+            self._admit()
+
+    def run(self, level, key, function, timeout):
+        """
+        Call function once the request may be sent to Hass
+        :param level: Int, priority class of the request
+        :param key: Hashable identifying the call for merging, None when it must be sent on its own
+        :param function: Function() making the request
+        :param timeout: Float, seconds the request may wait before being shed
+        :return: The result of function, or of the identical request it was merged with
+        :raises HassOverloadedError: When the request was shed
+        """
+        with self._lock:
+            request = self._queued.get(key) if key is not None else None
+            if request is not None:
+                self.merged[level] += 1
+                if level < request.priority:
+                    # Someone is now waiting for it
+                    self._queues[request.priority].remove(request)
+                    self._queues[level].append(request)
+                    request.priority = level
+                    self._admit()
+                merged = True
+            else:
+                merged = False
+                waiting = self._queues[level]
+                if level != INTERACTIVE and len(waiting) >= self.queue_size:
+                    self.shed[level] += 1
+                    raise HassOverloadedError("Hass is busy, shedding a {} request".format(PRIORITY_NAMES[level]))
+                request = _Request(level, key, timeit.default_timer() + timeout)
+                waiting.append(request)
+                if key is not None:
+                    self._queued[key] = request
+                self._admit()
+                if not request.admitted.is_set():
+                    self._waiting.set()
+        if merged:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            return request.result
+
+        request.admitted.wait()
+        if request.error is not None:
+            request.done.set()
+            raise request.error
+        metrics.observe('scheduler.wait.' + PRIORITY_NAMES[request.priority],
+                        timeit.default_timer() - request.enqueued)
+        try:
+            request.result = function()
+            return request.result
+        except Exception as e:
+            request.error = e
+            raise
+        finally:
+            request.done.set()
+            with self._lock:
+                self._running -= 1
+                self._admit()
+
+    def stats(self):
+        """
+        :return: Dict, per priority class the requests waiting, shed and merged, and the requests being sent
+        """
+        with self._lock:
+            stats = {'running': self._running}
+            for level, name in enumerate(PRIORITY_NAMES):
+                stats[name] = {'queued': len(self._queues[level]), 'shed': self.shed[level],
+                               'merged': self.merged[level]}
+            return stats
+
+    def close(self):
+        self._stopped = True
+        self._waiting.set()
+
+    def _admit(self):
+        """
+        Start the requests that may be sent, most urgent first. Called with the lock held.
+        """
+        for level, waiting in enumerate(self._queues):
+            limit = self.slots if level == INTERACTIVE else max(self.slots - RESERVED_SLOTS, 1)
+            while waiting and self._running < limit:
+                if self.bucket is not None and not self.bucket.take():
+                    return
+                request = waiting.popleft()
+                if request.key is not None:
+                    del self._queued[request.key]
+                self._running += 1
+                request.admitted.set()
+            if waiting:
+                # The less urgent classes wait behind it
+                return
+
+    def _expire(self):
+        now = timeit.default_timer()
+        for level, waiting in enumerate(self._queues):
+            expired = [request for request in waiting if request.deadline <= now]
+            for request in expired:
+                waiting.remove(request)
+                if request.key is not None:
+                    del self._queued[request.key]
+                self.shed[level] += 1
+                request.error = HassOverloadedError("Hass is busy, a {} request waited too long".format(
+                    PRIORITY_NAMES[level]))
+                request.admitted.set()
+
+    def _watch(self):
+        """
+        Send the requests that were waiting for tokens and shed the ones waiting too long, only while some wait
+        """
+        while not self._stopped:
+            self._waiting.wait()
+            time.sleep(TICK)
+            with self._lock:
+                self._expire()
+                self._admit()
+                if not any(self._queues):
+                    self._waiting.clear()
@@ -1,10 +1,13 @@
-import ConfigParser
+try:
+    from ConfigParser import SafeConfigParser, Error as ConfigError
+except ImportError:  # Python 3, e.g. running the tests
+    from configparser import ConfigParser as SafeConfigParser, Error as ConfigError
 import io
 
 CONFIGURATION_ENCODING_FORMAT = "utf-8"
 
 
-class SnipsConfigParser(ConfigParser.SafeConfigParser):
+class SnipsConfigParser(SafeConfigParser):
     def to_dict(self):
         return {section: {option_name : option for option_name, option in self.items(section)} for section in self.sections()}
 
@@ -15,7 +18,7 @@ class SnipsConfigParser(ConfigParser.SafeConfigParser):
                 conf_parser = SnipsConfigParser()
                 conf_parser.readfp(f)
                 return conf_parser.to_dict()
-        except (IOError, ConfigParser.Error) as e:
+        except (IOError, ConfigError) as e:
             print(e)
             return dict()
 
@@ -30,7 +33,7 @@ class SnipsConfigParser(ConfigParser.SafeConfigParser):
             with open(configuration_file, 'w') as f:
                 conf_parser.write(f)
                 return True
-        except (IOError, ConfigParser.Error) as e:
+        except (IOError, ConfigError) as e:
             print(e)
             return False
 
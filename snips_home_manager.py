@@ -1,5 +1,25 @@
 import json
-import requests as rq
+import logging
+import threading
+import time
+import timeit
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from entity_index import room_key
+from metrics import span
+from resilience import CircuitBreaker, HassUnavailableError, RetryPolicy, DEFAULT_TIMEOUT, DEFAULT_RETRIES
+from scheduler import INTERACTIVE, NORMAL, BULK, carry_priority, current_priority
+from transport import RestTransport, TransportError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_ADDRESS = 'http://192.168.0.136:8123/api/'
+DEFAULT_POOL_SIZE = 4
+COLD_AFTER = 60  # Seconds without an answer from Hass after which its idle connections may have been closed
+
+ALL_ENTITIES = "all"
+TV_ENTITY = "switch.living_room_tv"
 
 
 class SnipsHomeManager:
@@ -10,14 +30,398 @@ class SnipsHomeManager:
     appropriate API request. The SnipsHomeManager in this case is made mostly of calls to the Hass API
     to manage lights and switches.
 
+    The requests are carried by a transport: by default the REST API, through a single keep-alive session so that a
+    voice command reuses already open connections to Hass instead of paying a TCP handshake per call, or MQTT.
+
+    Every call to Hass has "timeout" seconds to complete, retries included. Reads and idempotent service calls are
+    retried on connection errors and 5xx answers, and a circuit breaker stops calling Hass while it keeps failing.
+    Either way a HassUnavailableError is raised instead of the caller hanging.
+    With a scheduler attached the requests are sent by priority class: a single entity first, then several entities,
+    then scenes and "all". A thread can choose the class of its requests with scheduler.priority().
+
     The functions in this manager depend on a corresponding naming convention for the Hass entities.
     E.g. each light entity must follow "light.roomname_light"
     """
-    def __init__(self, autho, header):
-        print("Created the snips home manager")
+    def __init__(self, autho, header, api_address=DEFAULT_API_ADDRESS, pool_size=DEFAULT_POOL_SIZE, warm_up=True,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, breaker=None, transport=None):
+        logger.info("Created the snips home manager")
         self.autho = autho  # Hass API key
         self.header = header  # Header required for REST API
-        self.api_address = 'http://192.168.0.136:8123/api/'
+        self.api_address = api_address
+        self.pool_size = pool_size  # Number of keep-alive connections kept open to Hass
+        # Carries the requests to Hass, e.g. a RestTransport or a MqttTransport
+        self.transport = transport or RestTransport(header, api_address, pool_size)
+        self._configure_lock = threading.Lock()
+        self._workers = ThreadPool(self.pool_size)  # Sends independent requests in parallel
+        self.timeout = timeout  # Seconds each call to Hass may take, retries included
+        self.retry = RetryPolicy(retries)
+        self.breaker = breaker or CircuitBreaker()
+        self.state_mirror = None  # Optional HassStateMirror answering state lookups from memory
+        self.coalescer = None  # Optional CommandCoalescer merging bursts of commands per entity
+        self.entity_index = None  # Optional EntityIndex finding the lights of each room
+        self.reconciler = None  # Optional StateReconciler dropping the calls that would change nothing
+        self.backends = None  # Optional HassBackends routing each entity to the Hass instance owning it
+        self.scheduler = None  # Optional HassScheduler sending the most urgent requests first
+        self._answered_at = None  # Time Hass last answered a request
+        if warm_up:
+            self.warm_up()
+
+    def configure(self, header=None, api_address=None, pool_size=None, timeout=None, retries=None):
+        """
+        Change how Hass is called while calls are being made, the arguments left to None are kept.
+        The open connections are only dropped when the address or the pool size change, a new token keeps them.
+        Calls already on their way finish with the previous settings.
+        :param header: Dict, headers of every request e.g. with a new "Authorization"
+        :param api_address: String, address of the Hass REST API
+        :param pool_size: Int, number of keep-alive connections kept open to Hass
+        :param timeout: Float, seconds each call to Hass may take, retries included
+        :param retries: Int, retries of reads and idempotent calls
+        :return: Bool, True if the connections to Hass were replaced
+        """
+        with self._configure_lock:
+            if timeout is not None:
+                self.timeout = timeout
+            if retries is not None:
+                self.retry.retries = retries
+            if header is not None:
+                self.header = header
+                self.autho = header.get('Authorization', self.autho)
+            if api_address is not None:
+                self.api_address = api_address
+            if pool_size is not None and pool_size != self.pool_size:
+                self.pool_size = pool_size
+                workers, self._workers = self._workers, ThreadPool(pool_size)
+                workers.close()
+            return self.transport.configure(header, api_address, pool_size)
+
+    def warm_up(self, connections=None):
+        """
+        Open the pooled connections to Hass ahead of the first voice command, checking the API token on the way.
+        Failures to connect are only reported, the connections will be opened again on first use.
+        :param connections: Int, number of connections to open, "pool_size" by default
+        :return: Bool, False if Hass refused the API token
+        """
+        if connections is None:
+            connections = self.pool_size
+        token_valid = all(self._workers.map(carry_priority(self._ping), range(max(connections, 1))))
+        if not token_valid:
+            logger.error("Hass refused the API token")
+        return token_valid
+
+    def is_cold(self):
+        """
+        :return: Bool, True if Hass has not answered for COLD_AFTER seconds, its pooled connections need warming up
+        """
+        answered_at = self._answered_at
+        return answered_at is None or timeit.default_timer() - answered_at >= COLD_AFTER
+
+    def _ping(self, _):
+        try:
+            if self.scheduler is None:
+                response = self.transport.ping(self.timeout)
+            else:
+                response = self.scheduler.run(current_priority(INTERACTIVE), None,
+                                              lambda: self.transport.ping(self.timeout), self.timeout)
+        except HassUnavailableError:
+            # Hass is busy, its connections are open
+            return True
+        except TransportError as e:
+            logger.warning("Could not reach Hass: %s", e)
+            return True
+        self._answered_at = timeit.default_timer()
+        return response.status_code not in (401, 403)
+
+    def _post_service(self, service, body):
+        """
+        Call a Hass service through the transport.
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param body: Dict, service data
+        :return: requests.Response
+        """
+        data = json.dumps(body, sort_keys=True)
+        entity_ids = body.get('entity_id')
+        if service == 'scene/apply' or entity_ids == ALL_ENTITIES:
+            level = BULK
+        elif isinstance(entity_ids, list) and len(entity_ids) > 1:
+            level = NORMAL
+        else:
+            level = INTERACTIVE
+        idempotent = not service.endswith('/toggle')
+        with span('hass.' + service):
+            # Writes are never merged: an identical write queued earlier may be sent before a conflicting one
+            return self._call(lambda timeout: self.transport.call_service(service, data, timeout), idempotent,
+                              current_priority(level))
+
+    def _get(self, path):
+        """
+        Read from the Hass API through the transport.
+        :param path: String, path relative to the api address e.g. "states/light.kitchen_light"
+        :return: requests.Response
+        """
+        level = current_priority(INTERACTIVE if '/' in path else NORMAL)
+        with span('hass.' + path.split('/', 1)[0]):
+            return self._call(lambda timeout: self.transport.get(path, timeout), True, level, ('GET', path))
+
+    def _call(self, request, idempotent, level=INTERACTIVE, key=None):
+        """
+        Make a request to Hass, once the scheduler lets it through when there is one.
+        :param request: Function(timeout) -> requests.Response, makes one attempt
+        :param idempotent: Bool, whether the request can be sent again when its outcome is not known
+        :param level: Int, priority class of the request
+        :param key: Hashable identifying a read, identical reads waiting together are sent once
+        :return: requests.Response, answered below 500
+        :raises HassUnavailableError: When Hass failed, is not being called, refused the API token or is too busy
+        """
+        if self.scheduler is None:
+            return self._attempts(request, idempotent)
+        return self.scheduler.run(level, key, lambda: self._attempts(request, idempotent), self.timeout)
+
+    def _attempts(self, request, idempotent):
+        """
+        Make a request to Hass within the time budget, retrying it with jittered backoff when that is safe.
+        Hass failing (connection error, timeout or 5xx) counts against the circuit breaker once per call, any answer
+        below 500 counts as a success, a refused token included, so that every call leaves the breaker an outcome.
+        """
+        if not self.breaker.allow():
+            raise HassUnavailableError("Hass is failing, not calling it for now")
+        deadline = timeit.default_timer() + self.timeout
+        attempt = 0
+        answered = False
+        try:
+            while True:
+                attempt += 1
+                try:
+                    response = request(max(deadline - timeit.default_timer(), 0.001))
+                    if response.status_code < 500:
+                        answered = True
+                        if response.status_code in (401, 403):
+                            # Hass is up, only the token is wrong
+                            raise HassUnavailableError("Hass refused the API token")
+                        return response
+                    error = "Hass answered {}".format(response.status_code)
+                except TransportError as e:
+                    error = e
+                delay = self.retry.delay(attempt)
+                if not idempotent or attempt > self.retry.retries or timeit.default_timer() + delay >= deadline:
+                    raise HassUnavailableError("{} (after {} attempts)".format(error, attempt))
+                logger.debug("Hass call failed (%s), retrying in %.2fs", error, delay)
+                time.sleep(delay)
+        finally:
+            if answered:
+                self._answered_at = timeit.default_timer()
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def fetch_state(self, entity_id):
+        """
+        Ask Hass for the current state of an entity
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: State dict as returned by Hass
+        """
+        return self._get('states/' + entity_id).json()
+
+    def fetch_states(self):
+        """
+        Ask Hass for the current state of every entity in a single request
+        :return: List of state dicts
+        """
+        return self._get('states').json()
+
+    def get_state(self, entity_id):
+        """
+        Current state of an entity, answered by the state mirror when there is one
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: State dict as returned by Hass
+        """
+        if self.backends is not None:
+            return self.backends.get_state(entity_id)
+        return self.get_state_local(entity_id)
+
+    def get_state_local(self, entity_id):
+        """
+        Same as get_state, from this Hass instance only
+        """
+        if self.state_mirror is not None:
+            return self.state_mirror.get(entity_id)
+        return self.fetch_state(entity_id)
+
+    def get_states(self):
+        """
+        Current state of every entity, answered by the state mirror when there is one
+        :return: List of state dicts
+        """
+        if self.backends is not None:
+            return self.backends.get_states()
+        return self.get_states_local()
+
+    def get_states_local(self):
+        """
+        Same as get_states, from this Hass instance only
+        """
+        if self.state_mirror is not None:
+            return self.state_mirror.all()
+        return self.fetch_states()
+
+    def expected_state(self, entity_id):
+        """
+        State an entity will be in once the commands still held by the coalescer are sent, so that relative
+        changes build on each other e.g. "brighter... brighter".
+        :param entity_id: String, e.g. "light.kitchen_light"
+        :return: State dict as returned by Hass
+        """
+        state = self.get_state(entity_id)
+        pending = self.coalescer.pending(entity_id) if self.coalescer is not None else None
+        if pending is None:
+            return state
+        service, data = pending
+        attributes = dict(state.get('attributes', {}))
+        if service.endswith('/turn_off'):
+            attributes.pop('brightness', None)
+            return dict(state, state='off', attributes=attributes)
+        if 'brightness_pct' in data:
+            attributes['brightness'] = int(round(data['brightness_pct'] * 255 / 100.0))
+        elif 'brightness' in data:
+            attributes['brightness'] = data['brightness']
+        return dict(state, state='on', attributes=attributes)
+
+    @staticmethod
+    def shifted_brightness(state, percent):
+        """
+        Work out a lights new brightness after shifting it by a percentage.
+        Hass reports brightness on a 0-255 scale, and not at all when the light is off.
+        :param state: State dict of the light as returned by Hass
+        :param percent: Int, percentage to add to the current brightness, negative to dim
+        :return: Int, new brightness percentage between 0 and 100
+        """
+        brightness = state.get('attributes', {}).get('brightness') or 0
+        new_brightness = int(round(brightness * 100.0 / 255)) + percent
+        if new_brightness < 0:
+            new_brightness = 0
+        if new_brightness > 100:
+            new_brightness = 100
+        return new_brightness
+
+    @staticmethod
+    def light_entity(room):
+        """
+        :param room: String, name of the room
+        :return: String, entity id of the rooms light by naming convention e.g. "light.kitchen_light"
+        """
+        return "light.{}_light".format(room_key(room))
+
+    def light_entities(self, rooms):
+        """
+        Find the lights of the rooms, using the entity index when there is one and the naming convention otherwise
+        :param rooms: List of room names
+        :return: List of light entity ids, every light of each room
+        """
+        if self.entity_index is None:
+            return [self.light_entity(room) for room in rooms]
+        entity_ids = []
+        for room in rooms:
+            for entity_id in self.entity_index.lights(room):
+                if entity_id not in entity_ids:
+                    entity_ids.append(entity_id)
+        return entity_ids
+
+    def unknown_rooms(self, rooms):
+        """
+        :param rooms: List of room names
+        :return: List of the rooms without any light, always empty when there is no entity index
+        """
+        if self.entity_index is None:
+            return []
+        return [room for room in rooms if not self.entity_index.lights(room)]
+
+    def apply(self, service, entity_ids, **data):
+        """
+        Call a Hass service once for one or more entities sharing the same service data.
+        E.g. apply('light/turn_on', ['light.kitchen_light', 'light.bedroom_light'], brightness_pct=40)
+        When a coalescer is attached the call is merged with the other pending commands for the same entities
+        and sent once its window closes. Calls for "all" first flush the pending commands, then go out directly.
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param entity_ids: String or list of entity ids, "all" targets every entity of the domain
+        :param data: Service data shared by every entity
+        :return: requests.Response, None when the call was handed to the coalescer or there is no entity
+        """
+        if not entity_ids:
+            return None
+        if self.coalescer is not None:
+            if entity_ids != ALL_ENTITIES:
+                return self.coalescer.submit(service, entity_ids, data)
+            self.coalescer.flush()
+        return self.send(service, entity_ids, data)
+
+    def apply_batch(self, calls):
+        """
+        Carry out several service calls with as few requests as possible.
+        Entities sharing a service and service data are grouped into a single request, the remaining
+        requests are sent in parallel.
+        :param calls: Iterable of (service, entity_id, data) tuples, data being a dict of service data
+        :return: List of requests.Response, one per request sent, empty when handed to the coalescer
+        """
+        if self.coalescer is not None:
+            for service, entity_id, data in calls:
+                self.apply(service, entity_id, **(data or {}))
+            return []
+        return self.send_batch(calls)
+
+    def send(self, service, entity_ids, data):
+        """
+        Call a Hass service straight away, bypassing the coalescer.
+        When a reconciler is attached only the entities the call would change are sent. When there are several
+        Hass instances each gets the call for its own entities.
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param entity_ids: String or list of entity ids, "all" targets every entity of the domain
+        :param data: Dict, service data shared by every entity
+        :return: requests.Response, None when the call would change nothing
+        """
+        if self.backends is not None:
+            return self.backends.send(service, entity_ids, data)
+        return self.send_local(service, entity_ids, data)
+
+    def send_local(self, service, entity_ids, data):
+        """
+        Same as send, to this Hass instance only
+        """
+        if self.reconciler is not None:
+            entity_ids = self.reconciler.changing(service, entity_ids, data)
+            if not entity_ids:
+                logger.debug("Not calling %s, nothing would change", service)
+                return None
+        body = dict(data)
+        if isinstance(entity_ids, (list, tuple, set)):
+            body["entity_id"] = list(entity_ids)
+        else:
+            body["entity_id"] = entity_ids
+        return self._post_service(service, body)
+
+    def send_batch(self, calls):
+        """
+        Same as apply_batch, bypassing the coalescer
+        :param calls: Iterable of (service, entity_id, data) tuples, data being a dict of service data
+        :return: List of requests.Response, one per request sent, None for the requests that would change nothing
+        """
+        groups = OrderedDict()
+        for service, entity_id, data in calls:
+            data = data or {}
+            key = (service, json.dumps(data, sort_keys=True))
+            if key not in groups:
+                groups[key] = (service, data, [])
+            groups[key][2].append(entity_id)
+
+        grouped = [(service, entity_ids, data) for service, data, entity_ids in groups.values()]
+        if len(grouped) == 1:
+            return [self._send_group(grouped[0])]
+        return self._workers.map(carry_priority(self._send_group), grouped)
+
+    def _send_group(self, request):
+        service, entity_ids, data = request
+        if ALL_ENTITIES in entity_ids:
+            # Hass only accepts "all" on its own
+            entity_ids = ALL_ENTITIES
+        return self.send(service, entity_ids, data)
 
     def light_on(self, room):
         """
@@ -25,24 +429,14 @@ class SnipsHomeManager:
         :param room: String, name of the room
         :return: None
         """
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "light.{}_light".format(room)
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_on', self.light_entities([room]))
 
     def light_on_all(self):
         """
         Ask Hass to turn on all of the lights
         :return: None
         """
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "all"
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_on', ALL_ENTITIES)
 
     def light_off(self, room):
         """
@@ -50,24 +444,14 @@ class SnipsHomeManager:
         :param room: String, room to turn lights off
         :return: None
         """
-        url = self.api_address + 'services/light/turn_off'
-        body = {
-            "entity_id": "light.{}_light".format(room)
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_off', self.light_entities([room]))
 
     def light_off_all(self):
         """
         Ask Hass to turn off all of the lights
         :return: None
         """
-        url = self.api_address + 'services/light/turn_off'
-        body = {
-            "entity_id": "all",
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_off', ALL_ENTITIES)
 
     def light_color(self, room, color):
         """
@@ -76,13 +460,7 @@ class SnipsHomeManager:
         :param color: String, human readable name of a color e.g. red, blue
         :return: None
         """
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "light.{}_light".format(room),
-            "color_name": color
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_on', self.light_entities([room]), color_name=color)
 
     def light_color_all(self, color):
         """
@@ -90,13 +468,7 @@ class SnipsHomeManager:
         :param color:
         :return: None
         """
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "all",
-            "color_name": color
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_on', ALL_ENTITIES, color_name=color)
 
     def light_brightness(self, room, brightness):
         """
@@ -105,13 +477,7 @@ class SnipsHomeManager:
         :param brightness: Int, percentage, how bright the light should be
         :return: None
         """
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "light.{}_light".format(room),
-            "brightness_pct": brightness
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_on', self.light_entities([room]), brightness_pct=brightness)
 
     def light_brightness_all(self, brightness):
         """
@@ -119,102 +485,105 @@ class SnipsHomeManager:
         :param brightness: Int, percentage, how bright the lights should be
         :return: None
         """
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "all",
-            "brightness_pct": brightness
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('light/turn_on', ALL_ENTITIES, brightness_pct=brightness)
 
     def shift_light_up(self, room, percent):
         """
         Ask Hass to make a specific light brighter.
-        Asks Hass for the current light brightness, then adds on the specified brightness
+        Looks up the current light brightness, then adds on the specified brightness
         :param room: String, room to change lights brightness
         :param percent: Int, percentage, amount to increase the lights brightness
         :return: None
         """
-        url = self.api_address + 'states/light.{}_light'.format(room)
-        request = rq.get(url, headers=self.header)
-        print(request.text)
-        response = request.json()
-        current_brightness = response['attributes']['brightness']
-
-        new_brightness = current_brightness + percent
-
-        if new_brightness < 0:
-            new_brightness = 0
-        if new_brightness > 100:
-            new_brightness = 100
-
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "light.{}_light".format(room),
-            "brightness": new_brightness
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self._shift_lights(self.light_entities([room]), percent)
 
     def shift_light_up_all(self, percent):
         """
-        !!!!!!NEEDS IMPLEMENTATION!!!!!!
-        Ask Hass to make the lights brighter.
+        Ask Hass to make the lights that are on brighter.
         :param percent: Int, percentage, amount to increase the lights brightness
-        :return: None
+        :return: List of requests.Response
         """
+        return self._shift_lights_all(percent)
 
     def shift_light_down(self, room, percent):
         """
         Ask Hass to make a specific light dimmer.
-        Asks Hass for the current light brightness, then subtracts the specified brightness
+        Looks up the current light brightness, then subtracts the specified brightness
         :param percent: Int, percentage, amount to decrease the lights brightness
         :return: None
         """
-        url = self.api_address + 'states/light.{}_light'.format(room)
-        request = rq.get(url, headers=self.header)
-        print(request.text)
-        response = request.json()
-        current_brightness = response['attributes']['brightness']
-
-        new_brightness = current_brightness - percent
+        self._shift_lights(self.light_entities([room]), -percent)
 
-        if new_brightness < 0:
-            new_brightness = 0
-        if new_brightness > 100:
-            new_brightness = 100
+    def shift_light_down_all(self, percent):
+        """
+        Ask Hass to make the lights that are on dimmer
+        :param percent: Int, percentage, amount to decrease the lights brightness
+        :return: List of requests.Response
+        """
+        return self._shift_lights_all(-percent)
 
-        url = self.api_address + 'services/light/turn_on'
-        body = {
-            "entity_id": "light.{}_light".format(room),
-            "brightness": new_brightness
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+    def _shift_lights(self, entity_ids, percent):
+        """
+        Shift the brightness of some lights, lights ending up at the same brightness are changed in one request
+        :param entity_ids: List of light entity ids
+        :param percent: Int, percentage to add to each lights brightness, negative to dim
+        :return: List of requests.Response
+        """
+        calls = []
+        for entity_id in entity_ids:
+            new_brightness = self.shifted_brightness(self.expected_state(entity_id), percent)
+            calls.append(('light/turn_on', entity_id, {"brightness_pct": new_brightness}))
+        return self.apply_batch(calls)
 
-    def shift_light_down_all(self, room, percent):
+    def _shift_lights_all(self, percent):
         """
-        !!!!!!NEEDS IMPLEMENTATION!!!!!!
-        Ask Hass to make the lights dimmer
-        :param percent: Int, percentage, amount to decrease the lights brightness
-        :return: None
+        Shift the brightness of every light that is on using a single read of all the states.
+        Lights ending up at the same brightness are changed together in one request.
+        :param percent: Int, percentage to add to each lights brightness, negative to dim
+        :return: List of requests.Response
         """
+        calls = []
+        for state in self.get_states():
+            if not state['entity_id'].startswith('light.') or state.get('state') != 'on':
+                continue
+            new_brightness = self.shifted_brightness(state, percent)
+            calls.append(('light/turn_on', state['entity_id'], {"brightness_pct": new_brightness}))
+        if not calls:
+            return []
+        return self.apply_batch(calls)
 
     def set_lights_all(self, color, brightness):
-        print("[DEBUG] (set_lights_all)")
-        print("[DEBUG] Color: " + color)
-        print("[DEBUG] Brightness: " + str(brightness))
-
-        url = 'http://192.168.0.136:8123/api/services/light/turn_on'
-        body = {
-            "entity_id": "all",
-            "color_name": color,
-            "brightness_pct": brightness
-        }
-        json_body = json.dumps(body)
-        print(json_body)
-        request = rq.post(url, data=json_body, headers=self.header)
-        print(request)
+        """
+        Ask Hass to set the color and brightness of all of the lights in one call
+        :param color: String, human readable name of a color e.g. red, blue
+        :param brightness: Int, percentage, how bright the lights should be
+        :return: requests.Response
+        """
+        logger.debug("(set_lights_all) Color: %s Brightness: %s", color, brightness)
+        return self.apply('light/turn_on', ALL_ENTITIES, color_name=color, brightness_pct=brightness)
+
+    def apply_scene(self, entities):
+        """
+        Ask Hass to put several entities in a given state at once, without having to create the scene first
+        :param entities: Dict, entity_id -> target state e.g. {"light.kitchen_light": {"state": "on", "brightness": 120}}
+        :return: requests.Response, None when the scene would change nothing
+        """
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        if self.backends is not None:
+            return self.backends.apply_scene(entities)
+        return self.apply_scene_local(entities)
+
+    def apply_scene_local(self, entities):
+        """
+        Same as apply_scene, on this Hass instance only
+        """
+        if self.reconciler is not None:
+            entities = self.reconciler.changing_scene(entities)
+            if not entities:
+                logger.debug("Not applying the scene, nothing would change")
+                return None
+        return self._post_service('scene/apply', {"entities": entities})
 
     def tv_on(self):
         """
@@ -222,21 +591,11 @@ class SnipsHomeManager:
         Could be modified for multiple tvs
         :return: None
         """
-        url = self.api_address + 'services/switch/turn_on'
-        body = {
-            "entity_id": "switch.living_room_tv",
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
+        self.apply('switch/turn_on', TV_ENTITY)
 
     def tv_off(self):
         """
         Ask Hass to turn the tv off
         :return: None
         """
-        url = self.api_address + 'services/switch/turn_off'
-        body = {
-            "entity_id": "switch.living_room_tv",
-        }
-        json_body = json.dumps(body)
-        request = rq.post(url, data=json_body, headers=self.header)
\ No newline at end of file
+        self.apply('switch/turn_off', TV_ENTITY)
\ No newline at end of file
@@ -0,0 +1,159 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 1  # Seconds between two checks of the worker processes
+RESTART_DELAY = 1  # Seconds before restarting a worker that died
+MAX_RESTART_DELAY = 60  # Longest wait before restarting a worker that keeps dying
+STABLE_AFTER = 60  # Seconds a worker must run for its restart delay to go back to RESTART_DELAY
+
+
+class SiteShard(object):
+    """
+    The satellites served by one of several worker processes. Every worker gets every intent from the broker and
+    only handles those of its satellites, so the dialogue of a satellite always stays in the same process. The site
+    ids are spread with crc32, which unlike hash() gives the same shard in every process.
+    """
+    def __init__(self, index, workers):
+        """
+        :param index: Int, number of this worker, from 0
+        :param workers: Int, number of worker processes
+        """
+        self.index = index
+        self.workers = workers
+
+    def owns(self, site_id):
+        """
+        :param site_id: String, Hermes site id of a satellite
+        :return: Bool, True if this worker handles the satellite
+        """
+        return shard_of(site_id, self.workers) == self.index
+
+    def filter(self, callback):
+        """
+        :param callback: Function(hermes, message), message having a "site_id" e.g. an intent or a session ended
+        :return: Function(hermes, message) calling callback for the satellites of this worker only
+        """
+        def filtered(hermes, message):
+            if self.owns(message.site_id):
+                return callback(hermes, message)
+        return filtered
+
+    def file_name(self, path):
+        """
+        :param path: String, file written by the action e.g. "intents.jsonl.gz"
+        :return: String, the file of this worker e.g. "intents.1.jsonl.gz"
+        """
+        directory, name = os.path.split(path)
+        stem, dot, extensions = name.partition('.')
+        return os.path.join(directory, '{}.{}{}{}'.format(stem, self.index, dot, extensions))
+
+
+def shard_of(site_id, workers):
+    """
+    :param site_id: String, Hermes site id of a satellite
+    :param workers: Int, number of worker processes
+    :return: Int, index of the worker handling the satellite
+    """
+    return (zlib.crc32((site_id or '').encode('utf-8')) & 0xffffffff) % workers
+
+
+class IntentSupervisor(object):
+    """
+    Runs the action in several processes, so that the intents of a busy house are handled on every core instead of
+    waiting for each other behind the GIL. Worker i runs target(SiteShard(i, workers)), which is expected to block
+    while handling the intents of its satellites. A worker that exits is started again, after a delay doubling
+    each time it dies within STABLE_AFTER seconds of starting.
+    """
+    def __init__(self, target, workers):
+        """
+        :param target: Function(shard) run in each worker process
+        :param workers: Int, number of worker processes
+        """
+        self.target = target
+        self.workers = workers
+        self._processes = [None] * workers
+        self._started = [0] * workers
+        self._delays = [RESTART_DELAY] * workers
+        self._restart_at = [0] * workers  # Time a dead worker is started again, 0 while it runs
+        self._stopped = False
+
+    def run(self):
+        """
+        Start the workers and restart those that die, until stopped or sent SIGTERM
+        :return: None
+        """
+        previous = signal.signal(signal.SIGTERM, self._terminated)
+        try:
+            for index in range(self.workers):
+                self._start(index)
+            while not self._stopped:
+                time.sleep(CHECK_INTERVAL)
+                self.check()
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            self.stop()
+
+    def check(self):
+        """
+        Restart the workers that died, once their delay has passed
+        :return: Int, number of workers running
+        """
+        now = time.time()
+        for index, process in enumerate(self._processes):
+            if self._stopped:
+                break
+            if self._restart_at[index]:
+                if now >= self._restart_at[index]:
+                    self._start(index)
+            elif not process.is_alive():
+                self._died(index, now)
+        return len([process for process in self._processes if process is not None and process.is_alive()])
+
+    def stop(self):
+        """
+        Stop every worker
+        :return: None
+        """
+        self._stopped = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+    def _start(self, index):
+        process = multiprocessing.Process(target=_work, args=(self.target, SiteShard(index, self.workers)),
+                                          name="intent-worker-{}".format(index))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+        self._started[index] = time.time()
+        self._restart_at[index] = 0
+        logger.info("(IntentSupervisor) Started worker %s of %s, pid %s", index, self.workers, process.pid)
+
+    def _died(self, index, now):
+        process = self._processes[index]
+        process.join()
+        if now - self._started[index] >= STABLE_AFTER:
+            self._delays[index] = RESTART_DELAY
+        delay = self._delays[index]
+        self._delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+        self._restart_at[index] = now + delay
+        logger.error("(IntentSupervisor) Worker %s exited with code %s, restarting it in %ss, the conversations "
+                     "of its satellites are lost", index, process.exitcode, delay)
+
+    def _terminated(self, signum, frame):
+        self._stopped = True
+
+
+def _work(target, shard):
+    # Forked with the handler of the supervisor, terminate() must stop the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(shard)
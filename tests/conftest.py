@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+
+# The modules of the action sit at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def wait_until(predicate, timeout=2.0):
+    """
+    :return: Bool, True once predicate() is true, False if it still is not after "timeout" seconds
+    """
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+_action = []
+
+
+def action_module():
+    """
+    :return: The action module, loaded once
+    """
+    if not _action:
+        from fake_hermes import load_action
+        _action.append(load_action())
+    return _action[0]
+
+
+def action_config(api_address, **options):
+    """
+    :param api_address: String, api address of the fake Hass
+    :param options: Options of the [global] section, the others keep their default
+    :return: Dict, config of an action calling the fake Hass
+    """
+    options['hass_api_address'] = api_address
+    return {'global': dict((name, str(value)) for name, value in options.items()),
+            'secret': {'http_api_token': 'Bearer test'}}
+
+
+def home_manager(api_address, **options):
+    """
+    :return: HomeManager calling the fake Hass at api_address, not subscribed to Hermes
+    """
+    return action_module().HomeManager(config=action_config(api_address, **options), blocking=False)
@@ -0,0 +1,99 @@
+import random
+import threading
+import time
+import timeit
+
+import pytest
+
+from async_home_manager import AsyncIntentCallback, AsyncSnipsHomeManager
+from fake_hass import FakeHass
+from fake_hermes import IntentMessage
+from resilience import HassUnavailableError
+from snips_home_manager import SnipsHomeManager
+
+HEADER = {'Authorization': 'Bearer test'}
+ROOMS = ('kitchen', 'bedroom', 'bathroom', 'living room')
+
+
+@pytest.fixture
+def hass():
+    hass = FakeHass(latency=0.2)
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+def test_calls_return_before_hass_answers(hass):
+    steward = AsyncSnipsHomeManager(SnipsHomeManager('test', HEADER, hass.api_address, 4, warm_up=False))
+    start = timeit.default_timer()
+    results = [steward.light_on(room) for room in ROOMS] + [steward.tv_on()]
+    assert timeit.default_timer() - start < 0.1
+    steward.gather(results, 2)
+    # Sent at once rather than one after the other
+    assert timeit.default_timer() - start < 0.2 * len(results)
+    steward.close()
+    for room in ROOMS:
+        assert hass.state('light.{}_light'.format(room.replace(' ', '_')))['state'] == 'on'
+    assert hass.state('switch.living_room_tv')['state'] == 'on'
+
+
+def test_other_attributes_are_those_of_the_manager(hass):
+    manager = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False)
+    steward = AsyncSnipsHomeManager(manager)
+    assert steward.pool_size == 2
+    steward.gather([steward.light_brightness('kitchen', 40)], 2)
+    # Reads still block
+    assert steward.get_state('light.kitchen_light')['state'] == 'on'
+    steward.close()
+
+
+def test_errors_are_raised_by_get(hass):
+    hass.token = 'Bearer other'
+    steward = AsyncSnipsHomeManager(SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False))
+    result = steward.light_off('kitchen')
+    with pytest.raises(HassUnavailableError):
+        result.get(2)
+    steward.close()
+
+
+def test_intents_of_a_session_are_handled_in_order():
+    handled = {}
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def callback(hermes, intent_message):
+        session_id = intent_message.session_id
+        with lock:
+            if session_id in running:
+                overlaps.append(session_id)
+            running.add(session_id)
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            running.discard(session_id)
+            handled.setdefault(session_id, []).append(intent_message.intent.intent_name)
+
+    # More workers than sessions, several of them could pick intents of the same session
+    dispatcher = AsyncIntentCallback(callback, workers=8)
+    for number in range(20):
+        for session in range(2):
+            dispatcher(None, IntentMessage(str(number), 'session-{}'.format(session)))
+    dispatcher.close()
+    assert overlaps == []
+    assert handled == dict(('session-{}'.format(session), [str(number) for number in range(20)])
+                           for session in range(2))
+
+
+def test_failed_intent_does_not_stop_the_session():
+    handled = []
+
+    def callback(hermes, intent_message):
+        if intent_message.intent.intent_name == 'broken':
+            raise ValueError("broken")
+        handled.append(intent_message.intent.intent_name)
+
+    dispatcher = AsyncIntentCallback(callback, workers=2)
+    for name in ('first', 'broken', 'last'):
+        dispatcher(None, IntentMessage(name, 'session'))
+    dispatcher.close()
+    assert handled == ['first', 'last']
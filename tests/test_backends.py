@@ -0,0 +1,167 @@
+import pytest
+
+from backends import DEFAULT_BACKEND, HassBackends
+from conftest import action_config, action_module, wait_until
+from fake_hass import FakeHass
+from fake_hermes import FakeHermes, IntentMessage
+from hass_state import HassStateMirror
+from resilience import HassUnavailableError
+from snips_home_manager import ALL_ENTITIES, SnipsHomeManager
+
+HEADER = {'Authorization': 'Bearer test'}
+
+# Lights of the annex, a second building with its own Hass
+ANNEX_STATES = [
+    {"entity_id": "light.garage_light", "state": "off", "attributes": {"friendly_name": "Garage Light"}},
+    {"entity_id": "light.annex_hall_light", "state": "off", "attributes": {"friendly_name": "Hall Light"}},
+]
+
+
+@pytest.fixture
+def main():
+    hass = FakeHass()
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+@pytest.fixture
+def annex():
+    hass = FakeHass(ANNEX_STATES)
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+def steward_of(hass):
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False)
+    steward.state_mirror = HassStateMirror(steward)
+    return steward
+
+
+@pytest.fixture
+def backends(main, annex):
+    default, other = steward_of(main), steward_of(annex)
+    backends = HassBackends(default)
+    backends.add('annex', other)
+    for steward in (default, other):
+        assert steward.state_mirror.start()
+    yield backends
+    for steward in (default, other):
+        steward.state_mirror.stop()
+    backends.close()
+
+
+def service_calls(hass):
+    return [(path, body) for method, path, body in hass.calls if method == 'POST']
+
+
+def test_entities_go_to_the_instance_that_reported_them(backends):
+    default, annex = backends.stewards()
+    assert backends.backend('light.garage_light') is annex
+    assert backends.backend('light.kitchen_light') is default
+    # Not reported by any instance
+    assert backends.backend('light.attic_light') is default
+
+
+def test_call_is_split_between_the_instances(backends, main, annex):
+    backends.send('light/turn_on', ['light.kitchen_light', 'light.garage_light', 'light.bedroom_light'], {})
+    assert service_calls(main) == [('/api/services/light/turn_on',
+                                    {'entity_id': ['light.kitchen_light', 'light.bedroom_light']})]
+    assert service_calls(annex) == [('/api/services/light/turn_on', {'entity_id': ['light.garage_light']})]
+    assert annex.state('light.garage_light')['state'] == 'on'
+    assert main.state('light.garage_light') is None
+
+
+def test_call_for_all_goes_to_every_instance(backends, main, annex):
+    assert [steward for steward, _ in backends.split(ALL_ENTITIES)] == backends.stewards()
+    assert [part for _, part in backends.split(['light.kitchen_light', ALL_ENTITIES])] == [ALL_ENTITIES] * 2
+    backends.send('light/turn_off', ALL_ENTITIES, {})
+    assert service_calls(main) == [('/api/services/light/turn_off', {'entity_id': ALL_ENTITIES})]
+    assert service_calls(annex) == [('/api/services/light/turn_off', {'entity_id': ALL_ENTITIES})]
+
+
+def test_scene_is_split_between_the_instances(backends, main, annex):
+    backends.apply_scene({'light.kitchen_light': {'state': 'on'}, 'light.garage_light': {'state': 'on'}})
+    assert service_calls(main) == [('/api/services/scene/apply',
+                                    {'entities': {'light.kitchen_light': {'state': 'on'}}})]
+    assert service_calls(annex) == [('/api/services/scene/apply',
+                                     {'entities': {'light.garage_light': {'state': 'on'}}})]
+
+
+def test_states_of_every_instance_are_merged(backends):
+    entity_ids = [state['entity_id'] for state in backends.get_states()]
+    assert 'light.kitchen_light' in entity_ids and 'light.garage_light' in entity_ids
+    assert backends.get_state('light.garage_light')['attributes']['friendly_name'] == 'Garage Light'
+
+
+def test_entity_is_learned_when_it_appears(backends, annex):
+    default, other = backends.stewards()
+    # Changes made before the event stream is followed are not seen
+    assert wait_until(lambda: other.state_mirror._streaming)
+    annex.set_state('light.porch_light', 'off')
+    assert wait_until(lambda: backends.backend('light.porch_light') is other)
+
+
+def test_routes(main, annex):
+    default, other = steward_of(main), steward_of(annex)
+    backends = HassBackends(default)
+    backends.add('annex', other)
+    with pytest.raises(ValueError):
+        backends.route('attic', 'nowhere')
+    # Neither instance has reported its entities, only the routes send them to the annex
+    backends.route('garage', 'annex')
+    backends.route('light.annex_', 'annex')
+    backends.route('light.annex_kitchen_', DEFAULT_BACKEND)
+    assert backends.backend('light.garage_light') is other
+    assert backends.backend('light.garage') is other
+    assert backends.backend('light.garages_light') is default
+    assert backends.backend('light.annex_hall_light') is other
+    # The longest prefix wins
+    assert backends.backend('light.annex_kitchen_light') is default
+    backends.close()
+
+
+def test_prefix_route_wins_over_the_reporting_instance(backends):
+    default, annex = backends.stewards()
+    backends.route('light.garage_', DEFAULT_BACKEND)
+    assert backends.backend('light.garage_light') is default
+
+
+def test_one_instance_down_does_not_stop_the_others(backends, main, annex):
+    default, other = backends.stewards()
+    annex.stop()
+    other.configure(retries=0, timeout=0.5)
+    with pytest.raises(HassUnavailableError):
+        backends.send('light/turn_on', ['light.kitchen_light', 'light.garage_light'], {})
+    # The call to the instance still up was made all the same
+    assert main.state('light.kitchen_light')['state'] == 'on'
+    assert backends.health()[DEFAULT_BACKEND] == 'closed'
+
+
+@pytest.fixture
+def action(main, annex):
+    config = action_config(main.api_address)
+    config['backends'] = {'annex': annex.api_address}
+    action = action_module().HomeManager(config=config, blocking=False)
+    assert action.warm_up()
+    yield action
+    for steward in action.stewards():
+        steward.state_mirror.stop()
+    action.backends.close()
+
+
+def test_rooms_of_every_instance_are_known(action, main, annex):
+    hermes = FakeHermes()
+    action.master_intent_callback(hermes, IntentMessage('turnOn', 'session', slots={'house_room': ['garage']}))
+    assert wait_until(lambda: annex.state('light.garage_light')['state'] == 'on')
+    assert main.state('light.garage_light') is None
+    assert action.steward.unknown_rooms(['garage', 'kitchen', 'attic']) == ['attic']
+
+
+def test_unknown_room_is_answered_without_calling_hass(action, main, annex):
+    hermes = FakeHermes()
+    action.master_intent_callback(hermes, IntentMessage('turnOn', 'session', slots={'house_room': ['attic']}))
+    kind, session_id, text, intent_filter = hermes.published[-1]
+    assert (kind, text) == ('end', "I don't know the attic")
+    assert service_calls(main) == [] and service_calls(annex) == []
@@ -0,0 +1,73 @@
+import pytest
+
+from coalesce import CommandCoalescer
+from fake_hass import FakeHass
+from snips_home_manager import SnipsHomeManager
+
+HEADER = {'Authorization': 'Bearer test'}
+
+
+@pytest.fixture
+def house():
+    hass = FakeHass()
+    api_address = hass.start()
+    steward = SnipsHomeManager('test', HEADER, api_address, 2, warm_up=False)
+    # A long window, the tests flush themselves
+    coalescer = CommandCoalescer(steward, window=60)
+    yield hass, coalescer
+    coalescer.flush()
+    hass.stop()
+
+
+def service_calls(hass):
+    return [(path, body) for method, path, body in hass.calls if path.startswith('/api/services/')]
+
+
+def test_turn_off_replaces_pending_turn_on():
+    merged = CommandCoalescer._merge(('light/turn_on', {'brightness': 40}), 'light/turn_off', {})
+    assert merged == ('light/turn_off', {})
+
+
+def test_turn_on_keeps_earlier_data():
+    merged = CommandCoalescer._merge(('light/turn_on', {'color_name': 'red'}), 'light/turn_on', {'brightness': 40})
+    assert merged == ('light/turn_on', {'color_name': 'red', 'brightness': 40})
+
+
+def test_exclusive_data_replace_each_other():
+    previous = ('light/turn_on', {'brightness': 40, 'color_name': 'red'})
+    assert CommandCoalescer._merge(previous, 'light/turn_on', {'brightness_pct': 10}) == \
+        ('light/turn_on', {'brightness_pct': 10, 'color_name': 'red'})
+    assert CommandCoalescer._merge(previous, 'light/turn_on', {'kelvin': 2700}) == \
+        ('light/turn_on', {'brightness': 40, 'kelvin': 2700})
+
+
+def test_turn_on_after_turn_off_drops_the_turn_off():
+    merged = CommandCoalescer._merge(('light/turn_off', {}), 'light/turn_on', {'brightness': 40})
+    assert merged == ('light/turn_on', {'brightness': 40})
+
+
+def test_burst_is_sent_as_one_call(house):
+    hass, coalescer = house
+    coalescer.submit('light/turn_on', 'light.kitchen_light', {'brightness': 100})
+    coalescer.submit('light/turn_on', 'light.kitchen_light', {'brightness': 150})
+    coalescer.submit('light/turn_on', 'light.kitchen_light', {'color_name': 'blue'})
+    assert service_calls(hass) == []
+    assert coalescer.pending('light.kitchen_light') == \
+        ('light/turn_on', {'brightness': 150, 'color_name': 'blue'})
+
+    coalescer.flush()
+    assert coalescer.pending('light.kitchen_light') is None
+    assert service_calls(hass) == [('/api/services/light/turn_on', {
+        'entity_id': ['light.kitchen_light'], 'brightness': 150, 'color_name': 'blue'})]
+    assert hass.state('light.kitchen_light')['attributes']['brightness'] == 150
+
+
+def test_entities_with_the_same_command_share_a_call(house):
+    hass, coalescer = house
+    coalescer.submit('light/turn_on', ['light.kitchen_light', 'light.bedroom_light'], {})
+    coalescer.submit('light/turn_off', 'light.bathroom_light', {})
+    coalescer.submit('light/turn_off', 'light.bedroom_light', {})
+    coalescer.flush()
+    calls = sorted((path, sorted(body['entity_id'])) for path, body in service_calls(hass))
+    assert calls == [('/api/services/light/turn_off', ['light.bathroom_light', 'light.bedroom_light']),
+                     ('/api/services/light/turn_on', ['light.kitchen_light'])]
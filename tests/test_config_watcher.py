@@ -0,0 +1,107 @@
+import io
+
+import pytest
+
+from conftest import action_config, home_manager, wait_until
+from config_watcher import ConfigWatcher, load_config
+from fake_hass import FakeHass
+
+CONFIG = u"""[global]
+hass_timeout=3
+
+[secret]
+http_api_token=Bearer test
+"""
+
+
+def write(path, text):
+    with io.open(str(path), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    path = tmp_path / 'config.ini'
+    write(path, CONFIG)
+    return path
+
+
+def test_load_config(config_file, tmp_path):
+    assert load_config(str(config_file)) == {'global': {'hass_timeout': '3'},
+                                             'secret': {'http_api_token': 'Bearer test'}}
+    with pytest.raises(ValueError):
+        load_config(str(tmp_path / 'missing.ini'))
+    write(config_file, u"hass_timeout=3\n")
+    with pytest.raises(ValueError):
+        load_config(str(config_file))
+
+
+def test_changes_are_handed_over_once(config_file):
+    changes = []
+    watcher = ConfigWatcher(str(config_file), changes.append)
+    assert not watcher.check()
+    write(config_file, CONFIG.replace('hass_timeout=3', 'hass_timeout=10'))
+    assert watcher.check()
+    assert not watcher.check()
+    assert changes == [{'global': {'hass_timeout': '10'}, 'secret': {'http_api_token': 'Bearer test'}}]
+
+
+def test_file_that_can_not_be_parsed_is_ignored(config_file):
+    changes = []
+    watcher = ConfigWatcher(str(config_file), changes.append)
+    write(config_file, u"[global\nhass_timeout=3\n")
+    assert watcher.check()
+    assert changes == []
+    write(config_file, CONFIG)
+    assert watcher.check()
+    assert len(changes) == 1
+
+
+def test_watcher_thread_checks_the_file(config_file):
+    changes = []
+    watcher = ConfigWatcher(str(config_file), changes.append, interval=0.02)
+    watcher.start()
+    write(config_file, CONFIG + u"\n[aliases]\nlounge=living room\n")
+    assert wait_until(lambda: changes)
+    watcher.stop()
+    assert changes[0]['aliases'] == {'lounge': 'living room'}
+
+
+@pytest.fixture
+def hass():
+    hass = FakeHass()
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+def test_reload_applies_the_new_settings(hass):
+    action = home_manager(hass.api_address)
+    pool = action.steward.transport._adapter
+    config = action_config(hass.api_address, hass_timeout=1.5, conversation_timeout=10)
+    config['secret']['http_api_token'] = 'Bearer other'
+    config['aliases'] = {'lounge': 'living room'}
+    assert action.reload_config(config)
+    assert action.settings['hass_timeout'] == 1.5
+    assert action.steward.timeout == 1.5
+    assert action.conversations.idle_timeout == 10
+    assert action.steward.header['Authorization'] == 'Bearer other'
+    assert action.steward.entity_index.lights('lounge') == ['light.living_room_light']
+    # Same Hass and pool, the open connections are kept
+    assert action.steward.transport._adapter is pool
+
+
+def test_reload_with_a_bad_value_changes_nothing(hass):
+    action = home_manager(hass.api_address)
+    assert not action.reload_config(action_config(hass.api_address, hass_timeout=1.5, hass_pool_size='many'))
+    assert action.settings['hass_timeout'] == 3
+    assert action.steward.timeout == 3
+
+
+def test_reload_without_the_token_is_refused(hass):
+    action = home_manager(hass.api_address)
+    config = action_config(hass.api_address, hass_timeout=1.5)
+    del config['secret']['http_api_token']
+    assert not action.reload_config(config)
+    assert action.settings['http_api_token'] == 'Bearer test'
+    assert action.steward.header['Authorization'] == 'Bearer test'
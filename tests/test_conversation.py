@@ -0,0 +1,69 @@
+import time
+
+from conversation import ConversationStep, ConversationStore
+
+
+class Aborted(list):
+    def __call__(self, conversation):
+        self.append(conversation.session_id)
+
+
+def test_conversation_is_kept_per_session():
+    store = ConversationStore()
+    kitchen = store.start('first', 'kitchen', arriving=True)
+    hall = store.start('second', 'hall', arriving=False)
+    assert store.get('first') is kitchen
+    assert store.get('second') is hall
+    assert kitchen.step == ConversationStep.LIGHTS_ON
+    assert kitchen.arriving and not hall.arriving
+    assert store.get('third') is None
+    assert len(store) == 2
+
+
+def test_end_forgets_without_aborting():
+    aborted = Aborted()
+    store = ConversationStore(on_abort=aborted)
+    conversation = store.start('session', 'kitchen', arriving=True)
+    assert store.end('session') is conversation
+    assert store.get('session') is None
+    assert store.end('session') is None
+    assert aborted == []
+
+
+def test_abort_tells_on_abort():
+    aborted = Aborted()
+    store = ConversationStore(on_abort=aborted)
+    store.start('session', 'kitchen', arriving=True)
+    assert store.abort('session') is not None
+    assert store.abort('session') is None
+    assert aborted == ['session']
+
+
+def test_new_conversation_on_a_satellite_replaces_the_previous_one():
+    aborted = Aborted()
+    store = ConversationStore(on_abort=aborted)
+    store.start('first', 'kitchen', arriving=True)
+    store.start('second', 'kitchen', arriving=False)
+    assert store.get('first') is None
+    assert store.get('second') is not None
+    assert aborted == ['first']
+    # Ending the replaced session does not touch the new one
+    store.end('first')
+    store.start('third', 'hall', arriving=True)
+    assert len(store) == 2
+
+
+def test_idle_conversations_expire():
+    aborted = Aborted()
+    store = ConversationStore(idle_timeout=0.2, on_abort=aborted)
+    store.start('idle', 'kitchen', arriving=True)
+    store.start('busy', 'hall', arriving=True)
+    time.sleep(0.12)
+    assert store.get('busy') is not None
+    time.sleep(0.12)
+    assert store.get('idle') is None
+    assert store.get('busy') is not None
+    assert aborted == ['idle']
+    # The satellite is free again
+    store.start('again', 'kitchen', arriving=True)
+    assert aborted == ['idle']
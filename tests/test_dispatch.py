@@ -0,0 +1,84 @@
+import random
+import threading
+import time
+
+from dispatch import CommandDispatcher
+from snips_home_manager import ALL_ENTITIES
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, name, delay=0.0):
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.calls.append(name)
+        return name
+
+
+def lanes_apart(dispatcher):
+    """
+    :return: Two entity ids served by different lanes
+    """
+    first = 'light.a0'
+    for number in range(1, 100):
+        other = 'light.a{}'.format(number)
+        if dispatcher._lanes_for(other) != dispatcher._lanes_for(first):
+            return first, other
+    raise AssertionError("every entity is on the same lane")
+
+
+def test_commands_for_an_entity_run_in_order():
+    dispatcher = CommandDispatcher(workers=4)
+    recorder = Recorder()
+    commands = []
+    for number in range(20):
+        entity_id = 'light.l{}'.format(number % 3)
+        commands.append(dispatcher.submit(entity_id, recorder, (entity_id, number), random.uniform(0, 0.005)))
+    for command in commands:
+        assert command.wait(2)
+    for entity_id in ('light.l0', 'light.l1', 'light.l2'):
+        numbers = [number for name, number in recorder.calls if name == entity_id]
+        assert numbers == sorted(numbers)
+    dispatcher.close()
+
+
+def test_command_for_several_entities_waits_for_each_lane():
+    dispatcher = CommandDispatcher(workers=4)
+    first, second = lanes_apart(dispatcher)
+    recorder = Recorder()
+    slow = dispatcher.submit(first, recorder, 'slow ' + first, 0.1)
+    both = dispatcher.submit([first, second], recorder, 'both')
+    after = dispatcher.submit(second, recorder, 'after ' + second)
+    for command in (slow, both, after):
+        assert command.wait(2)
+    assert recorder.calls == ['slow ' + first, 'both', 'after ' + second]
+    dispatcher.close()
+
+
+def test_all_runs_after_everything_queued_before_it():
+    dispatcher = CommandDispatcher(workers=4)
+    recorder = Recorder()
+    earlier = [dispatcher.submit('light.l{}'.format(number), recorder, number, 0.01) for number in range(6)]
+    everything = dispatcher.submit(ALL_ENTITIES, recorder, 'all')
+    assert everything.wait(2)
+    assert all(command.wait(0) for command in earlier)
+    assert recorder.calls[-1] == 'all'
+    dispatcher.close()
+
+
+def test_errors_are_reported_on_the_command():
+    failed = []
+    dispatcher = CommandDispatcher(workers=2, on_error=failed.append)
+
+    def broken():
+        raise ValueError("broken")
+
+    command = dispatcher.submit('light.l0', broken)
+    assert command.wait(2)
+    assert isinstance(command.error, ValueError)
+    dispatcher.close()
+    assert failed == [command]
@@ -0,0 +1,78 @@
+from entity_index import EntityIndex, room_key
+
+STATES = [
+    {'entity_id': 'light.kitchen_light', 'attributes': {'friendly_name': 'Kitchen Light'}},
+    {'entity_id': 'light.living_room_lamp', 'attributes': {'friendly_name': 'Living Room Lamp'}},
+    {'entity_id': 'light.living_room_ceiling', 'attributes': {}},
+    {'entity_id': 'light.hue_1', 'attributes': {'friendly_name': 'Bedroom Light'}},
+    {'entity_id': 'switch.living_room_tv', 'attributes': {'friendly_name': 'Living Room TV'}},
+]
+
+
+class States(object):
+    """
+    Stands for SnipsHomeManager.get_states, counting the discoveries
+    """
+    def __init__(self, states):
+        self.states = list(states)
+        self.loads = 0
+
+    def __call__(self):
+        self.loads += 1
+        return list(self.states)
+
+
+def index(aliases=None, refresh_interval=60):
+    states = States(STATES)
+    entity_index = EntityIndex(states, aliases, refresh_interval)
+    entity_index.refresh()
+    return entity_index, states
+
+
+def test_room_key():
+    assert room_key(' Living Room ') == 'living_room'
+
+
+def test_every_entity_of_a_room_is_found():
+    entity_index, _ = index()
+    assert entity_index.lights('kitchen') == ['light.kitchen_light']
+    assert entity_index.lights('Living Room') == ['light.living_room_ceiling', 'light.living_room_lamp']
+    assert entity_index.lights('living room lamp') == ['light.living_room_lamp']
+    assert entity_index.entities('living room', 'switch') == ['switch.living_room_tv']
+
+
+def test_friendly_name_finds_the_room():
+    entity_index, _ = index()
+    assert entity_index.lights('bedroom') == ['light.hue_1']
+
+
+def test_aliases():
+    entity_index, _ = index({'lounge': 'living room'})
+    assert entity_index.lights('lounge') == ['light.living_room_ceiling', 'light.living_room_lamp']
+    entity_index.set_aliases({})
+    assert entity_index.lights('lounge') == []
+
+
+def test_updates_keep_the_index_current():
+    entity_index, states = index()
+    entity_index.update('light.garage_light', {'entity_id': 'light.garage_light', 'attributes': {}})
+    assert entity_index.lights('garage') == ['light.garage_light']
+    entity_index.update('light.living_room_lamp', None)
+    assert entity_index.lights('living room') == ['light.living_room_ceiling']
+    # Renamed
+    entity_index.update('light.hue_1', {'entity_id': 'light.hue_1', 'attributes': {'friendly_name': 'Study'}})
+    assert entity_index.lights('study') == ['light.hue_1']
+    assert entity_index.lights('bedroom') == []
+    assert states.loads == 1
+
+
+def test_unknown_room_triggers_a_discovery_at_most_every_interval():
+    entity_index, states = index(refresh_interval=0)
+    states.states.append({'entity_id': 'light.attic_light', 'attributes': {}})
+    assert entity_index.lights('attic') == ['light.attic_light']
+    assert states.loads == 2
+
+    entity_index, states = index(refresh_interval=60)
+    assert entity_index.lights('attic') == []
+    assert entity_index.lights('cellar') == []
+    assert states.loads == 1
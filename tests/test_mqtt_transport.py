@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from conftest import wait_until
+from fake_hass import FakeHass
+from fake_mqtt import FakeBroker, FakeHassBridge
+from hass_state import HassStateMirror
+from resilience import HassUnavailableError
+from snips_home_manager import SnipsHomeManager
+from transport import MqttTransport, RestTransport, DEFAULT_COMMAND_TOPIC
+
+HEADER = {'Authorization': 'Bearer test'}
+
+
+@pytest.fixture
+def house():
+    hass = FakeHass()
+    api_address = hass.start()
+    broker = FakeBroker()
+    bridge = FakeHassBridge(hass, broker)
+    bridge.start()
+    client = broker.client()
+    client.connect()
+    transport = MqttTransport(client, RestTransport(HEADER, api_address, 2))
+    steward = SnipsHomeManager('test', HEADER, api_address, 2, warm_up=False, transport=transport)
+    steward.state_mirror = HassStateMirror(steward)
+    assert steward.state_mirror.start()
+    yield hass, broker, bridge, client, steward
+    steward.state_mirror.stop()
+    bridge.stop()
+    hass.stop()
+
+
+def test_command_is_published_on_the_command_topic(house):
+    hass, broker, bridge, client, steward = house
+    steward.light_on('kitchen')
+    topic = DEFAULT_COMMAND_TOPIC + '/light/turn_on'
+    payloads = [json.loads(payload.decode('utf-8')) for sent, payload in broker.messages if sent == topic]
+    assert payloads == [{"entity_id": ["light.kitchen_light"]}]
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'on')
+
+
+def test_statestream_update_reaches_the_mirror(house):
+    hass, broker, bridge, client, steward = house
+    mirror = steward.state_mirror
+    assert wait_until(lambda: mirror.known_states() is not None)
+    hass.set_state('light.bedroom_light', 'on', {'brightness': 10})
+    assert wait_until(lambda: (mirror.known('light.bedroom_light') or {}).get('state') == 'on')
+    assert mirror.known('light.bedroom_light')['attributes']['brightness'] == 10
+
+
+def test_calls_fail_while_disconnected(house):
+    hass, broker, bridge, client, steward = house
+    broker.disconnect_all()
+    with pytest.raises(HassUnavailableError):
+        steward.light_on('kitchen')
+    assert steward.state_mirror.known_states() is None
+
+
+def test_states_reload_after_reconnect(house):
+    hass, broker, bridge, client, steward = house
+    mirror = steward.state_mirror
+    broker.disconnect_all()
+    # Missed by the mirror, nothing is streamed while disconnected
+    hass.set_state('light.bathroom_light', 'on', {'brightness': 20})
+    bridge.client.connect()
+    client.connect()
+    assert wait_until(lambda: mirror.known_states() is not None)
+    assert mirror.known('light.bathroom_light')['state'] == 'on'
+    steward.light_off('bathroom')
+    assert wait_until(lambda: hass.state('light.bathroom_light')['state'] == 'off')
+
+
+def test_qos_1_call_returns_once_the_broker_has_it():
+    hass = FakeHass()
+    api_address = hass.start()
+    broker = FakeBroker(latency=0.05)
+    client = broker.client()
+    client.connect()
+    transport = MqttTransport(client, RestTransport(HEADER, api_address, 1), qos=1)
+    try:
+        response = transport.call_service('light/turn_on', '{"entity_id": "light.kitchen_light"}', 1.0)
+        assert response.status_code == 200
+        assert broker.messages == [(DEFAULT_COMMAND_TOPIC + '/light/turn_on', b'{"entity_id": "light.kitchen_light"}')]
+    finally:
+        hass.stop()
@@ -0,0 +1,117 @@
+import os
+import pstats
+import time
+
+from conftest import wait_until
+from fake_mqtt import FakeBroker
+from profiler import SamplingProfiler, pstats_of
+
+TOPIC = 'homemanager/profile'
+
+
+class Steward(object):
+    """
+    Stands for the SnipsHomeManager watched by the profiler
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def light_on(self, room):
+        self.calls += 1
+        time.sleep(0.03)
+        return room
+
+    def light_on_all(self):
+        # A call made inside another one is not counted
+        return self.light_on('kitchen')
+
+    def _private(self):
+        return 'private'
+
+
+def profiler_of(tmp_path, *targets):
+    profiler = SamplingProfiler(str(tmp_path / 'profiles'), interval=0.001)
+    for target in targets:
+        profiler.watch(target)
+    return profiler
+
+
+def test_pstats_of_counts_the_samples():
+    main, light_on = ('action.py', 1, 'main'), ('steward.py', 10, 'light_on')
+    stats = pstats_of({(main, light_on): [3, 0.3], (main,): [1, 0.1]})
+    calls, primitive, own, cumulated, callers = stats[main]
+    assert (calls, primitive, callers) == (4, 4, {})
+    assert (round(own, 6), round(cumulated, 6)) == (0.1, 0.4)
+    calls, primitive, own, cumulated, callers = stats[light_on]
+    assert (calls, primitive, round(own, 6), round(cumulated, 6)) == (3, 3, 0.3, 0.3)
+    assert list(callers) == [main]
+    assert callers[main][:2] == (3, 3)
+
+
+def test_stop_without_samples_writes_nothing(tmp_path):
+    steward = Steward()
+    profiler = profiler_of(tmp_path, steward)
+    assert profiler.stop() == ()
+    profiler.start(5)
+    assert 'light_on' in vars(steward)
+    assert profiler.stop() == ()
+    assert not profiler.armed
+    assert 'light_on' not in vars(steward)
+    assert not os.path.exists(str(tmp_path / 'profiles'))
+
+
+def test_calls_are_profiled_then_written(tmp_path):
+    steward = Steward()
+    profiler = profiler_of(tmp_path, steward)
+    profiler.start(2)
+    assert profiler.armed
+    # Only the public methods are wrapped
+    assert sorted(name for name in vars(steward) if name != 'calls') == ['light_on', 'light_on_all']
+    assert steward.light_on_all() == 'kitchen'
+    assert profiler.armed
+    assert steward.light_on('bedroom') == 'bedroom'
+    assert steward.calls == 2
+    # Stopped by itself after the second call
+    assert not profiler.armed
+    assert sorted(vars(steward)) == ['calls']
+    written = sorted(os.listdir(str(tmp_path / 'profiles')))
+    assert [os.path.splitext(name)[1] for name in written] == ['.folded', '.pstats']
+    pstats_path, folded_path = [str(tmp_path / 'profiles' / name) for name in reversed(written)]
+    functions = dict((function, stats) for (path, line, function), stats in pstats.Stats(pstats_path).stats.items())
+    assert functions['light_on'][0] > functions['light_on_all'][0] > 0
+    with open(folded_path) as f:
+        lines = f.read().splitlines()
+    assert any(';light_on_all (test_profiler.py:24);light_on (test_profiler.py:19)' in line for line in lines)
+    assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+    # The wrappers of the profiler are left out of the stacks
+    assert not any(' (profiler.py:' in line for line in lines)
+
+
+def test_start_again_begins_a_new_profile(tmp_path):
+    steward = Steward()
+    profiler = profiler_of(tmp_path, steward)
+    profiler.start(1)
+    profiler.start(2)
+    steward.light_on('kitchen')
+    assert profiler.armed
+    steward.light_on('kitchen')
+    assert not profiler.armed
+    assert len(os.listdir(str(tmp_path / 'profiles'))) == 2
+
+
+def test_profiling_is_started_over_mqtt(tmp_path):
+    steward = Steward()
+    profiler = profiler_of(tmp_path, steward)
+    broker = FakeBroker()
+    listener = broker.client()
+    profiler.listen(listener, TOPIC)
+    listener.connect()
+    publisher = broker.client()
+    publisher.connect()
+    publisher.publish(TOPIC, b'many')
+    publisher.publish(TOPIC, b'3')
+    assert wait_until(lambda: profiler.armed)
+    steward.light_on('kitchen')
+    publisher.publish(TOPIC, b'0')
+    assert wait_until(lambda: not profiler.armed)
+    assert len(os.listdir(str(tmp_path / 'profiles'))) == 2
@@ -0,0 +1,111 @@
+import time
+
+import pytest
+
+from conftest import wait_until
+from fake_hass import DEFAULT_STATES, FakeHass
+from hass_state import HassStateMirror
+from reconcile import StateReconciler
+from snips_home_manager import ALL_ENTITIES, SnipsHomeManager
+
+KITCHEN = 'light.kitchen_light'
+BEDROOM = 'light.bedroom_light'
+
+
+def light(entity_id, state, brightness=None):
+    attributes = {'brightness': brightness} if brightness is not None else {}
+    return {'entity_id': entity_id, 'state': state, 'attributes': attributes}
+
+
+@pytest.fixture
+def mirror():
+    mirror = HassStateMirror(None)
+    for state in DEFAULT_STATES:
+        mirror.update(state)
+    mirror.set_streaming(True)
+    return mirror
+
+
+def test_calls_that_change_nothing_are_dropped(mirror):
+    reconciler = StateReconciler(mirror)
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == []
+    assert reconciler.changing('light/turn_off', [KITCHEN, BEDROOM], {}) == []
+    assert reconciler.changing('light/turn_on', [KITCHEN, BEDROOM], {}) == [KITCHEN, BEDROOM]
+
+
+def test_brightness_is_compared_with_the_state(mirror):
+    reconciler = StateReconciler(mirror)
+    mirror.update(light(KITCHEN, 'on', 102))
+    assert reconciler.changing('light/turn_on', KITCHEN, {'brightness_pct': 40}) == []
+    assert reconciler.changing('light/turn_on', KITCHEN, {'brightness': 102}) == []
+    assert reconciler.changing('light/turn_on', KITCHEN, {'brightness_pct': 50}) == KITCHEN
+
+
+def test_data_that_can_not_be_checked_is_sent(mirror):
+    reconciler = StateReconciler(mirror)
+    mirror.update(light(KITCHEN, 'on', 102))
+    assert reconciler.changing('light/turn_on', KITCHEN, {'color_name': 'blue'}) == KITCHEN
+    assert reconciler.changing('light/toggle', BEDROOM, {}) == BEDROOM
+
+
+def test_call_in_flight_is_not_dropped(mirror):
+    reconciler = StateReconciler(mirror)
+    assert reconciler.changing('light/turn_on', KITCHEN, {}) == KITCHEN
+    # Hass has not reported the light on yet, the mirror still says off
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == KITCHEN
+    # The state of the first call does not confirm the second one
+    mirror.update(light(KITCHEN, 'on'))
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == KITCHEN
+    mirror.update(light(KITCHEN, 'off'))
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == []
+
+
+def test_unconfirmed_entity_is_trusted_again_after_the_timeout(mirror):
+    reconciler = StateReconciler(mirror, confirm_timeout=0.05)
+    assert reconciler.changing('light/turn_on', KITCHEN, {}) == KITCHEN
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == KITCHEN
+    time.sleep(0.05)
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == []
+
+
+def test_all_is_narrowed_to_the_entities_it_changes(mirror):
+    reconciler = StateReconciler(mirror)
+    mirror.update(light(KITCHEN, 'on'))
+    assert reconciler.changing('light/turn_off', ALL_ENTITIES, {}) == [KITCHEN]
+    mirror.update(light(KITCHEN, 'off'))
+    assert reconciler.changing('light/turn_off', ALL_ENTITIES, {}) == []
+    # Every light changes, "all" is shorter
+    assert reconciler.changing('light/turn_on', ALL_ENTITIES, {}) == ALL_ENTITIES
+
+
+def test_all_is_sent_when_the_states_are_not_trusted(mirror):
+    reconciler = StateReconciler(mirror)
+    mirror.set_streaming(False)
+    mirror.ttl = 0
+    assert reconciler.changing('light/turn_off', ALL_ENTITIES, {}) == ALL_ENTITIES
+    assert reconciler.changing('light/turn_off', KITCHEN, {}) == KITCHEN
+
+
+def test_scene_is_narrowed_to_the_entities_it_changes(mirror):
+    reconciler = StateReconciler(mirror)
+    mirror.update(light(BEDROOM, 'on', 102))
+    scene = {KITCHEN: {'state': 'off'}, BEDROOM: {'state': 'on', 'brightness': 102},
+             'light.bathroom_light': {'state': 'on', 'brightness': 255}}
+    assert reconciler.changing_scene(scene) == {'light.bathroom_light': {'state': 'on', 'brightness': 255}}
+    # Sent but not confirmed yet
+    assert reconciler.changing_scene(scene) == {'light.bathroom_light': {'state': 'on', 'brightness': 255}}
+
+
+def test_steward_skips_the_calls_that_change_nothing():
+    hass = FakeHass()
+    steward = SnipsHomeManager('test', {'Authorization': 'Bearer test'}, hass.start(), 2, warm_up=False)
+    steward.state_mirror = HassStateMirror(steward)
+    assert steward.state_mirror.start()
+    steward.reconciler = StateReconciler(steward.state_mirror)
+    assert wait_until(lambda: steward.state_mirror.known_states() is not None)
+    steward.light_off_all()
+    steward.light_off('kitchen')
+    steward.light_on('kitchen')
+    steward.state_mirror.stop()
+    hass.stop()
+    assert [path for method, path, body in hass.calls if method == 'POST'] == ['/api/services/light/turn_on']
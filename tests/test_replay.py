@@ -0,0 +1,70 @@
+import random
+import time
+
+import pytest
+
+from conftest import home_manager
+from fake_hass import FakeHass
+from fake_hermes import FakeHermes, IntentMessage
+from replay import IntentRecorder, Replayer, read_recording
+
+ARRIVE_HOME = 'LLUWE19:arriveHome'
+GIVE_ANSWER = 'LLUWE19:giveAnswer'
+SESSIONS = 3
+
+# What the action says along an arrive conversation
+SENTENCES = [
+    ('continue', "welcome home. would you like the lights on"),
+    ('continue', "okay. what color do you want the light"),
+    ('continue', "okay. how bright do you want the light"),
+    ('continue', "okay. did you want the TV on"),
+    ('end', "okay. welcome home"),
+]
+
+
+@pytest.fixture
+def recording(tmp_path):
+    """
+    Arrive conversations of several satellites at once, their intents interleaved
+    """
+    path = str(tmp_path / 'intents.jsonl.gz')
+    recorder = IntentRecorder(lambda hermes, intent_message: None, path)
+    steps = [(ARRIVE_HOME, {}), (GIVE_ANSWER, {'answer': ['yes']}), ('LLUWE19:setColor', {'color': ['blue']}),
+             ('setBrightness', {'percent': [40.0]}), (GIVE_ANSWER, {'answer': ['no']})]
+    for name, slots in steps:
+        for session in range(SESSIONS):
+            recorder(None, IntentMessage(name, 'session-{}'.format(session), 'site-{}'.format(session), slots))
+    recorder.close()
+    return path
+
+
+def test_recording_is_read_back(recording):
+    messages = read_recording(recording)
+    assert len(messages) == 5 * SESSIONS
+    offset, first = messages[0]
+    assert (first.intent.intent_name, first.session_id, first.site_id) == (ARRIVE_HOME, 'session-0', 'site-0')
+    offset, color = messages[2 * SESSIONS]
+    assert color.slots.color.first().value == 'blue'
+
+
+# More workers than conversations, several could pick the intents of the same session
+@pytest.mark.parametrize('concurrency', [1, 8])
+def test_conversations_are_replayed_in_order(recording, concurrency):
+    hass = FakeHass(latency=0.002, jitter=0.002)
+    hass.start()
+    hermes = FakeHermes()
+    callback = home_manager(hass.api_address).master_intent_callback
+
+    def handle(hermes, intent_message):
+        # Intents of a session reaching the action at slightly different times
+        time.sleep(random.uniform(0, 0.002))
+        callback(hermes, intent_message)
+
+    replayer = Replayer(handle, hermes, speed=0, concurrency=concurrency)
+    replayer.replay(read_recording(recording))
+    hass.stop()
+    assert len(replayer.latencies) == 5 * SESSIONS
+    for session in range(SESSIONS):
+        session_id = 'session-{}'.format(session)
+        said = [(kind, text) for kind, said_to, text, _ in hermes.published if said_to == session_id]
+        assert said == SENTENCES
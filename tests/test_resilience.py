@@ -0,0 +1,120 @@
+import time
+import timeit
+
+import pytest
+
+from conftest import action_module, home_manager
+from fake_hass import FakeHass
+from fake_hermes import FakeHermes, IntentMessage
+from resilience import CircuitBreaker, HassUnavailableError, RetryPolicy
+from snips_home_manager import SnipsHomeManager
+
+HEADER = {'Authorization': 'Bearer test'}
+
+
+@pytest.fixture
+def hass():
+    hass = FakeHass()
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+def requests_made(hass):
+    return len([call for call in hass.calls if call[0] in ('GET', 'POST')])
+
+
+def test_retry_delays_grow_up_to_the_longest_backoff():
+    retry = RetryPolicy(retries=3, backoff=0.1, max_backoff=0.3)
+    for _ in range(100):
+        assert 0 <= retry.delay(1) <= 0.1
+        assert 0 <= retry.delay(2) <= 0.2
+        assert 0 <= retry.delay(10) <= 0.3
+
+
+def test_breaker_opens_then_lets_a_trial_call_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    time.sleep(0.05)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # A single trial call at a time
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.05)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_success_resets_the_failures_in_a_row():
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_reads_are_retried(hass):
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False, retries=2)
+    hass.failure_rate = 1
+    with pytest.raises(HassUnavailableError):
+        steward.fetch_states()
+    assert requests_made(hass) == 3
+
+
+def test_toggles_are_not_retried(hass):
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False, retries=2)
+    hass.failure_rate = 1
+    with pytest.raises(HassUnavailableError):
+        steward.send('light/toggle', 'light.kitchen_light', {})
+    assert requests_made(hass) == 1
+
+
+def test_retries_stay_within_the_timeout(hass):
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False, timeout=0.3, retries=5)
+    hass.latency = 0.5
+    start = timeit.default_timer()
+    with pytest.raises(HassUnavailableError):
+        steward.fetch_states()
+    assert timeit.default_timer() - start < 0.5
+
+
+def test_open_breaker_fails_without_calling_hass(hass):
+    breaker = CircuitBreaker(failure_threshold=1)
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False, retries=0, breaker=breaker)
+    hass.failure_rate = 1
+    with pytest.raises(HassUnavailableError):
+        steward.fetch_states()
+    hass.failure_rate = 0
+    with pytest.raises(HassUnavailableError):
+        steward.fetch_states()
+    assert requests_made(hass) == 1
+
+
+def test_refused_token_closes_the_breaker_after_a_trial(hass):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False, retries=0, breaker=breaker)
+    breaker.record_failure()
+    hass.token = 'Bearer other'
+    with pytest.raises(HassUnavailableError):
+        steward.fetch_states()
+    # Hass answered, it is only the token
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_user_is_told_when_the_breaker_is_open(hass):
+    action = home_manager(hass.api_address)
+    hermes = FakeHermes()
+    for _ in range(action.steward.breaker.failure_threshold):
+        action.steward.breaker.record_failure()
+    before = requests_made(hass)
+    action.master_intent_callback(hermes, IntentMessage('turnOn', 'session', slots={'house_room': ['kitchen']}))
+    assert hermes.published == [('end', 'session', action_module().SENTENCE_HASS_UNAVAILABLE, None)]
+    assert requests_made(hass) == before
@@ -0,0 +1,121 @@
+import pytest
+
+from conftest import wait_until
+from fake_hass import FakeHass
+from hass_state import HassStateMirror
+from scenes import HomeScenes
+from snips_home_manager import ALL_ENTITIES, SnipsHomeManager, TV_ENTITY
+from transport import TransportResponse
+
+HEADER = {'Authorization': 'Bearer test'}
+LIGHTS = ['light.bathroom_light', 'light.bedroom_light', 'light.kitchen_light', 'light.living_room_light']
+
+
+@pytest.fixture
+def hass():
+    hass = FakeHass()
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+@pytest.fixture
+def steward(hass):
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False)
+    steward.state_mirror = HassStateMirror(steward)
+    assert steward.state_mirror.start()
+    assert wait_until(lambda: steward.state_mirror.known_states() is not None)
+    yield steward
+    steward.state_mirror.stop()
+
+
+def service_calls(hass):
+    return [(path, body) for method, path, body in hass.calls if method == 'POST']
+
+
+def test_outcome_ignores_the_light_settings_when_off():
+    assert HomeScenes.outcome(False, 'blue', 40, True) == (False, None, None, True)
+    assert HomeScenes.outcome(True, 'blue', 40, 0) == (True, 'blue', 40, False)
+
+
+def test_outcome_is_applied_as_one_scene(hass, steward):
+    HomeScenes(steward).activate(True, 'blue', 40, True)
+    calls = service_calls(hass)
+    assert [path for path, body in calls] == ['/api/services/scene/apply']
+    entities = calls[0][1]['entities']
+    assert sorted(entities) == sorted(LIGHTS + [TV_ENTITY])
+    assert entities['light.kitchen_light'] == {'state': 'on', 'color_name': 'blue', 'brightness': 102}
+    assert hass.state('light.kitchen_light')['state'] == 'on'
+    assert hass.state(TV_ENTITY)['state'] == 'on'
+
+
+def test_scene_is_compiled_again_when_the_lights_change(hass, steward):
+    scenes = HomeScenes(steward)
+    outcome = scenes.outcome(True, None, None, False)
+    first = scenes.scene(outcome)
+    assert scenes.scene(outcome) is first
+    hass.set_state('light.garage_light', 'off')
+    assert wait_until(lambda: steward.state_mirror.known('light.garage_light') is not None)
+    assert 'light.garage_light' in scenes.scene(outcome)
+
+
+def test_defined_scene_replaces_the_compiled_one(hass, steward):
+    scenes = HomeScenes(steward)
+    outcome = scenes.outcome(False, None, None, False)
+    scenes.define(outcome, {'light.kitchen_light': {'state': 'on'}})
+    scenes.activate(False, None, None, False)
+    assert service_calls(hass) == [('/api/services/scene/apply',
+                                    {'entities': {'light.kitchen_light': {'state': 'on'}}})]
+
+
+def test_unknown_lights_are_targeted_with_all(hass):
+    steward = SnipsHomeManager('test', HEADER, hass.api_address, 2, warm_up=False)
+    HomeScenes(steward).activate(True, None, 40, False)
+    calls = sorted(service_calls(hass))
+    assert calls == [('/api/services/light/turn_on', {'entity_id': ALL_ENTITIES, 'brightness_pct': 40}),
+                     ('/api/services/switch/turn_off', {'entity_id': [TV_ENTITY]})]
+
+
+class RefusingSteward(object):
+    """
+    Hass without scene/apply
+    """
+    state_mirror = None
+    entity_index = None
+
+    def __init__(self):
+        self.scenes = 0
+        self.batches = []
+
+    def apply_scene(self, entities):
+        self.scenes += 1
+        return TransportResponse(400)
+
+    def send_batch(self, calls):
+        self.batches.append(sorted(calls))
+        return []
+
+
+def test_service_calls_are_used_when_scene_apply_is_refused():
+    steward = RefusingSteward()
+    scenes = HomeScenes(steward)
+    entities = {'light.kitchen_light': {'state': 'on', 'brightness': 10}, TV_ENTITY: {'state': 'off'}}
+    scenes.apply(entities)
+    scenes.apply(entities)
+    assert steward.scenes == 1
+    assert steward.batches == 2 * [[('light/turn_on', 'light.kitchen_light', {'brightness': 10}),
+                                    ('switch/turn_off', TV_ENTITY, {})]]
+
+
+def test_snapshot_puts_the_lights_back():
+    states = [
+        {'entity_id': 'light.kitchen_light', 'state': 'on',
+         'attributes': {'brightness': 80, 'color_mode': 'hs', 'hs_color': [30, 50], 'rgb_color': [1, 2, 3]}},
+        {'entity_id': 'light.bedroom_light', 'state': 'off', 'attributes': {'brightness': None}},
+        {'entity_id': 'light.broken_light', 'state': 'unavailable', 'attributes': {}},
+        {'entity_id': TV_ENTITY, 'state': 'on', 'attributes': {}},
+    ]
+    assert HomeScenes.snapshot(states) == {
+        'light.kitchen_light': {'state': 'on', 'brightness': 80, 'hs_color': [30, 50]},
+        'light.bedroom_light': {'state': 'off'},
+    }
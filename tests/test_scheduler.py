@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+
+from conftest import wait_until
+from fake_hass import FakeHass
+from resilience import HassOverloadedError
+from scheduler import HassScheduler, INTERACTIVE, NORMAL, BULK
+from snips_home_manager import SnipsHomeManager
+
+
+class Calls(object):
+    """
+    Runs requests through the scheduler in threads, recording the order they are sent in
+    """
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.sent = []
+        self.results = {}
+        self.threads = []
+        self.release = threading.Event()
+
+    def block(self):
+        # Holds a connection until released
+        self.start('blocker', NORMAL, None, wait=True)
+        assert wait_until(lambda: self.sent == ['blocker'])
+
+    def start(self, name, level, key, wait=False):
+        def function():
+            self.sent.append(name)
+            if wait:
+                self.release.wait()
+            return name
+
+        def run():
+            try:
+                self.results[name] = self.scheduler.run(level, key, function, 5)
+            except HassOverloadedError as e:
+                self.results[name] = e
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join(2)
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = HassScheduler(slots=2, queue_size=2)
+    yield scheduler
+    scheduler.close()
+
+
+def queued(scheduler, name):
+    return scheduler.stats()[name]['queued']
+
+
+def test_identical_requests_share_one_call(scheduler):
+    calls = Calls(scheduler)
+    calls.block()
+    calls.start('first', NORMAL, 'states')
+    assert wait_until(lambda: queued(scheduler, 'normal') == 1)
+    calls.start('second', NORMAL, 'states')
+    assert wait_until(lambda: scheduler.merged[NORMAL] == 1)
+    calls.join()
+    assert calls.sent == ['blocker', 'first']
+    assert calls.results['second'] == 'first'
+
+
+def test_interactive_request_takes_over_a_merged_request(scheduler):
+    calls = Calls(scheduler)
+    calls.block()
+    calls.start('bulk', BULK, 'states')
+    assert wait_until(lambda: queued(scheduler, 'bulk') == 1)
+    calls.start('interactive', INTERACTIVE, 'states')
+    assert wait_until(lambda: 'bulk' in calls.sent)
+    assert scheduler.merged[INTERACTIVE] == 1
+    calls.join()
+    assert calls.results['interactive'] == 'bulk'
+
+
+def test_full_queue_sheds_normal_requests_only(scheduler):
+    calls = Calls(scheduler)
+    calls.block()
+    calls.start('queued 1', NORMAL, None)
+    calls.start('queued 2', NORMAL, None)
+    assert wait_until(lambda: queued(scheduler, 'normal') == 2)
+    with pytest.raises(HassOverloadedError):
+        scheduler.run(NORMAL, None, lambda: 'shed', 5)
+    assert scheduler.shed[NORMAL] == 1
+    # The connection kept for interactive requests is still free
+    assert scheduler.run(INTERACTIVE, None, lambda: 'interactive', 5) == 'interactive'
+    calls.join()
+    assert calls.results['queued 1'] == 'queued 1'
+    assert calls.results['queued 2'] == 'queued 2'
+
+
+def test_request_waiting_too_long_is_shed(scheduler):
+    calls = Calls(scheduler)
+    calls.block()
+    with pytest.raises(HassOverloadedError):
+        scheduler.run(BULK, None, lambda: 'late', 0.05)
+    assert scheduler.shed[BULK] == 1
+    calls.join()
+
+
+def test_most_urgent_class_goes_first():
+    scheduler = HassScheduler(slots=1)
+    calls = Calls(scheduler)
+    calls.block()
+    calls.start('bulk', BULK, None)
+    assert wait_until(lambda: queued(scheduler, 'bulk') == 1)
+    calls.start('normal', NORMAL, None)
+    assert wait_until(lambda: queued(scheduler, 'normal') == 1)
+    calls.start('interactive', INTERACTIVE, None)
+    assert wait_until(lambda: queued(scheduler, 'interactive') == 1)
+    calls.join()
+    scheduler.close()
+    assert calls.sent == ['blocker', 'interactive', 'normal', 'bulk']
+
+
+def test_writes_are_not_merged_past_a_conflicting_write():
+    hass = FakeHass()
+    api_address = hass.start()
+    steward = SnipsHomeManager('test', {'Authorization': 'Bearer test'}, api_address, 1, warm_up=False)
+    steward.scheduler = HassScheduler(slots=1)
+    calls = Calls(steward.scheduler)
+    calls.block()
+    commands = []
+    for number, command in enumerate((steward.light_on, steward.light_off, steward.light_on)):
+        thread = threading.Thread(target=command, args=('kitchen',))
+        thread.start()
+        commands.append(thread)
+        assert wait_until(lambda: queued(steward.scheduler, 'interactive') == number + 1)
+    calls.join()
+    for thread in commands:
+        thread.join(2)
+    steward.scheduler.close()
+    hass.stop()
+    assert [path for method, path, body in hass.calls if path.startswith('/api/services/')] == [
+        '/api/services/light/turn_on', '/api/services/light/turn_off', '/api/services/light/turn_on']
+    assert hass.state('light.kitchen_light')['state'] == 'on'
+    assert steward.scheduler.merged[INTERACTIVE] == 0
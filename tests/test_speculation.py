@@ -0,0 +1,144 @@
+import threading
+import timeit
+from collections import namedtuple
+
+import pytest
+
+from conftest import action_module, home_manager, wait_until
+from fake_hass import FakeHass
+from fake_hermes import FakeHermes, IntentMessage
+
+ARRIVE_HOME = 'LLUWE19:arriveHome'
+GIVE_ANSWER = 'LLUWE19:giveAnswer'
+
+SessionEnded = namedtuple('SessionEnded', ('session_id', 'site_id'))
+
+
+@pytest.fixture
+def hass():
+    hass = FakeHass()
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+def say(action, hermes, session_id, intent_name, site_id='default', **slots):
+    action.master_intent_callback(hermes, IntentMessage(intent_name, session_id, site_id, slots))
+
+
+def service_calls(hass):
+    return [path for method, path, body in hass.calls if path.startswith('/api/services/')]
+
+
+def test_answers_are_carried_out_as_they_are_given(hass):
+    action = home_manager(hass.api_address)
+    hermes = FakeHermes()
+    say(action, hermes, 'session', ARRIVE_HOME)
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['yes'])
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'on')
+    say(action, hermes, 'session', 'LLUWE19:setColor', color=['blue'])
+    say(action, hermes, 'session', 'setBrightness', percent=[40.0])
+    assert wait_until(lambda: hass.state('light.kitchen_light')['attributes'].get('brightness') == 102)
+    hass.reset()
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['yes'])
+    # Only the tv was left
+    assert service_calls(hass) == ['/api/services/switch/turn_on']
+    assert hermes.published[-1][:3] == ('end', 'session', "okay. welcome home")
+
+
+def test_nothing_is_carried_out_before_the_end_when_off(hass):
+    action = home_manager(hass.api_address, speculative_conversations='false')
+    hermes = FakeHermes()
+    say(action, hermes, 'session', ARRIVE_HOME)
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['yes'])
+    say(action, hermes, 'session', 'LLUWE19:setColor', color=['blue'])
+    say(action, hermes, 'session', 'setBrightness', percent=[40.0])
+    assert service_calls(hass) == []
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['no'])
+    assert service_calls(hass) == ['/api/services/scene/apply']
+    assert hass.state('light.kitchen_light')['state'] == 'on'
+
+
+def test_answers_are_undone_when_the_session_ends_early(hass):
+    hass.set_state('light.bedroom_light', 'on', {'brightness': 20})
+    action = home_manager(hass.api_address)
+    hermes = FakeHermes()
+    say(action, hermes, 'session', ARRIVE_HOME)
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['no'])
+    assert wait_until(lambda: hass.state('light.bedroom_light')['state'] == 'off')
+    action.session_ended(hermes, SessionEnded('session', 'default'))
+    assert wait_until(lambda: hass.state('light.bedroom_light')['state'] == 'on')
+    assert hass.state('light.bedroom_light')['attributes']['brightness'] == 20
+    assert hass.state('light.kitchen_light')['state'] == 'off'
+
+
+def test_new_conversation_on_the_satellite_undoes_the_previous_one(hass):
+    action = home_manager(hass.api_address)
+    hermes = FakeHermes()
+    say(action, hermes, 'first', ARRIVE_HOME)
+    say(action, hermes, 'first', GIVE_ANSWER, answer=['yes'])
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'on')
+    say(action, hermes, 'second', ARRIVE_HOME)
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'off')
+    assert action.conversations.get('first') is None
+
+
+def test_commands_tell_the_user_when_hass_fails(hass):
+    action = home_manager(hass.api_address, hass_timeout=0.3)
+    hermes = FakeHermes()
+    hass.failure_rate = 1
+    say(action, hermes, 'session', 'turnOn', house_room=['kitchen'])
+    assert hermes.published == [('end', 'session', action_module().SENTENCE_HASS_UNAVAILABLE, None)]
+
+
+def test_hung_speculation_does_not_hold_the_end_of_the_conversation(hass):
+    action = home_manager(hass.api_address, hass_timeout=0.3)
+    hermes = FakeHermes()
+    say(action, hermes, 'session', ARRIVE_HOME)
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['no'])
+    hung = threading.Event()
+    action.speculate(action.conversations.get('session'), hung.wait)
+    start = timeit.default_timer()
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['yes'])
+    assert timeit.default_timer() - start < 2
+    hung.set()
+    assert hermes.published[-1][:3] == ('end', 'session', "okay. welcome home")
+    # Carried out again as a scene
+    assert hass.state('switch.living_room_tv')['state'] == 'on'
+    assert hass.state('light.kitchen_light')['state'] == 'off'
+
+
+def test_satellites_speculate_in_parallel(hass):
+    action = home_manager(hass.api_address)
+    hermes = FakeHermes()
+    sites = ['site-{}'.format(number) for number in range(20)]
+    busy = sites[0]
+    free = next(site for site in sites if action._speculation._lanes_for(site) != action._speculation._lanes_for(busy))
+    say(action, hermes, 'busy', ARRIVE_HOME, busy)
+    hung = threading.Event()
+    action.speculate(action.conversations.get('busy'), hung.wait)
+    say(action, hermes, 'free', ARRIVE_HOME, free)
+    say(action, hermes, 'free', GIVE_ANSWER, free, answer=['yes'])
+    # Not waiting behind the other satellite
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'on')
+    hung.set()
+
+
+def test_answers_are_undone_when_hass_fails_at_the_end(hass):
+    action = home_manager(hass.api_address, hass_timeout=0.3)
+    hermes = FakeHermes()
+    say(action, hermes, 'session', ARRIVE_HOME)
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['yes'])
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'on')
+    # Hold the undo until Hass is back
+    hung = threading.Event()
+    action.speculate(action.conversations.get('session'), hung.wait)
+    say(action, hermes, 'session', 'LLUWE19:setColor', color=['blue'])
+    say(action, hermes, 'session', 'setBrightness', percent=[40.0])
+    hass.failure_rate = 1
+    say(action, hermes, 'session', GIVE_ANSWER, answer=['yes'])
+    assert hermes.published[-1][:3] == ('end', 'session', action_module().SENTENCE_HASS_UNAVAILABLE)
+    assert action.conversations.get('session') is None
+    hass.failure_rate = 0
+    hung.set()
+    assert wait_until(lambda: hass.state('light.kitchen_light')['state'] == 'off')
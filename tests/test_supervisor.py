@@ -0,0 +1,130 @@
+import io
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import supervisor
+from conftest import wait_until
+from supervisor import IntentSupervisor, SiteShard, shard_of
+
+SITES = ['default', 'kitchen', 'bedroom', 'living-room', 'garage', 'annex-hall', '']
+
+
+def test_every_site_has_one_shard():
+    for workers in (1, 2, 3, 8):
+        shards = [SiteShard(index, workers) for index in range(workers)]
+        for site_id in SITES:
+            assert 0 <= shard_of(site_id, workers) < workers
+            assert [shard.owns(site_id) for shard in shards].count(True) == 1
+    # Unlike hash() crc32 is the same in every process
+    assert shard_of('kitchen', 8) == shard_of(u'kitchen', 8) == 4
+    assert shard_of(None, 3) == shard_of('', 3)
+
+
+class Message(object):
+    def __init__(self, site_id):
+        self.site_id = site_id
+
+
+def test_filter_keeps_the_sites_of_the_shard():
+    handled = []
+    shard = SiteShard(shard_of('kitchen', 2), 2)
+    callback = shard.filter(lambda hermes, message: handled.append(message.site_id) or 'handled')
+    others = [site_id for site_id in SITES if not shard.owns(site_id)]
+    assert others
+    assert callback(None, Message('kitchen')) == 'handled'
+    for site_id in others:
+        assert callback(None, Message(site_id)) is None
+    assert handled == ['kitchen']
+
+
+def test_file_name():
+    shard = SiteShard(1, 4)
+    path = os.path.join('records', 'intents.jsonl.gz')
+    assert shard.file_name(path) == os.path.join('records', 'intents.1.jsonl.gz')
+    assert shard.file_name('metrics') == 'metrics.1'
+
+
+# Targets of the workers, forked from the test process
+
+def count_start(path):
+    def target(shard):
+        with io.open(path, 'a', encoding='utf-8') as f:
+            f.write(u'{}\n'.format(shard.index))
+    return target
+
+
+def block(shard):
+    time.sleep(60)
+
+
+def starts(path):
+    if not os.path.exists(path):
+        return []
+    with io.open(path, encoding='utf-8') as f:
+        return [int(line) for line in f]
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    monkeypatch.setattr(supervisor, 'CHECK_INTERVAL', 0.01)
+    monkeypatch.setattr(supervisor, 'RESTART_DELAY', 0.05)
+    monkeypatch.setattr(supervisor, 'MAX_RESTART_DELAY', 0.2)
+
+
+def test_worker_that_dies_is_restarted_later_each_time(delays, tmp_path):
+    path = str(tmp_path / 'starts')
+    intents = IntentSupervisor(count_start(path), 1)
+    intents._start(0)
+    next_delays = []
+    for _ in range(3):
+        assert wait_until(lambda: intents.check() == 0 and intents._restart_at[0])
+        restart_at = intents._restart_at[0]
+        next_delays.append(intents._delays[0])
+        assert wait_until(lambda: intents.check() is not None and not intents._restart_at[0])
+        assert time.time() >= restart_at
+    assert wait_until(lambda: starts(path) == [0] * 4)
+    intents.stop()
+    # Waited 0.05, then 0.1, then 0.2 and no more
+    assert next_delays == [0.1, 0.2, 0.2]
+
+
+def test_delay_goes_back_down_once_the_worker_was_stable(delays, monkeypatch, tmp_path):
+    monkeypatch.setattr(supervisor, 'STABLE_AFTER', 0)
+    intents = IntentSupervisor(count_start(str(tmp_path / 'starts')), 1)
+    for _ in range(3):
+        intents._start(0)
+        assert wait_until(lambda: intents.check() == 0 and intents._restart_at[0])
+        assert intents._delays == [0.1]
+    intents.stop()
+
+
+def test_stop_terminates_the_workers(delays):
+    intents = IntentSupervisor(block, 2)
+    intents._start(0)
+    intents._start(1)
+    assert intents.check() == 2
+    intents.stop()
+    assert not any(process.is_alive() for process in intents._processes)
+    assert intents.check() == 0
+
+
+def test_run_until_sigterm(delays, tmp_path):
+    path = str(tmp_path / 'starts')
+    intents = IntentSupervisor(count_start(path), 2)
+
+    def terminate():
+        # The handler is in place once the workers are started
+        assert wait_until(lambda: None not in intents._processes)
+        os.kill(os.getpid(), signal.SIGTERM)
+    previous = signal.getsignal(signal.SIGTERM)
+    killer = threading.Thread(target=terminate)
+    killer.start()
+    intents.run()
+    killer.join()
+    assert signal.getsignal(signal.SIGTERM) == previous
+    assert sorted(set(starts(path))) == [0, 1]
+    assert not any(process.is_alive() for process in intents._processes)
@@ -0,0 +1,135 @@
+import json
+import threading
+import timeit
+
+import pytest
+
+from conftest import wait_until
+from fake_hass import FakeHass
+from transport import TransportError, TransportResponse, WebSocketTransport, _Call
+
+HEADER = {'Authorization': 'Bearer test'}
+TURN_ON = json.dumps({"entity_id": "light.kitchen_light"})
+
+
+@pytest.fixture
+def hass():
+    hass = FakeHass(token='Bearer test')
+    hass.start()
+    yield hass
+    hass.stop()
+
+
+@pytest.fixture
+def transport(hass):
+    transport = WebSocketTransport(HEADER, hass.api_address, connect=hass.connect_websocket)
+    assert wait_until(lambda: transport.connected)
+    yield transport
+    transport.close()
+
+
+def websocket_calls(hass, kind):
+    return [message for method, path, message in hass.calls if method == 'WS' and path == kind]
+
+
+def in_background(function, *args):
+    """
+    :return: Dict, filled with the "response" or "error" of function once it returned
+    """
+    outcome = {}
+
+    def run():
+        try:
+            outcome['response'] = function(*args)
+        except TransportError as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    outcome['thread'] = thread
+    return outcome
+
+
+def test_calls_and_reads(hass, transport):
+    assert transport.call_service('light/turn_on', TURN_ON, 2).status_code == 200
+    assert hass.state('light.kitchen_light')['state'] == 'on'
+    response = transport.get('states/light.kitchen_light', 2)
+    assert response.json()['state'] == 'on'
+    assert transport.get('states/light.nowhere', 2).status_code == 404
+    assert transport.ping(2).status_code == 200
+
+
+def test_calls_waiting_are_sent_again_after_reconnecting(hass, transport):
+    hass.latency = 0.3
+    outcome = in_background(transport.call_service, 'light/turn_on', TURN_ON, 5)
+    assert wait_until(lambda: transport._sent)
+    hass.drop_websockets()
+    outcome['thread'].join(5)
+    assert outcome['response'].status_code == 200
+    # Once on the lost connection, once replayed
+    assert wait_until(lambda: len(websocket_calls(hass, 'call_service')) == 2)
+
+
+def test_toggles_are_not_sent_again(hass, transport):
+    hass.latency = 0.3
+    outcome = in_background(transport.call_service, 'light/toggle', TURN_ON, 5)
+    assert wait_until(lambda: transport._sent)
+    hass.drop_websockets()
+    outcome['thread'].join(5)
+    assert 'error' in outcome
+    # Only carried out by the lost connection
+    assert wait_until(lambda: len(websocket_calls(hass, 'call_service')) == 1)
+    assert transport.ping(2).status_code == 200
+    assert len(websocket_calls(hass, 'call_service')) == 1
+
+
+def test_calls_expire_without_an_answer(hass, transport):
+    hass.latency = 2
+    start = timeit.default_timer()
+    with pytest.raises(TransportError):
+        transport.call_service('light/turn_on', TURN_ON, 0.2)
+    assert timeit.default_timer() - start < 1
+
+
+def test_calls_expire_while_connecting(hass):
+    class Silent(object):
+        # Never asks for the token
+        def send(self, text):
+            pass
+
+        def recv(self):
+            threading.Event().wait(0.05)
+            return None
+
+        def close(self):
+            pass
+
+    transport = WebSocketTransport(HEADER, hass.api_address, connect=lambda url, timeout: Silent())
+    start = timeit.default_timer()
+    with pytest.raises(TransportError):
+        transport.ping(0.3)
+    assert timeit.default_timer() - start < 1
+    transport.close()
+
+
+def test_refused_token_answers_401_until_configured(hass):
+    transport = WebSocketTransport({'Authorization': 'Bearer wrong'}, hass.api_address,
+                                   connect=hass.connect_websocket)
+    assert wait_until(lambda: transport.refused)
+    assert transport.call_service('light/turn_on', TURN_ON, 2).status_code == 401
+    assert websocket_calls(hass, 'call_service') == []
+    transport.configure(header=HEADER)
+    assert wait_until(lambda: transport.connected)
+    assert transport.call_service('light/turn_on', TURN_ON, 2).status_code == 200
+    transport.close()
+
+
+def test_a_call_is_completed_once(transport):
+    call = _Call({"type": "ping"}, timeit.default_timer() + 1, True)
+    with transport._lock:
+        transport._calls.append(call)
+    assert transport._resolve(call, response=TransportResponse(200))
+    assert not transport._resolve(call, error=TransportError("No answer from Hass in time"))
+    assert call.response.status_code == 200
+    assert call.error is None
+    assert call not in transport._calls
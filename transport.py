@@ -0,0 +1,754 @@
+import itertools
+import json
+import logging
+import threading
+import time
+import timeit
+
+import requests as rq
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+TRANSPORTS = ('rest', 'mqtt', 'websocket')
+
+DEFAULT_STATE_TOPIC = 'homeassistant/statestream'  # base_topic of the Hass mqtt_statestream integration
+DEFAULT_COMMAND_TOPIC = 'homeassistant/command'
+DEFAULT_QOS = 0
+PUBLISH_POLL = 0.001  # Seconds between two checks that the broker received a command sent with qos 1
+RELOAD_TIMEOUT = 10  # Seconds the states may take to be read again from the fallback after reconnecting
+WEBSOCKET_TICK = 0.1  # Seconds between two checks for calls waiting too long, and the WebSocket read timeout
+CONNECT_TIMEOUT = 10  # Seconds the WebSocket may take to connect and authenticate
+RECONNECT_DELAY = 1  # Seconds between two attempts to connect the WebSocket
+# Error codes of the Hass WebSocket API -> status of the same failure through the REST API
+WEBSOCKET_ERRORS = {'unauthorized': 401, 'not_found': 404, 'invalid_format': 400, 'not_supported': 400}
+
+
+class TransportError(Exception):
+    """
+    Raised when a request could not be sent to Hass or its answer was lost, it may be sent again
+    """
+
+
+class TransportResponse(object):
+    """
+    Answer of a transport that does not speak HTTP, with the parts of a requests.Response read by the action
+    """
+    __slots__ = ('status_code', 'payload')
+
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class RestTransport(object):
+    """
+    Calls the Hass REST API. Every request goes through a single keep-alive session so that a voice command reuses
+    already open connections to Hass instead of paying a TCP handshake per call, and each service has a prepared
+    request template so that only the body is built per call.
+    """
+    name = 'rest'
+
+    def __init__(self, header, api_address, pool_size):
+        """
+        :param header: Dict, headers of every request e.g. with the "Authorization"
+        :param api_address: String, address of the Hass REST API
+        :param pool_size: Int, number of keep-alive connections kept open to Hass
+        """
+        self.header = header
+        self.api_address = api_address
+        self.pool_size = pool_size
+        self._adapter = None  # Connection pool of the session
+        self.session = self._create_session()
+        self._templates = {}  # Service -> (session, prepared request), reused for every call on that session
+
+    def _create_session(self):
+        """
+        Build the keep-alive session shared by every call to Hass, reusing the current connection pool if there is one.
+        :return: requests.Session with a connection pool of "pool_size" connections
+        """
+        if self._adapter is None:
+            self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session = rq.Session()
+        session.mount('http://', self._adapter)
+        session.mount('https://', self._adapter)
+        session.headers.update(self.header)
+        return session
+
+    def configure(self, header=None, api_address=None, pool_size=None):
+        """
+        Change the token, address or pool size, the arguments left to None are kept.
+        The open connections are only dropped when the address or the pool size change.
+        :return: Bool, True if the connections to Hass were replaced
+        """
+        new_endpoint = (api_address is not None and api_address != self.api_address or
+                        pool_size is not None and pool_size != self.pool_size)
+        if not new_endpoint and (header is None or header == self.header):
+            return False
+        if header is not None:
+            self.header = header
+        if new_endpoint:
+            self.api_address = api_address or self.api_address
+            self.pool_size = pool_size or self.pool_size
+            self._adapter = None
+        self.session = self._create_session()
+        return new_endpoint
+
+    def call_service(self, service, data, timeout):
+        """
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param data: String, JSON encoded service data
+        :param timeout: Float, seconds to wait for Hass
+        :return: requests.Response
+        :raises TransportError: When Hass could not be reached in time
+        """
+        session = self.session
+        cached = self._templates.get(service)
+        if cached is None or cached[0] is not session:
+            url = self.api_address + 'services/' + service
+            cached = (session, session.prepare_request(rq.Request('POST', url)))
+            self._templates[service] = cached
+        prepared = cached[1].copy()
+        prepared.prepare_body(data=data, files=None)
+        try:
+            return session.send(prepared, timeout=timeout)
+        except rq.RequestException as e:
+            raise TransportError(e)
+
+    def get(self, path, timeout):
+        """
+        :param path: String, path relative to the api address e.g. "states/light.kitchen_light"
+        :param timeout: Float, seconds to wait for Hass
+        :return: requests.Response
+        :raises TransportError: When Hass could not be reached in time
+        """
+        try:
+            return self.session.get(self.api_address + path, timeout=timeout)
+        except rq.RequestException as e:
+            raise TransportError(e)
+
+    def ping(self, timeout):
+        """
+        Check Hass answers, opening a pooled connection on the way
+        :return: requests.Response
+        :raises TransportError: When Hass could not be reached in time
+        """
+        return self.get('', timeout)
+
+    def follow(self, mirror):
+        """
+        :param mirror: HassStateMirror to keep current
+        :return: Bool, False as the mirror follows the REST event stream itself
+        """
+        return False
+
+
+class MqttTransport(object):
+    """
+    Sends the service calls to Hass over a long-lived MQTT connection and answers the state reads from the states
+    Hass publishes with its mqtt_statestream integration, which saves the HTTP request per command.
+    A call to "light/turn_on" is published as its JSON service data on "<command_topic>/light/turn_on", for a Hass
+    automation to carry out (see the README). With qos 1 a call returns once the broker has it, with qos 0 once it
+    was written to the connection.
+    Until the statestream is known, e.g. at startup or after the connection was lost, states are read from the
+    fallback transport when there is one.
+    """
+    name = 'mqtt'
+
+    def __init__(self, client, fallback=None, state_topic=DEFAULT_STATE_TOPIC, command_topic=DEFAULT_COMMAND_TOPIC,
+                 qos=DEFAULT_QOS):
+        """
+        :param client: paho.mqtt.client.Client, or any client with the same API, connected or about to be
+        :param fallback: RestTransport reading the states until the statestream is known, None answers from the
+                         statestream only
+        :param state_topic: String, base topic of the Hass statestream
+        :param command_topic: String, topic the service calls are published under
+        :param qos: Int, 0 or 1
+        """
+        self.client = client
+        self.fallback = fallback
+        self.state_topic = state_topic.rstrip('/')
+        self.command_topic = command_topic.rstrip('/')
+        self.qos = qos
+        self.connected = False
+        self._states = {}  # entity_id -> state dict as returned by Hass
+        self._loaded = False  # True once _states holds every entity
+        self._lock = threading.Lock()
+        self._mirror = None
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.message_callback_add(self.state_topic + '/#', self._on_state)
+        if client.is_connected():
+            self._on_connect(client, None, None, 0)
+
+    def configure(self, header=None, api_address=None, pool_size=None):
+        """
+        Pass a new token, address or pool size on to the fallback transport
+        :return: Bool, True if the connections of the fallback were replaced
+        """
+        if self.fallback is None:
+            return False
+        return self.fallback.configure(header, api_address, pool_size)
+
+    def call_service(self, service, data, timeout):
+        """
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param data: String, JSON encoded service data
+        :param timeout: Float, seconds to wait for the broker
+        :return: TransportResponse, 200 once published
+        :raises TransportError: When the broker could not be reached in time
+        """
+        if not self.connected:
+            raise TransportError("Not connected to the MQTT broker")
+        deadline = timeit.default_timer() + timeout
+        info = self.client.publish(self.command_topic + '/' + service, data, qos=self.qos)
+        if info.rc != 0:
+            raise TransportError("MQTT publish failed ({})".format(info.rc))
+        if self.qos > 0:
+            while not info.is_published():
+                if timeit.default_timer() >= deadline:
+                    raise TransportError("The MQTT broker did not acknowledge {}".format(service))
+                time.sleep(PUBLISH_POLL)
+        return TransportResponse(200, [])
+
+    def get(self, path, timeout):
+        """
+        :param path: String, "states" or "states/<entity_id>"
+        :param timeout: Float, seconds to wait for the fallback
+        :return: TransportResponse, or the response of the fallback
+        :raises TransportError: When the states are not known and can not be read from the fallback
+        """
+        with self._lock:
+            if self.connected and self._loaded:
+                if path == 'states':
+                    return TransportResponse(200, [_copy(state) for state in self._states.values()])
+                state = self._states.get(path[len('states/'):]) if path.startswith('states/') else None
+                if state is not None and state['state'] is not None:
+                    return TransportResponse(200, _copy(state))
+                if self.fallback is None:
+                    return TransportResponse(404, {"message": "Entity not found."})
+        if self.fallback is None:
+            raise TransportError("Not connected to the MQTT broker")
+        response = self.fallback.get(path, timeout)
+        if path == 'states' and response.status_code == 200:
+            self._load(response.json())
+        return response
+
+    def ping(self, timeout):
+        """
+        :return: TransportResponse, 200 while connected to the broker
+        :raises TransportError: When not connected to the broker
+        """
+        if not self.connected:
+            raise TransportError("Not connected to the MQTT broker")
+        if self.fallback is not None:
+            return self.fallback.ping(timeout)
+        return TransportResponse(200, {"message": "API running."})
+
+    def follow(self, mirror):
+        """
+        Keep a mirror current from the statestream instead of the REST event stream
+        :param mirror: HassStateMirror, None to stop
+        :return: Bool, True
+        """
+        self._mirror = mirror
+        if mirror is not None:
+            mirror.set_streaming(self.connected and self._loaded)
+        return True
+
+    def _load(self, states):
+        with self._lock:
+            self._states = dict((state['entity_id'], _copy(state)) for state in states)
+            self._loaded = self.connected
+        mirror = self._mirror
+        if mirror is not None and self.connected:
+            mirror.set_streaming(True)
+
+    def _reload(self):
+        mirror = self._mirror
+        try:
+            if mirror is not None:
+                mirror.load()
+            elif self.fallback is not None:
+                self.get('states', RELOAD_TIMEOUT)
+        except Exception as e:
+            logger.warning("(MqttTransport) Could not reload the states: %s", e)
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc != 0:
+            logger.warning("(MqttTransport) The MQTT broker refused the connection (%s)", rc)
+            return
+        client.subscribe(self.state_topic + '/#', self.qos)
+        self.connected = True
+        logger.info("(MqttTransport) Connected to the MQTT broker")
+        if self.fallback is None:
+            # The statestream is all there is to know
+            with self._lock:
+                self._loaded = True
+            if self._mirror is not None:
+                self._mirror.set_streaming(True)
+            return
+        # States may have changed while disconnected
+        reload = threading.Thread(target=self._reload, name="mqtt-transport-reload")
+        reload.daemon = True
+        reload.start()
+
+    def _on_disconnect(self, client, userdata, rc, *args):
+        self.connected = False
+        with self._lock:
+            self._loaded = False
+        mirror = self._mirror
+        if mirror is not None:
+            mirror.set_streaming(False)
+        logger.warning("(MqttTransport) Disconnected from the MQTT broker (%s)", rc)
+
+    def _on_state(self, client, userdata, message):
+        """
+        Handle "<state_topic>/<domain>/<object_id>/<state or attribute>"
+        """
+        parts = message.topic[len(self.state_topic) + 1:].split('/')
+        if len(parts) != 3:
+            return
+        domain, object_id, key = parts
+        payload = message.payload
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        entity_id = domain + '.' + object_id
+        with self._lock:
+            state = self._states.get(entity_id)
+            if state is None:
+                state = self._states[entity_id] = {"entity_id": entity_id, "state": None, "attributes": {}}
+            if key == 'state':
+                state['state'] = payload
+            else:
+                try:
+                    value = json.loads(payload)
+                except ValueError:
+                    value = payload
+                if key in ('last_changed', 'last_updated'):
+                    state[key] = value
+                else:
+                    state['attributes'][key] = value
+            # Attributes may come before the state of a new entity
+            update = _copy(state) if state['state'] is not None else None
+        mirror = self._mirror
+        if update is not None and mirror is not None:
+            mirror.update(update)
+
+
+class _Call(object):
+    """
+    A message for the WebSocket waiting for its result
+    """
+    __slots__ = ('message', 'deadline', 'replay', 'id', 'response', 'error', 'done')
+
+    def __init__(self, message, deadline, replay):
+        self.message = message
+        self.deadline = deadline
+        self.replay = replay  # Whether it may be sent again after the connection was lost
+        self.id = None  # Message id on the connection it was sent over, None until sent
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class WebSocketTransport(object):
+    """
+    Calls Hass over its WebSocket API. A single authenticated connection carries every request tagged with a message
+    id, so the calls made at once go out without waiting for each other's answer and a burst of commands costs about
+    one round trip instead of one per call. Each caller waits for the result carrying its id.
+    A background thread keeps the connection open. When it is lost the calls still waiting for their result are sent
+    again once reconnected, except toggles which may have been carried out already. When Hass refuses the token
+    every call is answered with a 401 until configure() gives another one.
+    A mirror following the states gets the "state_changed" events over the same connection.
+    """
+    name = 'websocket'
+
+    def __init__(self, header, api_address, connect=None):
+        """
+        :param header: Dict, headers of the REST API, the token is taken from its "Authorization"
+        :param api_address: String, address of the Hass REST API e.g. "http://hass:8123/api/"
+        :param connect: Function(url, timeout) -> connection with send(text), recv() returning None when nothing
+                        arrived within WEBSOCKET_TICK, and close(). connect_websocket when None
+        """
+        self.header = header
+        self.api_address = api_address
+        self.connect = connect or connect_websocket
+        self.connected = False
+        self.refused = False  # True while Hass refuses the token
+        self._connection = None
+        self._ids = itertools.count(1)
+        self._calls = []  # _Call waiting for their result, in the order they were made
+        self._sent = {}  # Message id -> _Call sent over the current connection
+        self._subscription = None  # Message id of the state_changed subscription on the current connection
+        self._reconnected = False
+        self._mirror = None
+        self._lock = threading.Lock()
+        self._configured = threading.Event()  # Set when a refused token may have been replaced
+        self._closed = False
+        self._waiting = threading.Event()  # Set while calls wait for their result, wakes the thread expiring them
+        for target, name in ((self._run, "hass-websocket"), (self._watch, "hass-websocket-expiry")):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def url(self):
+        """
+        :return: String, e.g. "ws://hass:8123/api/websocket" for "http://hass:8123/api/"
+        """
+        return 'ws' + self.api_address[len('http'):] + 'websocket'
+
+    def configure(self, header=None, api_address=None, pool_size=None):
+        """
+        Reconnect with a new token or to a new address, the calls waiting are sent again over the new connection
+        :return: Bool, True if the address changed
+        """
+        new_endpoint = api_address is not None and api_address != self.api_address
+        if not new_endpoint and (header is None or header == self.header):
+            return False
+        if header is not None:
+            self.header = header
+        if new_endpoint:
+            self.api_address = api_address
+        connection = self._connection
+        if connection is not None:
+            connection.close()
+        self._configured.set()
+        return new_endpoint
+
+    def close(self):
+        self._closed = True
+        self._configured.set()
+        self._waiting.set()
+        connection = self._connection
+        if connection is not None:
+            connection.close()
+
+    def call_service(self, service, data, timeout):
+        """
+        :param service: String, "domain/service" e.g. "light/turn_on"
+        :param data: String, JSON encoded service data
+        :param timeout: Float, seconds to wait for the result
+        :return: TransportResponse, with the status the REST API would have answered
+        :raises TransportError: When no result came in time
+        """
+        domain, name = service.split('/', 1)
+        message = {"type": "call_service", "domain": domain, "service": name, "service_data": json.loads(data)}
+        return self._request(message, timeout, replay=name != 'toggle')
+
+    def get(self, path, timeout):
+        """
+        :param path: String, "states" or "states/<entity_id>"
+        :param timeout: Float, seconds to wait for the result
+        :return: TransportResponse
+        :raises TransportError: When no result came in time
+        """
+        if path == '':
+            return self.ping(timeout)
+        response = self._request({"type": "get_states"}, timeout)
+        if path == 'states' or response.status_code != 200:
+            return response
+        entity_id = path[len('states/'):]
+        for state in response.payload:
+            if state['entity_id'] == entity_id:
+                return TransportResponse(200, state)
+        return TransportResponse(404, {"message": "Entity not found."})
+
+    def ping(self, timeout):
+        """
+        :return: TransportResponse, 200 when Hass answered
+        :raises TransportError: When Hass did not answer in time
+        """
+        return self._request({"type": "ping"}, timeout)
+
+    def follow(self, mirror):
+        """
+        Keep a mirror current from the "state_changed" events
+        :param mirror: HassStateMirror, None to stop
+        :return: Bool, True
+        """
+        with self._lock:
+            self._mirror = mirror
+            if mirror is not None and self._subscription is None:
+                if self._connection is not None:
+                    self._subscribe()
+                else:
+                    # The mirror may not have been loaded, it is once subscribed
+                    self._reconnected = True
+                mirror.set_streaming(False)
+        return True
+
+    def _request(self, message, timeout, replay=True):
+        if self.refused:
+            return TransportResponse(401, {"message": "Hass refused the API token"})
+        call = _Call(message, timeit.default_timer() + timeout, replay)
+        with self._lock:
+            self._calls.append(call)
+            self._waiting.set()
+            if self._connection is not None:
+                self._send(call)
+        # Not timed, _watch gives up on the calls waiting too long even while connecting
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.response
+
+    def _send(self, call):
+        """
+        Send a call over the current connection, with the lock held. Message ids only grow on a connection, so each
+        call gets its id when sent.
+        """
+        call.id = next(self._ids)
+        self._sent[call.id] = call
+        message = dict(call.message)
+        message['id'] = call.id
+        try:
+            self._connection.send(json.dumps(message))
+        except Exception as e:
+            # Sent again once reconnected
+            logger.debug("(WebSocketTransport) Could not send: %s", e)
+
+    def _subscribe(self):
+        self._subscription = next(self._ids)
+        try:
+            self._connection.send(json.dumps({"id": self._subscription, "type": "subscribe_events",
+                                              "event_type": "state_changed"}))
+        except Exception as e:
+            logger.debug("(WebSocketTransport) Could not subscribe: %s", e)
+
+    def _resolve(self, call, response=None, error=None):
+        """
+        Complete a call with its result or error. The result and the expiry of a call may come at once, only the
+        first completes it.
+        :return: Bool, False if the call was already completed
+        """
+        with self._lock:
+            if call.done.is_set():
+                return False
+            if call in self._calls:
+                self._calls.remove(call)
+            call.response = response
+            call.error = error
+            call.done.set()
+        return True
+
+    def _run(self):
+        while not self._closed:
+            try:
+                connection = self._open()
+            except Exception as e:
+                if not self.refused:
+                    logger.warning("(WebSocketTransport) Could not connect to %s: %s", self.url, e)
+                self._wait()
+                continue
+            try:
+                self._read(connection)
+            except Exception as e:
+                if not self._closed:
+                    logger.warning("(WebSocketTransport) Connection lost: %s", e)
+            self._lost(connection)
+
+    def _wait(self):
+        """
+        Wait before connecting again, until configure() is called while Hass refuses the token
+        """
+        if self.refused:
+            self._configured.wait()
+            self._configured.clear()
+            self.refused = False
+            return
+        time.sleep(RECONNECT_DELAY)
+
+    def _open(self):
+        """
+        Connect, authenticate and send the calls waiting
+        :return: The connection
+        """
+        connection = self.connect(self.url, CONNECT_TIMEOUT)
+        deadline = timeit.default_timer() + CONNECT_TIMEOUT
+        message = self._receive(connection, deadline)
+        if message.get('type') == 'auth_required':
+            token = self.header.get('Authorization', '')
+            if token.startswith('Bearer '):
+                token = token[len('Bearer '):]
+            connection.send(json.dumps({"type": "auth", "access_token": token}))
+            message = self._receive(connection, deadline)
+        if message.get('type') == 'auth_invalid':
+            connection.close()
+            self.refused = True
+            logger.error("(WebSocketTransport) Hass refused the API token")
+            with self._lock:
+                calls = list(self._calls)
+            for call in calls:
+                self._resolve(call, response=TransportResponse(401, {"message": message.get('message')}))
+            raise TransportError("Hass refused the API token")
+        if message.get('type') != 'auth_ok':
+            connection.close()
+            raise TransportError("Unexpected message from Hass: {}".format(message))
+        with self._lock:
+            self._connection = connection
+            self._sent = {}
+            self.connected = True
+            if self._mirror is not None:
+                self._subscribe()
+            # Sent again in the order they were made
+            for call in list(self._calls):
+                if call.id is None or call.replay:
+                    self._send(call)
+                else:
+                    self._calls.remove(call)
+                    call.error = TransportError("Connection lost before Hass answered")
+                    call.done.set()
+        logger.info("(WebSocketTransport) Connected to %s", self.url)
+        return connection
+
+    def _receive(self, connection, deadline):
+        while timeit.default_timer() < deadline:
+            raw = connection.recv()
+            if raw is not None:
+                return json.loads(raw)
+        raise TransportError("Hass did not answer in time")
+
+    def _read(self, connection):
+        while not self._closed and self._connection is connection:
+            raw = connection.recv()
+            if raw is not None:
+                self._handle(json.loads(raw))
+
+    def _handle(self, message):
+        kind = message.get('type')
+        if kind == 'event':
+            mirror = self._mirror
+            if mirror is not None and message.get('id') == self._subscription:
+                data = message.get('event', {}).get('data', {})
+                if data.get('new_state') is not None:
+                    mirror.update(data['new_state'])
+                elif data.get('entity_id'):
+                    mirror.remove(data['entity_id'])
+            return
+        with self._lock:
+            call = self._sent.pop(message.get('id'), None)
+        if call is None:
+            if message.get('id') == self._subscription and message.get('success'):
+                self._followed()
+            return
+        if kind == 'pong':
+            response = TransportResponse(200, {"message": "API running."})
+        elif message.get('success'):
+            response = TransportResponse(200, message.get('result'))
+        else:
+            error = message.get('error') or {}
+            response = TransportResponse(WEBSOCKET_ERRORS.get(error.get('code'), 500),
+                                         {"message": error.get('message')})
+        self._resolve(call, response=response)
+
+    def _followed(self):
+        mirror = self._mirror
+        if mirror is None:
+            return
+        if not self._reconnected:
+            mirror.set_streaming(True)
+            return
+
+        def reload():
+            # Events were missed while disconnected
+            try:
+                mirror.load()
+                mirror.set_streaming(True)
+            except Exception as e:
+                logger.warning("(WebSocketTransport) Could not reload the states: %s", e)
+        thread = threading.Thread(target=reload, name="hass-websocket-reload")
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self):
+        """
+        Fail the calls not answered within their timeout, only while some wait. Apart from the connection thread,
+        which may be stuck connecting or authenticating.
+        """
+        while not self._closed:
+            self._waiting.wait()
+            time.sleep(WEBSOCKET_TICK)
+            now = timeit.default_timer()
+            with self._lock:
+                expired = [call for call in self._calls if call.deadline <= now]
+                for call in expired:
+                    self._sent.pop(call.id, None)
+                if len(expired) == len(self._calls):
+                    self._waiting.clear()
+            for call in expired:
+                self._resolve(call, error=TransportError("No answer from Hass in time"))
+
+    def _lost(self, connection):
+        with self._lock:
+            if self._connection is connection:
+                self._connection = None
+                self._sent = {}
+                self._subscription = None
+                self.connected = False
+                self._reconnected = True
+        try:
+            connection.close()
+        except Exception:
+            pass
+        mirror = self._mirror
+        if mirror is not None:
+            mirror.set_streaming(False)
+
+
+class _WebSocketConnection(object):
+    """
+    websocket-client connection whose recv returns None when nothing arrived in time
+    """
+    def __init__(self, connection, timeout_error):
+        self.connection = connection
+        self.timeout_error = timeout_error
+
+    def send(self, text):
+        self.connection.send(text)
+
+    def recv(self):
+        try:
+            return self.connection.recv()
+        except self.timeout_error:
+            return None
+
+    def close(self):
+        self.connection.close()
+
+
+def connect_websocket(url, timeout):
+    """
+    Open a WebSocket, needs the websocket-client package
+    :param url: String, e.g. "ws://hass:8123/api/websocket"
+    :param timeout: Float, seconds to connect
+    :return: Connection for the WebSocketTransport
+    """
+    import websocket
+    connection = websocket.create_connection(url, timeout=timeout)
+    connection.settimeout(WEBSOCKET_TICK)
+    return _WebSocketConnection(connection, websocket.WebSocketTimeoutException)
+
+
+def connect_mqtt(address, client_id=None):
+    """
+    Open a long-lived connection to an MQTT broker, reconnecting in the background when it is lost.
+    Needs the paho-mqtt package.
+    :param address: String, "host:port" e.g. "localhost:1883"
+    :param client_id: String, "" for a random one
+    :return: paho.mqtt.client.Client, connecting in its own thread
+    """
+    import paho.mqtt.client as mqtt
+    host, _, port = address.partition(':')
+    client = mqtt.Client(client_id or '')
+    client.connect_async(host, int(port or 1883))
+    client.loop_start()
+    return client
+
+
+def _copy(state):
+    return json.loads(json.dumps(state))